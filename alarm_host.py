@@ -0,0 +1,115 @@
+"""
+Host computer stand-in for CircuitPython's alarm module.
+
+power.py uses CircuitPython's alarm module on the Pico.  On a host computer that module does not exist, so hal.py
+provides this one instead, with the same names and host friendly behaviour:
+
+- time.TimeAlarm and pin.PinAlarm record their settings.
+- light_sleep_until_alarms() sleeps on clock until the earliest TimeAlarm, unless a pin has been triggered with
+  trigger_pin() or a simulated pin (see hal_host.py) is already at the alarm's level, in which case it returns that
+  PinAlarm straight away.  On a virtual clock a simulated pin that reaches the alarm's level during the sleep ends
+  it at that moment.
+- exit_and_deep_sleep_until_alarms() records the alarms in deep_sleep_alarms and raises DeepSleepExit, standing in
+  for the reset that ends a real deep sleep.  Tests can then set wake_alarm and run the start up code again.
+- sleep_memory is a plain bytearray that keeps its contents for the life of the process.
+
+The module also counts light and deep sleeps so the power saving behaviour can be checked off the device.
+"""
+import time as _time
+
+# Clock used for TimeAlarms and light sleeps.  hal_host.py replaces it with its own clock.
+clock = _time
+
+# Survives "deep sleep" for the life of the process, like the RP2040's sleep memory survives a deep sleep reset.
+sleep_memory = bytearray(256)
+
+# The alarm that woke the program from deep sleep, or None after a normal start.
+wake_alarm = None
+
+# Alarms passed to the last exit_and_deep_sleep_until_alarms() call.
+deep_sleep_alarms = ()
+
+# Number of light and deep sleeps requested.
+light_sleep_count = 0
+deep_sleep_count = 0
+
+# Pins triggered with trigger_pin() that have not yet woken a light sleep.
+_triggered_pins = []
+
+
+class DeepSleepExit(SystemExit):
+    """
+    Raised by exit_and_deep_sleep_until_alarms() in place of the reset that ends a deep sleep on the Pico.
+    """
+
+
+class _TimeModule:
+    class TimeAlarm:
+        def __init__(self, *, monotonic_time=None, epoch_time=None):
+            if (monotonic_time is None) == (epoch_time is None):
+                raise ValueError("Provide exactly one of monotonic_time or epoch_time")
+            if epoch_time is not None:
+                monotonic_time = clock.monotonic() + (epoch_time - clock.time())
+            self.monotonic_time = monotonic_time
+
+
+class _PinModule:
+    class PinAlarm:
+        def __init__(self, pin, value, edge=False, pull=False):
+            self.pin = pin
+            self.value = value
+            self.edge = edge
+            self.pull = pull
+
+
+time = _TimeModule
+pin = _PinModule
+
+
+def trigger_pin(pin_name):
+    """
+    Makes the next light sleep that is waiting on the given pin return its PinAlarm immediately.
+    """
+    _triggered_pins.append(pin_name)
+
+
+def light_sleep_until_alarms(*alarms):
+    """
+    Sleeps until the earliest TimeAlarm, or returns a PinAlarm at once if its pin was triggered.
+
+    :returns:
+        alarm: The alarm that ended the sleep.
+    """
+    global light_sleep_count
+    light_sleep_count += 1
+    for alarm in alarms:
+        if isinstance(alarm, pin.PinAlarm):
+            if alarm.pin in _triggered_pins:
+                _triggered_pins.remove(alarm.pin)
+                return alarm
+            if getattr(alarm.pin, "external", None) == alarm.value:
+                return alarm
+
+    time_alarms = [alarm for alarm in alarms if isinstance(alarm, time.TimeAlarm)]
+    if not time_alarms:
+        raise ValueError("No alarm can wake the host from light sleep")
+    earliest = min(time_alarms, key=lambda alarm: alarm.monotonic_time)
+    while True:
+        remaining = earliest.monotonic_time - clock.monotonic()
+        if remaining <= 0:
+            return earliest
+        clock.sleep(remaining)
+        # A virtual clock sleep stops early for a simulated event, which may have pressed a button.
+        for alarm in alarms:
+            if isinstance(alarm, pin.PinAlarm) and getattr(alarm.pin, "external", None) == alarm.value:
+                return alarm
+
+
+def exit_and_deep_sleep_until_alarms(*alarms, preserve_dios=()):
+    """
+    Records the alarms and raises DeepSleepExit in place of the reset that starts a deep sleep.
+    """
+    global deep_sleep_alarms, deep_sleep_count
+    deep_sleep_count += 1
+    deep_sleep_alarms = alarms
+    raise DeepSleepExit()
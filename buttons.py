@@ -0,0 +1,257 @@
+"""
+Manual button debouncing for the Garden Controller.
+
+The old check_manual_button() slept 0.1 seconds for every pressed button to debounce it, so with all eight latching
+buttons held each pass of the main loop stalled for 0.8 seconds before any scheduling happened.
+
+Debouncer never sleeps.  It takes the raw button states as a bitmask (bit i set while button i reads pressed) and a
+time.monotonic() timestamp, and only reports a button as pressed once it has read pressed for press_time seconds, or
+as released once it has read released for release_time seconds.  The work done depends on how many buttons changed,
+not on how many are held, and next_deadline() tells the main loop when a pending change will become stable so it can
+wake up for it instead of polling.
+
+The raw states can come from polling the pins or from a keypad event queue.  With a queue, feed every event to
+update() with the time it happened (see event_time()), so a press that started and ended while the main loop was
+asleep is still seen: it is latched in presses until take_presses() is called.
+
+RateLimiter caps how many log entries each button can produce in a time window, so a chattering contact cannot flood
+the event log.  Entries over the limit are counted instead.
+
+ButtonScanner reads the buttons of the LCD shield.  They sit on one port of the shield's I2C port expander, and
+reading each button's property is a separate I2C read of that port.  ButtonScanner reads the port once per scan,
+decodes every button from that one snapshot, debounces them with a Debouncer and turns them into press events, with
+auto-repeat while an arrow button is held.
+"""
+from array import array
+
+from relay_state import iter_bits
+
+# keypad event timestamps come from supervisor.ticks_ms(), which wraps around every 2**29 milliseconds.
+TICKS_PERIOD = 1 << 29
+
+# Buttons of the RGB LCD shield: bit i of the port expander's GPIOA register, pulled up, so 0 while pressed.
+SHIELD_SELECT = 0
+SHIELD_RIGHT = 1
+SHIELD_DOWN = 2
+SHIELD_UP = 3
+SHIELD_LEFT = 4
+SHIELD_BUTTONS = 5
+# The arrow buttons, which repeat while held.
+SHIELD_ARROWS = 1 << SHIELD_RIGHT | 1 << SHIELD_DOWN | 1 << SHIELD_UP | 1 << SHIELD_LEFT
+
+
+def event_time(timestamp, ticks_now, now):
+    """
+    Converts a keypad event timestamp into a time.monotonic() value.
+
+    :parameters:
+        timestamp (int): The event's timestamp from supervisor.ticks_ms().
+        ticks_now (int): supervisor.ticks_ms() now.
+        now (float): time.monotonic() now.
+    """
+    return now - ((ticks_now - timestamp) % TICKS_PERIOD) / 1000
+
+
+class Debouncer:
+    """
+    Debounces up to 32 buttons given as a bitmask of raw states.
+
+    :parameters:
+        count (int): Number of buttons, bit i of the masks is button i.
+        press_time (float): Seconds a button must read pressed before it is reported pressed.
+        release_time (float): Seconds a button must read released before it is reported released.
+    """
+
+    def __init__(self, count, press_time=0.05, release_time=0.05):
+        self.count = count
+        self.press_time = press_time
+        self.release_time = release_time
+        self.raw = 0  # Raw states at the last update().
+        self.stable = 0  # Debounced states.
+        self.changed_at = [0.0] * count  # time.monotonic() when each button's raw state last changed.
+        self.presses = 0  # Buttons that became pressed since the last take_presses().
+        self.bounces = 0  # Raw changes that did not last long enough to change the debounced state.
+
+    def update(self, raw, now):
+        """
+        Feeds in the raw button states and returns the debounced states.
+
+        :parameters:
+            raw (int): Bitmask of buttons that read pressed now.
+            now (float): The current time.monotonic() value.
+
+        :returns:
+            stable (int): Bitmask of debounced pressed buttons.
+        """
+        # Pending changes that lasted until now are stable, even if this update ends them.
+        self.settle(now)
+        changed = raw ^ self.raw
+        if changed:
+            for i in range(self.count):
+                bit = 1 << i
+                if changed & bit:
+                    if (self.stable ^ self.raw) & bit:
+                        self.bounces += 1  # A pending change reverted before it became stable.
+                    self.changed_at[i] = now
+            self.raw = raw
+            self.settle(now)
+        return self.stable
+
+    def settle(self, now):
+        """
+        Makes every pending change that has lasted its settle time part of the debounced states.
+        """
+        pending = self.raw ^ self.stable
+        if pending:
+            for i in range(self.count):
+                bit = 1 << i
+                if pending & bit:
+                    settle = self.press_time if self.raw & bit else self.release_time
+                    # Compared the same way next_deadline() adds them up, so waking at the deadline settles it.
+                    if now >= self.changed_at[i] + settle:
+                        self.stable ^= bit
+                        if self.raw & bit:
+                            self.presses |= bit
+
+    def take_presses(self):
+        """
+        Returns the buttons that became pressed since the last call, including any already released again.
+        """
+        presses = self.presses
+        self.presses = 0
+        return presses
+
+    def next_deadline(self):
+        """
+        Returns the time.monotonic() value at which the next pending change becomes stable, or None if none is pending.
+        """
+        pending = self.raw ^ self.stable
+        if not pending:
+            return None
+        deadline = None
+        for i in range(self.count):
+            bit = 1 << i
+            if pending & bit:
+                settle = self.press_time if self.raw & bit else self.release_time
+                if deadline is None or self.changed_at[i] + settle < deadline:
+                    deadline = self.changed_at[i] + settle
+        return deadline
+
+
+class RateLimiter:
+    """
+    Allows at most limit events for each index in every window seconds.
+
+    :parameters:
+        count (int): Number of indexes, for example one per button.
+        limit (int): Most events allowed per index in each window, at most 255.
+        window (float): Length of the window in seconds.  Each index's window starts with its first event.
+    """
+
+    def __init__(self, count, limit=6, window=60):
+        self.limit = limit
+        self.window = window
+        self.window_start = [None] * count  # time.monotonic() at the start of each index's window.
+        self.events = bytearray(count)  # Events allowed in the current window.
+        self.suppressed = array("H", [0] * count)  # Events refused since the last pop_suppressed().
+
+    def allow(self, index, now):
+        """
+        Returns True if another event for index is allowed now, otherwise counts it as suppressed.
+        """
+        start = self.window_start[index]
+        if start is None or now - start >= self.window:
+            self.window_start[index] = now
+            self.events[index] = 0
+        if self.events[index] < self.limit:
+            self.events[index] += 1
+            return True
+        if self.suppressed[index] < 0xFFFF:
+            self.suppressed[index] += 1
+        return False
+
+    def pop_suppressed(self, index):
+        """
+        Returns the number of events refused for index since the last call and clears it.
+        """
+        suppressed = self.suppressed[index]
+        self.suppressed[index] = 0
+        return suppressed
+
+
+class ButtonScanner:
+    """
+    Debounced press and auto-repeat events from a port of buttons read in one go.
+
+    Each scan() reads the port once.  A button gives one event when its press is stable, and a button in repeat
+    gives another after repeat_delay seconds held and then every repeat_interval seconds until it is released.
+
+    Attributes:
+        repeated (int): Buttons whose event in the last scan() was a repeat rather than a press.
+        scans (int): Number of times the port was read.
+
+    :parameters:
+        read_port (function): Returns the port's pin levels as an integer, bit i for button i.
+        count (int): Number of buttons, bits 0 to count - 1 of the port.
+        active_low (bool): True if a button reads 0 while pressed.
+        repeat (int): Mask of the buttons that repeat while held.
+        repeat_delay (float): Seconds a button is held before it first repeats.
+        repeat_interval (float): Seconds between repeats.
+        press_time, release_time (float): Debounce times, see Debouncer.
+    """
+
+    def __init__(self, read_port, count=SHIELD_BUTTONS, active_low=True, repeat=SHIELD_ARROWS, repeat_delay=0.5,
+                 repeat_interval=0.15, press_time=0.02, release_time=0.02):
+        self.read_port = read_port
+        self.mask = (1 << count) - 1
+        self.active_low = active_low
+        self.repeat = repeat
+        self.repeat_delay = repeat_delay
+        self.repeat_interval = repeat_interval
+        self.debouncer = Debouncer(count, press_time, release_time)
+        self.repeat_at = [0.0] * count  # time.monotonic() of each held button's next repeat.
+        self.repeated = 0
+        self.scans = 0
+
+    def scan(self, now):
+        """
+        Reads the port and returns the buttons with an event.
+
+        :parameters:
+            now (float): The current time.monotonic() value.
+
+        :returns:
+            events (int): Mask of the buttons pressed, or repeating, since the last scan.
+        """
+        port = self.read_port()
+        self.scans += 1
+        raw = (~port if self.active_low else port) & self.mask
+        held = self.debouncer.update(raw, now)
+        presses = self.debouncer.take_presses()
+        self.repeated = 0
+        for i in iter_bits(presses & self.repeat):
+            self.repeat_at[i] = now + self.repeat_delay
+        for i in iter_bits(held & self.repeat & ~presses):
+            if now >= self.repeat_at[i]:
+                self.repeated |= 1 << i
+                self.repeat_at[i] += self.repeat_interval
+                if self.repeat_at[i] <= now:
+                    # Repeats missed while nothing scanned are dropped, not sent in a burst.
+                    self.repeat_at[i] = now + self.repeat_interval
+        return presses | self.repeated
+
+    def held(self):
+        """
+        Returns the mask of the buttons held down, debounced.
+        """
+        return self.debouncer.stable
+
+    def next_deadline(self):
+        """
+        Returns the time.monotonic() value of the next pending debounce or repeat, or None if nothing is pending.
+        """
+        deadline = self.debouncer.next_deadline()
+        for i in iter_bits(self.debouncer.stable & self.repeat):
+            if deadline is None or self.repeat_at[i] < deadline:
+                deadline = self.repeat_at[i]
+        return deadline
@@ -0,0 +1,469 @@
+"""
+Buffered event log for the Garden Controller.
+
+Writing to flash is slow and every small write to log.txt also updates the FAT and directory sectors.  When several
+relays switch in the same minute the old log_data() opened, wrote, flushed and closed the log file once per event,
+stalling the main loop on a burst of tiny flash writes.
+
+LogBuffer keeps log records in a fixed size ring buffer in RAM and writes them to the log file in one block when the
+buffer reaches flush_threshold records, when the oldest record has waited flush_interval seconds, or when a flush is
+forced (before a deep sleep, when the schedule is paused or when the program stops).  The buffer never holds more
+than capacity records.  If records can't be written (for example the filesystem is read-only) the oldest records are
+overwritten and counted in dropped.
+
+A record is an event rather than a line of text: (epoch_time, code, relay, value, message).  code is one of the
+EVENT_* constants below, relay is the relay index (NO_RELAY if the event has no relay), value is an integer such as
+the CPU temperature in hundredths of a degree, and message is only used by EVENT_TEXT records.  Records are only
+turned into text by format_record() when a text log is written or read.
+
+Log records can be stored as:
+- Text: "YYYY-MM-DD HH:MM:SS: message" lines, roughly 60 bytes each.
+- Binary: fixed width 8 byte records (see RECORD_FORMAT), which are much smaller and need no formatting on the Pico.
+  EVENT_TEXT messages are not kept in binary records.  decode_binary_record() and log_reader.py turn them back into
+  text or CSV on a host computer.
+
+And written to:
+- TextLogFile or BinaryLogFile, which append to log.txt or log.bin and grow for as long as logging is enabled.
+- CircularLogFile, which preallocates a fixed size file and overwrites it in place as a circular log.  A small header
+  holds the position of the newest record and the number of records kept, so every write costs the same, the file
+  never grows and the filesystem can never fill up.  read_circular_log() (and log_reader.py on a host computer)
+  rebuilds the records in chronological order.
+
+The clock comes from hal.py so the module runs the same on the Pico and on a host computer.
+"""
+import struct
+from array import array
+
+from hal import time
+
+# Event codes stored in log records.
+EVENT_TEXT = 0  # Free text message, only kept in text logs.
+EVENT_MANUAL_ON = 1
+EVENT_MANUAL_OFF = 2
+EVENT_SCHEDULE_ON = 3
+EVENT_SCHEDULE_OFF = 4
+EVENT_CPU_TEMP = 5  # value is the CPU temperature in hundredths of a degree Celsius.
+EVENT_LOOP_PHASE = 6  # relay is a main loop phase (see profiler.py), value its longest time in milliseconds.
+EVENT_TIME_SYNC = 7  # relay is the time server's index (see time_sync.py), value the clock offset in milliseconds.
+EVENT_TIME_SYNC_FAILED = 8  # No time server answered.
+EVENT_CLOCK_DRIFT = 9  # value is the measured clock drift in hundredths of a ppm, positive if the clock runs fast.
+EVENT_QUEUE_DELAY = 10  # value is how many seconds a scheduled start waited for a valve (see sequencer.py).
+
+# Relay index stored for events that do not belong to a relay.
+NO_RELAY = 255
+
+# Text for each event code, formatted with the record's relay and value.
+EVENT_MESSAGES = {
+    EVENT_MANUAL_ON: "Relay {relay}: was manually activated.",
+    EVENT_MANUAL_OFF: "Relay {relay}: was manually deactivated.",
+    EVENT_SCHEDULE_ON: "Relay {relay}: was activated via schedule.",
+    EVENT_SCHEDULE_OFF: "Relay {relay}: was deactivated via schedule.",
+    EVENT_CPU_TEMP: "CPU Temp: {temp:.2f} °C",
+    EVENT_LOOP_PHASE: "Loop phase {relay}: longest {value} ms.",
+    EVENT_TIME_SYNC: "Time synced from server {relay}: offset {value} ms.",
+    EVENT_TIME_SYNC_FAILED: "Time sync failed.",
+    EVENT_CLOCK_DRIFT: "Clock drift: {temp:.2f} ppm.",
+    EVENT_QUEUE_DELAY: "Relay {relay}: started {value} s late, waiting for a valve.",
+}
+
+# Short names for each event code, used in CSV output.
+EVENT_NAMES = {
+    EVENT_TEXT: "text",
+    EVENT_MANUAL_ON: "manual_on",
+    EVENT_MANUAL_OFF: "manual_off",
+    EVENT_SCHEDULE_ON: "schedule_on",
+    EVENT_SCHEDULE_OFF: "schedule_off",
+    EVENT_CPU_TEMP: "cpu_temp",
+    EVENT_LOOP_PHASE: "loop_phase",
+    EVENT_TIME_SYNC: "time_sync",
+    EVENT_TIME_SYNC_FAILED: "time_sync_failed",
+    EVENT_CLOCK_DRIFT: "clock_drift",
+    EVENT_QUEUE_DELAY: "queue_delay",
+}
+
+# Binary record layout: epoch time (uint32), event code (uint8), relay index (uint8), value (int16).
+RECORD_FORMAT = "<IBBh"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Record formats, as stored in the circular log header.
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_BINARY = "binary"
+LOG_FORMAT_CODES = {LOG_FORMAT_TEXT: 0, LOG_FORMAT_BINARY: 1}
+
+
+def format_timestamp(epoch_time):
+    """
+    Formats seconds since the epoch as "YYYY-MM-DD HH:MM:SS".
+    """
+    t = time.localtime(epoch_time)
+    return "{:04}-{:02}-{:02} {:02}:{:02}:{:02}".format(t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
+
+
+def format_message(code, relay, value, message=None):
+    """
+    Returns the text message for an event record.
+    """
+    if code == EVENT_TEXT:
+        return message if message is not None else "(text message not stored)"
+    template = EVENT_MESSAGES.get(code)
+    if template is None:
+        return f"Unknown event {code}: relay {relay}, value {value}"
+    return template.format(relay=relay, temp=value / 100, value=value)
+
+
+def format_record(record):
+    """
+    Formats a record as a "YYYY-MM-DD HH:MM:SS: message" log line without the trailing newline.
+    """
+    epoch_time, code, relay, value, message = record
+    return f"{format_timestamp(epoch_time)}: {format_message(code, relay, value, message)}"
+
+
+def encode_binary_record(record):
+    """
+    Packs a record into RECORD_SIZE bytes.  The message of an EVENT_TEXT record is not stored.
+    """
+    epoch_time, code, relay, value, _ = record
+    return struct.pack(RECORD_FORMAT, epoch_time, code, relay, max(-32768, min(32767, value)))
+
+
+def decode_binary_record(data):
+    """
+    Unpacks RECORD_SIZE bytes written by encode_binary_record() into a record.
+    """
+    epoch_time, code, relay, value = struct.unpack(RECORD_FORMAT, bytes(data))
+    return epoch_time, code, relay, value, None
+
+
+class TextLogFile:
+    """
+    Appends log records to a text file, one "YYYY-MM-DD HH:MM:SS: message" line per record.
+    """
+    record_format = LOG_FORMAT_TEXT
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write_records(self, records):
+        """
+        Appends records to the log file with a single open, write and close.
+
+        :parameters:
+            records (list): List of records, oldest first.
+        """
+        lines = [format_record(record) + "\n" for record in records]
+        with open(self.filename, "a") as log_file:
+            log_file.write("".join(lines))
+
+
+class BinaryLogFile:
+    """
+    Appends log records to a file as fixed width binary records (see RECORD_FORMAT).
+    """
+    record_format = LOG_FORMAT_BINARY
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write_records(self, records):
+        """
+        Appends records to the log file with a single open, write and close.
+
+        :parameters:
+            records (list): List of records, oldest first.
+        """
+        data = bytearray(RECORD_SIZE * len(records))
+        for i, record in enumerate(records):
+            data[i * RECORD_SIZE:(i + 1) * RECORD_SIZE] = encode_binary_record(record)
+        with open(self.filename, "ab") as log_file:
+            log_file.write(data)
+
+
+def read_binary_log(filename):
+    """
+    Reads a file written by BinaryLogFile and returns its records, oldest first.
+    """
+    with open(filename, "rb") as log_file:
+        data = log_file.read()
+    return [decode_binary_record(data[start:start + RECORD_SIZE])
+            for start in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE)]
+
+
+class LogBuffer:
+    """
+    A fixed size ring buffer of log records flushed to a log file in blocks.
+
+    The record fields are kept in preallocated arrays so the buffer's memory use is fixed when it is created.  Only
+    EVENT_TEXT records hold a message string, and messages are truncated to max_message characters.
+
+    :parameters:
+        sink: Object with a write_records(records) method, for example a TextLogFile.
+        capacity (int): Most records held in RAM.  Older records are overwritten when the buffer is full.
+        flush_threshold (int): Number of buffered records that triggers a flush.
+        flush_interval (float): Seconds the oldest buffered record may wait before a flush is due.
+        max_message (int): Longest message kept, longer messages are truncated to bound the buffer's memory.
+    """
+
+    def __init__(self, sink, capacity=32, flush_threshold=16, flush_interval=60, max_message=64):
+        if not 0 < flush_threshold <= capacity:
+            raise ValueError("flush_threshold must be between 1 and capacity")
+        self.sink = sink
+        self.capacity = capacity
+        self.flush_threshold = flush_threshold
+        self.flush_interval = flush_interval
+        self.max_message = max_message
+        # Preallocated ring buffer slots, head is the oldest record.
+        self.times = array("L", [0] * capacity)
+        self.codes = bytearray(capacity)
+        self.relays = bytearray(capacity)
+        self.values = array("l", [0] * capacity)
+        self.messages = [None] * capacity
+        self.head = 0
+        self.count = 0
+        self.oldest_added = 0  # time.monotonic() when the oldest buffered record was added.
+        self.dropped = 0  # Records overwritten before they could be written.
+        self.flushes = 0  # Blocks written to the sink.
+        self.write_errors = 0  # Failed writes to the sink.
+        self.retry_at = 0  # After a failed write, no threshold flush is tried before this time.monotonic() value.
+
+    def __len__(self):
+        return self.count
+
+    def add(self, epoch_time, code, relay=NO_RELAY, value=0, message=None):
+        """
+        Adds a record to the buffer and flushes it if the buffer has reached flush_threshold records.
+
+        :parameters:
+            epoch_time (int): Time of the event in seconds since the epoch.
+            code (int): Event code, one of the EVENT_* constants.
+            relay (int): Relay index, or NO_RELAY.
+            value (int): Event value, for example the CPU temperature in hundredths of a degree.  Values outside the
+                32 bit signed range are clamped to it.
+            message (str): Text of an EVENT_TEXT record, None for other events.
+
+        :returns: None
+        """
+        if self.count == 0:
+            self.oldest_added = time.monotonic()
+        if self.count == self.capacity:
+            # Buffer is full, overwrite the oldest record.
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+            self.dropped += 1
+        slot = (self.head + self.count) % self.capacity
+        self.times[slot] = epoch_time
+        self.codes[slot] = code
+        self.relays[slot] = relay
+        self.values[slot] = max(-0x80000000, min(0x7FFFFFFF, value))  # Fits the 32 bit "l" array on the Pico
+        self.messages[slot] = None if message is None else message[:self.max_message]
+        self.count += 1
+        if self.count >= self.flush_threshold and time.monotonic() >= self.retry_at:
+            self.flush()
+
+    def records(self):
+        """
+        Returns the buffered records, oldest first, as a list of (epoch_time, code, relay, value, message) tuples.
+        """
+        slots = [(self.head + i) % self.capacity for i in range(self.count)]
+        return [(self.times[slot], self.codes[slot], self.relays[slot], self.values[slot], self.messages[slot])
+                for slot in slots]
+
+    def flush_deadline(self):
+        """
+        Returns the time.monotonic() value at which a time based flush is due, or None if the buffer is empty.
+        """
+        if self.count == 0:
+            return None
+        return self.oldest_added + self.flush_interval
+
+    def flush_if_due(self):
+        """
+        Flushes the buffer if the oldest record has waited flush_interval seconds.
+        """
+        if self.count and time.monotonic() >= self.oldest_added + self.flush_interval:
+            return self.flush()
+        return False
+
+    def flush(self):
+        """
+        Writes every buffered record to the sink in one block.
+
+        :returns:
+            flushed (bool): True if records were written, False if the buffer was empty or the write failed.  After a
+            failed write the records stay buffered and the next flush is due flush_interval seconds later.
+        """
+        if self.count == 0:
+            return False
+        try:
+            self.sink.write_records(self.records())
+        except OSError as e:
+            self.write_errors += 1
+            self.oldest_added = time.monotonic()
+            self.retry_at = self.oldest_added + self.flush_interval
+            print(f"Unexpected error writing log: {e}")
+            return False
+        for i in range(self.count):
+            self.messages[(self.head + i) % self.capacity] = None
+        self.head = 0
+        self.count = 0
+        self.flushes += 1
+        return True
+
+
+# Layout of the CircularLogFile header: magic, header version, record format (see LOG_FORMAT_CODES), slot size in
+# bytes, number of slots, index of the slot the next record will be written to (head) and the number of slots
+# holding records (count).  The oldest record is in slot (head - count) % slots.
+CIRCULAR_LOG_MAGIC = b"GCLG"
+CIRCULAR_LOG_VERSION = 2
+CIRCULAR_LOG_HEADER_FORMAT = "<4sBBHIII"
+CIRCULAR_LOG_HEADER_SIZE = struct.calcsize(CIRCULAR_LOG_HEADER_FORMAT)
+
+
+def encode_text_slot(record, slot_size):
+    """
+    Encodes a record as a text line padded with spaces to exactly slot_size bytes, ending in a newline.
+    """
+    line = format_record(record).encode("utf-8")[:slot_size - 1]
+    return line + b" " * (slot_size - 1 - len(line)) + b"\n"
+
+
+def decode_text_slot(slot):
+    """
+    Decodes a slot written by encode_text_slot() back into its text line.
+    """
+    return bytes(slot).decode("utf-8", "replace").rstrip()
+
+
+def encode_binary_slot(record, slot_size):
+    """
+    Encodes a record as a binary record padded with zeros to slot_size bytes.
+    """
+    return encode_binary_record(record) + bytes(slot_size - RECORD_SIZE)
+
+
+def decode_binary_slot(slot):
+    """
+    Decodes a slot written by encode_binary_slot() back into a record.
+    """
+    return decode_binary_record(slot[:RECORD_SIZE])
+
+
+class CircularLogFile:
+    """
+    A fixed size log file of equal sized record slots that is overwritten in place as a circular log.
+
+    The whole file is written once when it is created, after that each flush opens it, writes the new records into
+    their slots, rewrites the header and closes it.  Records are written before the header, so if power is lost part
+    way through a flush the header still describes the previous, complete set of records.
+
+    :parameters:
+        filename (str): Path of the log file.
+        slots (int): Number of records the file holds before the oldest are overwritten.
+        slot_size (int): Size of each record slot in bytes.  Binary records always use RECORD_SIZE byte slots.
+        record_format (str): LOG_FORMAT_TEXT or LOG_FORMAT_BINARY.
+    """
+
+    def __init__(self, filename, slots=1024, slot_size=64, record_format=LOG_FORMAT_TEXT):
+        if record_format not in LOG_FORMAT_CODES:
+            raise ValueError("Invalid log format specified")
+        self.filename = filename
+        self.slots = slots
+        self.record_format = record_format
+        if record_format == LOG_FORMAT_BINARY:
+            self.slot_size = RECORD_SIZE
+            self.encode_slot = encode_binary_slot
+        else:
+            self.slot_size = slot_size
+            self.encode_slot = encode_text_slot
+        self.head = None  # Read from the header on the first write.
+        self.count = 0
+
+    def file_size(self):
+        return CIRCULAR_LOG_HEADER_SIZE + self.slots * self.slot_size
+
+    def pack_header(self):
+        return struct.pack(CIRCULAR_LOG_HEADER_FORMAT, CIRCULAR_LOG_MAGIC, CIRCULAR_LOG_VERSION,
+                           LOG_FORMAT_CODES[self.record_format], self.slot_size, self.slots, self.head, self.count)
+
+    def prepare(self):
+        """
+        Opens an existing circular log, or creates and preallocates a new one if the file is missing or was made
+        with a different size or record format.
+
+        :returns: None
+        """
+        try:
+            with open(self.filename, "rb") as log_file:
+                header = log_file.read(CIRCULAR_LOG_HEADER_SIZE)
+            magic, version, record_format, slot_size, slots, head, count = struct.unpack(
+                CIRCULAR_LOG_HEADER_FORMAT, header)
+            if ((magic, version, record_format, slot_size, slots) ==
+                    (CIRCULAR_LOG_MAGIC, CIRCULAR_LOG_VERSION, LOG_FORMAT_CODES[self.record_format], self.slot_size,
+                     self.slots) and head < slots and count <= slots):
+                self.head, self.count = head, count
+                return
+        except (OSError, ValueError, struct.error):
+            pass
+        self.create()
+
+    def create(self):
+        """
+        Writes a new, empty circular log file of its full size.
+        """
+        self.head, self.count = 0, 0
+        blank = bytes(self.slot_size)
+        with open(self.filename, "wb") as log_file:
+            log_file.write(self.pack_header())
+            for _ in range(self.slots):
+                log_file.write(blank)
+
+    def write_records(self, records):
+        """
+        Writes records into the next slots, overwriting the oldest records once the file is full.
+
+        :parameters:
+            records (list): List of records, oldest first.
+        """
+        if self.head is None:
+            self.prepare()
+        # Only the newest records fit if a single block is larger than the whole file.
+        records = records[-self.slots:]
+        head = self.head
+        with open(self.filename, "r+b") as log_file:
+            for record in records:
+                log_file.seek(CIRCULAR_LOG_HEADER_SIZE + head * self.slot_size)
+                log_file.write(self.encode_slot(record, self.slot_size))
+                head = (head + 1) % self.slots
+            self.head = head
+            self.count = min(self.count + len(records), self.slots)
+            log_file.seek(0)
+            log_file.write(self.pack_header())
+
+
+def read_circular_log(filename):
+    """
+    Reads a circular log file and returns its entries in chronological order, oldest first.
+
+    :parameters:
+        filename (str): Path of the circular log file.
+
+    :returns:
+        record_format (str): LOG_FORMAT_TEXT or LOG_FORMAT_BINARY.
+        entries (list): Text lines for a text log, records for a binary log, oldest first.
+    """
+    with open(filename, "rb") as log_file:
+        data = log_file.read()
+    magic, version, record_format, slot_size, slots, head, count = struct.unpack(
+        CIRCULAR_LOG_HEADER_FORMAT, data[:CIRCULAR_LOG_HEADER_SIZE])
+    if magic != CIRCULAR_LOG_MAGIC or version != CIRCULAR_LOG_VERSION:
+        raise ValueError(f"{filename} is not a circular log file")
+    if record_format == LOG_FORMAT_CODES[LOG_FORMAT_BINARY]:
+        record_format, decode_slot = LOG_FORMAT_BINARY, decode_binary_slot
+    else:
+        record_format, decode_slot = LOG_FORMAT_TEXT, decode_text_slot
+    entries = []
+    for i in range(count):
+        slot = (head - count + i) % slots
+        start = CIRCULAR_LOG_HEADER_SIZE + slot * slot_size
+        entries.append(decode_slot(data[start:start + slot_size]))
+    return record_format, entries
@@ -0,0 +1,47 @@
+"""
+Hardware abstraction layer for the Garden Controller.
+
+main.py talks to the hardware through the CircuitPython modules board, digitalio, keypad, rtc, microcontroller, wifi,
+socketpool, alarm, supervisor and adafruit_requests, plus time and asyncio, and lcd_controller.py through busio and
+the LCD shield driver, character_lcd.  This module picks a backend that provides all of them:
+
+- hal_pico.py simply re-exports the real CircuitPython modules, so on the Pico nothing changes.
+- hal_host.py provides stand-ins with the same names and interfaces that run under CPython on a host computer:
+  simulated pins, a CPU temperature sensor, an RTC and Wi-Fi radio, a socket pool backed by the host's sockets, a
+  time server for the Internet time lookup, an SNTP server on 127.0.0.1, an LCD shield that counts its I2C traffic,
+  and a clock that can run in real time or in virtual time, with an asyncio event loop to match.
+
+The backend is chosen by the GARDEN_HAL setting ("pico" or "host"), which can be set in settings.toml on the Pico or
+as an environment variable on a host computer.  Without it, hal_pico is used on CircuitPython and hal_host everywhere
+else, so running "python main.py" on a host computer runs the controller against simulated hardware.
+
+Usage, in place of the CircuitPython imports:
+    from hal import board, digitalio, rtc, microcontroller, time
+"""
+import os
+import sys
+
+backend_name = os.getenv("GARDEN_HAL") or ("pico" if sys.implementation.name == "circuitpython" else "host")
+
+if backend_name == "pico":
+    import hal_pico as backend
+elif backend_name == "host":
+    import hal_host as backend
+else:
+    raise ValueError(f"Unknown GARDEN_HAL backend: {backend_name}")
+
+board = backend.board
+busio = backend.busio
+character_lcd = backend.character_lcd
+digitalio = backend.digitalio
+keypad = backend.keypad
+rtc = backend.rtc
+microcontroller = backend.microcontroller
+wifi = backend.wifi
+socketpool = backend.socketpool
+ssl = backend.ssl
+adafruit_requests = backend.adafruit_requests
+alarm = backend.alarm
+supervisor = backend.supervisor
+time = backend.time
+asyncio = backend.asyncio
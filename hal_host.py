@@ -0,0 +1,864 @@
+"""
+Host computer backend for hal.py.
+
+Provides stand-ins for the CircuitPython modules main.py uses so the controller runs under CPython on a host computer
+(Linux, macOS or Windows) for development, profiling and benchmarking.  Each stand-in has the same names and
+interface as the CircuitPython module it replaces:
+
+- time: a HostClock that runs in real time, or in virtual time where sleep() advances the clock instantly.  Like
+  CircuitPython, time.time() reads the RTC and localtime()/mktime() do no time zone conversion.
+- board: simulated pins GP0 to GP28 and LED.  press() and release() ground and free a button pin.
+- digitalio: DigitalInOut, Direction and Pull driving or reading the simulated pins.
+- keypad: Keys, which queues a press or release event the moment a simulated button pin changes, like the background
+  scanning of CircuitPython's keypad module.
+- supervisor: ticks_ms() from the HostClock.
+- busio: an I2C bus on two simulated pins.
+- character_lcd: a CharacterLcd standing in for the Adafruit RGB 16x2 LCD shield (Character_LCD_RGB_I2C).  It keeps
+  the characters on the display and counts the I2C transactions the real driver would make.
+- rtc: an RTC whose date/time starts at 2000-01-01 00:00:00, as the Pico's does after power up.
+- microcontroller: a CPU with a settable temperature.
+- wifi: a radio that "connects" at once (set radio.fail_connect to simulate failures).
+- socketpool: a SocketPool backed by the host's own sockets.  Every lookup of an SNTP server (port 123) resolves to
+  sntp_server, a local UDP server answering from the simulated world clock.
+- adafruit_requests: a Session that answers the worldtimeapi.org lookup from the simulated world clock, so no real
+  network access is needed.
+- alarm: alarm_host.py.
+- asyncio: CPython's own asyncio.  new_event_loop() returns a VirtualEventLoop while the HostClock runs in virtual
+  time, so the controller's tasks wait on the virtual clock too.
+
+Simulation helpers (pins, clock, world time) live on these objects, for example board.GP8.external = False holds a
+button down and time.advance(60) moves virtual time forward a minute.
+"""
+import asyncio
+import calendar
+import selectors
+import socket as _socket
+import ssl
+import struct
+import threading
+import time as _time
+from types import SimpleNamespace
+
+import alarm_host as alarm
+from time_zone import get_zone
+
+# RTC date/time after power up, 2000-01-01 00:00:00.
+RTC_POWER_UP_EPOCH = calendar.timegm((2000, 1, 1, 0, 0, 0, 5, 1, -1))
+
+
+class HostClock:
+    """
+    Stand-in for CircuitPython's time module.
+
+    Keeps three clocks: monotonic time since start up, "world" time (the true local date/time in the simulated world,
+    as seconds since the epoch) and the RTC, which is world time plus an offset that changes when the RTC is set.
+    crystal_ppm makes the Pico's crystal run fast (positive) or slow (negative) against world time.  Monotonic time
+    and the RTC both count crystal time, as on the RP2040, so they drift from world time together.  rtc_drift_ppm
+    makes the RTC alone run fast or slow against monotonic time.
+
+    In virtual time, call_at() schedules simulated world events (a button press, say) at a monotonic time.  A sleep
+    that reaches one stops there, runs it and returns early, the same as a sleep that was interrupted, so code that
+    polls the buttons between sleeps notices the event at the moment it happens.
+
+    :parameters:
+        virtual (bool): If True, sleep() advances the clock instead of waiting and the clock only moves when it does.
+        world_epoch (int): World time at start up, defaults to the host's local date/time.
+    """
+    struct_time = _time.struct_time
+
+    def __init__(self, virtual=False, world_epoch=None):
+        self.restart(virtual, world_epoch)
+
+    def restart(self, virtual=False, world_epoch=None):
+        """
+        Starts the clock again as if the Pico had just powered up, with the RTC back at 2000-01-01.
+        """
+        self.virtual = virtual
+        self.real_start = _time.monotonic()
+        self.virtual_now = 0.0
+        if world_epoch is None:
+            world_epoch = calendar.timegm(_time.localtime())
+        self.world_start = world_epoch
+        self.rtc_offset = RTC_POWER_UP_EPOCH - world_epoch
+        self.rtc_drift_ppm = 0
+        self.crystal_ppm = 0
+        self.sleep_calls = 0
+        self.timers = []  # Sorted list of [monotonic_time, seq, function] for call_at().
+        self.timer_seq = 0
+
+    def monotonic(self):
+        if self.virtual:
+            return self.virtual_now
+        return _time.monotonic() - self.real_start
+
+    def monotonic_ns(self):
+        return round(self.monotonic() * 1_000_000_000)
+
+    def world_time(self):
+        """
+        Returns the true local date/time in the simulated world as seconds since the epoch.
+        """
+        uptime = self.monotonic()
+        return self.world_start + uptime - uptime * self.crystal_ppm / 1_000_000
+
+    def world_to_monotonic(self, epoch_time):
+        """
+        Returns the monotonic time at which world time reaches epoch_time.
+        """
+        return (epoch_time - self.world_start) / (1 - self.crystal_ppm / 1_000_000)
+
+    def time(self):
+        """
+        Returns the RTC date/time as whole seconds since the epoch, like CircuitPython's time.time().
+        """
+        uptime = self.monotonic()
+        return int(self.world_start + uptime + self.rtc_offset + uptime * self.rtc_drift_ppm / 1_000_000)
+
+    def set_rtc(self, epoch_time):
+        """
+        Sets the RTC to the given date/time in seconds since the epoch.
+        """
+        uptime = self.monotonic()
+        self.rtc_offset = epoch_time - self.world_start - uptime - uptime * self.rtc_drift_ppm / 1_000_000
+
+    def sleep(self, seconds):
+        self.sleep_calls += 1
+        if seconds <= 0:
+            return
+        if not self.virtual:
+            _time.sleep(seconds)
+            return
+        wake_at = self.virtual_now + seconds
+        if self.timers and self.timers[0][0] < wake_at:
+            # A simulated event happens first, stop the sleep there.
+            self.virtual_now = max(self.virtual_now, self.timers[0][0])
+            self.run_timers()
+        else:
+            self.virtual_now = wake_at
+
+    def call_at(self, monotonic_time, function):
+        """
+        Calls function() when virtual time reaches monotonic_time.
+        """
+        self.timer_seq += 1
+        self.timers.append([monotonic_time, self.timer_seq, function])
+        self.timers.sort()
+
+    def run_timers(self):
+        """
+        Calls every function from call_at() that is due.
+        """
+        while self.timers and self.timers[0][0] <= self.virtual_now:
+            self.timers.pop(0)[2]()
+
+    def advance(self, seconds):
+        """
+        Moves virtual time forward.  In real time mode this waits instead.
+        """
+        self.sleep(seconds)
+
+    @staticmethod
+    def localtime(seconds=None):
+        if seconds is None:
+            seconds = time.time()
+        return _time.gmtime(int(seconds))
+
+    gmtime = localtime
+
+    @staticmethod
+    def mktime(t):
+        return calendar.timegm(tuple(t))
+
+
+time = HostClock()
+
+
+class VirtualSelector(selectors.SelectSelector):
+    """
+    Selector for a VirtualEventLoop.  Instead of waiting for the timeout, select() jumps the virtual clock forward by
+    it, stopping early at a simulated world event like HostClock.sleep() does.
+    """
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            # Nothing is scheduled, only a simulated world event can change that.
+            if not time.timers:
+                raise RuntimeError("Every task is waiting and the virtual clock has nothing to advance to")
+            timeout = time.timers[0][0] - time.monotonic()
+        time.sleep(timeout)
+        return []
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """
+    asyncio event loop on the HostClock's virtual time, so tasks that await asyncio.sleep() skip ahead like a sleep
+    on the virtual clock.
+    """
+
+    def __init__(self):
+        super().__init__(VirtualSelector())
+
+    def time(self):
+        return time.monotonic()
+
+
+def new_event_loop():
+    """
+    Returns a new asyncio event loop that runs on the HostClock: a VirtualEventLoop in virtual time, otherwise a
+    regular one.
+    """
+    return VirtualEventLoop() if time.virtual else asyncio.new_event_loop()
+
+
+class SimPin:
+    """
+    A simulated GPIO pin.
+
+    external is the level something outside the Pico pulls the pin to (False for a button holding it to ground, None
+    when nothing is connected).  level is the level the pin is at, writes counts values written to it as an output
+    and transitions counts the times that value actually changed.  Functions in listeners are called with
+    (pin, level) whenever an output value changes or external changes the level of an input.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._external = None
+        self.driven = None  # Value written when the pin is an output.
+        self.pull = None
+        self.output = False
+        self.in_use = False
+        self.writes = 0
+        self.transitions = 0
+        self.listeners = []
+
+    def __repr__(self):
+        return f"board.{self.name}"
+
+    @property
+    def external(self):
+        return self._external
+
+    @external.setter
+    def external(self, value):
+        before = self.level
+        self._external = value
+        level = self.level
+        if level != before:
+            for listener in self.listeners:
+                listener(self, level)
+
+    @property
+    def level(self):
+        if self.output:
+            return self.driven
+        if self.external is not None:
+            return self.external
+        if self.pull is not None:
+            return self.pull == digitalio.Pull.UP
+        return False
+
+    def write(self, value):
+        self.writes += 1
+        if value != self.driven:
+            self.transitions += 1
+            self.driven = value
+            for listener in self.listeners:
+                listener(self, value)
+        self.driven = value
+
+
+def _make_board():
+    pins = {f"GP{i}": SimPin(f"GP{i}") for i in range(29)}
+    pins["LED"] = SimPin("LED")
+    return SimpleNamespace(**pins)
+
+
+board = _make_board()
+
+
+def press(pin):
+    """
+    Holds a button pin to ground.
+    """
+    pin.external = False
+
+
+def release(pin):
+    """
+    Lets go of a button pin.
+    """
+    pin.external = None
+
+
+class _Direction:
+    INPUT = "INPUT"
+    OUTPUT = "OUTPUT"
+
+
+class _Pull:
+    UP = "UP"
+    DOWN = "DOWN"
+
+
+class DigitalInOut:
+    """
+    Stand-in for digitalio.DigitalInOut driving or reading a SimPin.
+    """
+
+    def __init__(self, pin):
+        if pin.in_use:
+            raise ValueError(f"{pin} in use")
+        pin.in_use = True
+        pin.output = False
+        self._pin = pin
+
+    @property
+    def direction(self):
+        return _Direction.OUTPUT if self._pin.output else _Direction.INPUT
+
+    @direction.setter
+    def direction(self, value):
+        self._pin.output = value == _Direction.OUTPUT
+        if self._pin.output and self._pin.driven is None:
+            self._pin.driven = False
+
+    @property
+    def pull(self):
+        return self._pin.pull
+
+    @pull.setter
+    def pull(self, value):
+        self._pin.pull = value
+
+    @property
+    def value(self):
+        return self._pin.level
+
+    @value.setter
+    def value(self, value):
+        if not self._pin.output:
+            raise AttributeError("Cannot set value when direction is input.")
+        self._pin.write(bool(value))
+
+    def deinit(self):
+        self._pin.in_use = False
+        self._pin.output = False
+        self._pin.pull = None
+
+
+digitalio = SimpleNamespace(DigitalInOut=DigitalInOut, Direction=_Direction, Pull=_Pull)
+
+
+class RTC:
+    """
+    Stand-in for rtc.RTC, reading and setting the HostClock's RTC.
+    """
+
+    @property
+    def datetime(self):
+        return time.localtime(time.time())
+
+    @datetime.setter
+    def datetime(self, value):
+        time.set_rtc(time.mktime(value))
+
+
+rtc = SimpleNamespace(RTC=RTC)
+
+# supervisor.ticks_ms() wraps around every 2**29 milliseconds.
+TICKS_PERIOD = 1 << 29
+
+supervisor = SimpleNamespace(ticks_ms=lambda: int(time.monotonic() * 1000) % TICKS_PERIOD)
+
+
+class KeyEvent:
+    """
+    Stand-in for keypad.Event.
+    """
+
+    def __init__(self, key_number=0, pressed=True, timestamp=None):
+        self.key_number = key_number
+        self.pressed = pressed
+        self.timestamp = supervisor.ticks_ms() if timestamp is None else timestamp
+
+    @property
+    def released(self):
+        return not self.pressed
+
+    def __repr__(self):
+        return f"<Event: key_number {self.key_number} {'pressed' if self.pressed else 'released'}>"
+
+
+class EventQueue:
+    """
+    Stand-in for keypad.EventQueue.  When it is full new events are dropped and overflowed is set.
+    """
+
+    def __init__(self, max_events):
+        self.max_events = max_events
+        self.queue = []
+        self.overflowed = False
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __bool__(self):
+        return bool(self.queue)
+
+    def put(self, event):
+        if len(self.queue) >= self.max_events:
+            self.overflowed = True
+            return
+        self.queue.append(event)
+
+    def get(self):
+        return self.queue.pop(0) if self.queue else None
+
+    def get_into(self, event):
+        if not self.queue:
+            return False
+        queued = self.queue.pop(0)
+        event.key_number, event.pressed, event.timestamp = queued.key_number, queued.pressed, queued.timestamp
+        return True
+
+    def clear(self):
+        self.queue = []
+        self.overflowed = False
+
+
+class Keys:
+    """
+    Stand-in for keypad.Keys.
+
+    The real Keys scans its pins in the background every interval seconds.  Here each pin's listener queues an event
+    as soon as the pin's level changes, and keys that are already pressed are reported by press events straight
+    away, as the first scan reports them on the Pico.  debounce_threshold is accepted and ignored, simulated pins do
+    not bounce unless a test makes them.
+    """
+
+    def __init__(self, pins, *, value_when_pressed, pull=True, interval=0.02, max_events=64, debounce_threshold=1):
+        for pin in pins:
+            if pin.in_use:
+                raise ValueError(f"{pin} in use")
+        self.pins = tuple(pins)
+        self.value_when_pressed = value_when_pressed
+        self.events = EventQueue(max_events)
+        self.key_count = len(self.pins)
+        self.state = [False] * self.key_count
+        self.listeners = []
+        for key_number, pin in enumerate(self.pins):
+            pin.in_use = True
+            pin.output = False
+            if pull:
+                pin.pull = _Pull.DOWN if value_when_pressed else _Pull.UP
+            listener = self._listener(key_number)
+            pin.listeners.append(listener)
+            self.listeners.append(listener)
+        self.reset()
+
+    def _listener(self, key_number):
+        def listener(pin, level):
+            self._update(key_number, level == self.value_when_pressed)
+        return listener
+
+    def _update(self, key_number, pressed):
+        if pressed != self.state[key_number]:
+            self.state[key_number] = pressed
+            self.events.put(KeyEvent(key_number, pressed))
+
+    def reset(self):
+        """
+        Forgets the key states, so keys that are pressed are reported again.
+        """
+        self.state = [False] * self.key_count
+        for key_number, pin in enumerate(self.pins):
+            self._update(key_number, pin.level == self.value_when_pressed)
+
+    def deinit(self):
+        for pin, listener in zip(self.pins, self.listeners):
+            pin.listeners.remove(listener)
+            pin.in_use = False
+            pin.pull = None
+        self.listeners = []
+
+
+keypad = SimpleNamespace(Keys=Keys, Event=KeyEvent, EventQueue=EventQueue)
+
+microcontroller = SimpleNamespace(cpu=SimpleNamespace(temperature=25.0, frequency=125_000_000))
+
+
+class I2C:
+    """
+    Stand-in for busio.I2C.  Only claims its pins, the devices on the bus are simulated directly.
+    """
+
+    def __init__(self, scl, sda, frequency=100000):
+        for pin in (scl, sda):
+            if pin.in_use:
+                raise ValueError(f"{pin} in use")
+            pin.in_use = True
+        self.pins = (scl, sda)
+        self.frequency = frequency
+
+    def deinit(self):
+        for pin in self.pins:
+            pin.in_use = False
+
+
+busio = SimpleNamespace(I2C=I2C)
+
+# The shield's MCP23017 port expander drives the HD44780 display in 4 bit mode.  The Adafruit driver sends a byte as
+# 15 pin changes (the register select line, then each nibble on 4 data lines and a low-high-low pulse of the enable
+# line) and changes a pin by reading the expander's GPIO register and writing it back, 2 I2C transactions each.
+LCD_PIN_CHANGES_PER_BYTE = 15
+I2C_TRANSACTIONS_PER_PIN_CHANGE = 2
+# The driver sleeps 1 ms before every byte, and 3 ms after a clear or home command.
+LCD_BYTE_SECONDS = 0.001
+LCD_CLEAR_SECONDS = 0.003
+# Start of each line in the HD44780's display memory.
+LCD_ROW_OFFSETS = (0x00, 0x40, 0x14, 0x54)
+
+
+class CharacterLcd:
+    """
+    Stand-in for adafruit_character_lcd's Character_LCD_RGB_I2C on the Adafruit RGB LCD shield.
+
+    Holds the characters on the display in text, one string per line, and the custom characters in glyphs.  Counts
+    the bytes sent to the display (commands and characters), the backlight pin changes and from them the I2C
+    transactions and the seconds the real driver would spend.  The buttons are read from pressed, a set of button
+    names such as "select", and each read counts as one I2C transaction, whether of one button's property or of the
+    whole port through gpioa.
+    """
+
+    # Button names in the order of their pins on the port expander's port A.
+    BUTTONS = ("select", "right", "down", "up", "left")
+
+    def __init__(self, i2c, columns, lines):
+        self.columns = columns
+        self.lines = lines
+        self.column = 0
+        self.row = 0
+        self.text = [" " * columns for _ in range(lines)]
+        self.glyphs = {}
+        self.pressed = set()
+        self._color = [0, 0, 0]
+        self._message = None
+        self._address = 0  # Display memory address the next character goes to, as (row, column).
+        self.commands = 0
+        self.characters = 0
+        self.clears = 0
+        self.backlight_changes = 0
+        self.button_reads = 0
+        # The driver keeps no reference to the port expander, only its pins do.  Here the LCD stands in for both.
+        self._select_button = SimpleNamespace(_mcp=self)
+
+    def reset_counts(self):
+        self.commands = self.characters = self.clears = self.backlight_changes = self.button_reads = 0
+
+    @property
+    def bytes_sent(self):
+        return self.commands + self.characters
+
+    @property
+    def transactions(self):
+        pin_changes = self.bytes_sent * LCD_PIN_CHANGES_PER_BYTE + self.backlight_changes
+        return pin_changes * I2C_TRANSACTIONS_PER_PIN_CHANGE + self.button_reads
+
+    @property
+    def seconds(self):
+        return self.bytes_sent * LCD_BYTE_SECONDS + self.clears * LCD_CLEAR_SECONDS
+
+    def _command(self):
+        self.commands += 1
+
+    def _write(self, character):
+        self.characters += 1
+        if self._address is None:
+            return
+        row, column = self._address
+        if column < self.columns:
+            line = self.text[row]
+            self.text[row] = line[:column] + character + line[column + 1:]
+        self._address = (row, column + 1)
+
+    def clear(self):
+        self._command()
+        self.clears += 1
+        self.text = [" " * self.columns for _ in range(self.lines)]
+        self._address = (0, 0)
+
+    def home(self):
+        self._command()
+        self.clears += 1
+        self._address = (0, 0)
+
+    def cursor_position(self, column, row):
+        row = min(row, self.lines - 1)
+        self._command()
+        self._address = (row, column)
+        self.row = row
+        self.column = column
+
+    @property
+    def message(self):
+        return self._message
+
+    @message.setter
+    def message(self, message):
+        self._message = message
+        line = self.row
+        self.cursor_position(self.column, line)
+        for character in message:
+            if character == "\n":
+                line += 1
+                self.cursor_position(0, line)
+            else:
+                self._write(character)
+        self.column, self.row = 0, 0
+
+    def create_char(self, location, pattern):
+        location &= 0x7
+        self._command()
+        self.characters += 8
+        self.glyphs[location] = bytes(pattern)
+        self._address = None  # Characters now go to the custom character memory until the cursor is placed.
+
+    @property
+    def color(self):
+        return self._color
+
+    @color.setter
+    def color(self, color):
+        # The backlight's red, green and blue LEDs are 3 expander pins, the driver writes all of them every time.
+        self.backlight_changes += 3
+        self._color = list(color)
+
+    def _button(self, name):
+        self.button_reads += 1
+        return name in self.pressed
+
+    @property
+    def gpioa(self):
+        """
+        Port A of the shield's MCP23017: the buttons on pins 0 to 4 are pulled up and read 0 while pressed.
+        """
+        self.button_reads += 1
+        port = 0xFF
+        for pin, name in enumerate(self.BUTTONS):
+            if name in self.pressed:
+                port &= ~(1 << pin)
+        return port
+
+    @property
+    def left_button(self):
+        return self._button("left")
+
+    @property
+    def up_button(self):
+        return self._button("up")
+
+    @property
+    def down_button(self):
+        return self._button("down")
+
+    @property
+    def right_button(self):
+        return self._button("right")
+
+    @property
+    def select_button(self):
+        return self._button("select")
+
+
+character_lcd = SimpleNamespace(Character_LCD_RGB_I2C=CharacterLcd)
+
+
+class Radio:
+    """
+    Stand-in for wifi.radio.  connect() succeeds at once unless fail_connect is True.
+    """
+
+    def __init__(self):
+        self.fail_connect = False
+        self.connected = False
+        self.ipv4_address = None
+        self.connect_calls = 0
+
+    def connect(self, ssid, password=None, **kwargs):
+        self.connect_calls += 1
+        if self.fail_connect:
+            raise ConnectionError("Simulated Wi-Fi connection failure")
+        self.connected = True
+        self.ipv4_address = "127.0.0.1"
+
+
+wifi = SimpleNamespace(radio=Radio())
+
+
+class SocketPool:
+    """
+    Stand-in for socketpool.SocketPool using the host's sockets.
+    """
+    AF_INET = _socket.AF_INET
+    SOCK_STREAM = _socket.SOCK_STREAM
+    SOCK_DGRAM = _socket.SOCK_DGRAM
+    IPPROTO_TCP = _socket.IPPROTO_TCP
+    IPPROTO_UDP = _socket.IPPROTO_UDP
+    SOL_SOCKET = _socket.SOL_SOCKET
+    SO_REUSEADDR = _socket.SO_REUSEADDR
+
+    def __init__(self, radio):
+        self.radio = radio
+
+    def socket(self, family=_socket.AF_INET, type=_socket.SOCK_STREAM, proto=0):
+        return _socket.socket(family, type, proto)
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        if port == SNTP_PORT:
+            # The simulated network sends every time server lookup to the local stand-in.
+            sntp_server.lookups.append(host)
+            return [(_socket.AF_INET, _socket.SOCK_DGRAM, _socket.IPPROTO_UDP, "", sntp_server.start())]
+        return _socket.getaddrinfo(host, port, family, type, proto, flags)
+
+
+socketpool = SimpleNamespace(SocketPool=SocketPool)
+
+SNTP_PORT = 123
+# Seconds from 1900-01-01, where NTP time starts, to 1970-01-01.
+NTP_UNIX_DELTA = 2_208_988_800
+
+
+class SntpServer:
+    """
+    A local SNTP server on 127.0.0.1 answering from the HostClock's world time, in a background thread.
+
+    It is started by the first time server lookup.  The answer's UTC time is time_server.world_utc().  Settings for
+    testing SNTP clients:
+        offset (float): Seconds added to the time the server gives.
+        delay (float): Seconds the server waits before answering, on the host's real clock.
+        stratum (int): Stratum of the answers, 0 sends a "kiss-o'-death".
+        drop (int): Number of requests to ignore before answering again, to simulate lost packets.
+        version (int): NTP version of the answers.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.delay = 0
+        self.stratum = 2
+        self.drop = 0
+        self.version = 4
+        self.requests = 0
+        self.lookups = []  # Host names looked up, in order.
+        self.sock = None
+        self.address = None
+
+    def start(self):
+        """
+        Starts the server if it isn't running and returns its (ip, port) address.
+        """
+        if self.sock is None:
+            self.sock = _socket.socket(_socket.AF_INET, _socket.SOCK_DGRAM)
+            self.sock.bind(("127.0.0.1", 0))
+            self.address = self.sock.getsockname()
+            threading.Thread(target=self.serve, daemon=True).start()
+        return self.address
+
+    def utc_ntp(self):
+        """
+        Returns the world's UTC time as an NTP timestamp (seconds, fraction).
+        """
+        utc = time_server.world_utc() + self.offset + NTP_UNIX_DELTA
+        seconds = int(utc)
+        return seconds & 0xFFFFFFFF, int((utc - seconds) * (1 << 32))
+
+    def serve(self):
+        while True:
+            request, client = self.sock.recvfrom(512)
+            self.requests += 1
+            if self.drop:
+                self.drop -= 1
+                continue
+            received = self.utc_ntp()
+            if self.delay:
+                _time.sleep(self.delay)
+            answer = bytearray(48)
+            answer[0] = (self.version << 3) | 4  # Leap indicator 0, mode 4 (server)
+            answer[1] = self.stratum
+            answer[12:16] = b"RATE" if self.stratum == 0 else b"SIM\0"
+            answer[24:32] = request[40:48]  # Originate timestamp, the client's transmit timestamp
+            struct.pack_into(">IIII", answer, 32, *received, *self.utc_ntp())
+            self.sock.sendto(answer, client)
+
+
+sntp_server = SntpServer()
+
+
+class TimeServer:
+    """
+    The simulated worldtimeapi.org answering the Internet time lookup from the HostClock's world time.
+
+    World time is local time in zone, a TimeZone that defaults to America/Los_Angeles, and is converted to UTC with
+    its rules.
+    """
+
+    def __init__(self):
+        self.zone = get_zone("America/Los_Angeles")
+        self.requests = 0
+
+    def world_utc(self):
+        """
+        Returns the world's UTC time in seconds since the epoch.
+        """
+        world = time.world_time()
+        seconds = int(world)
+        return self.zone.to_utc(seconds) + (world - seconds)
+
+    def response(self):
+        self.requests += 1
+        utc = int(self.world_utc())
+        dst = self.zone.is_dst(utc)
+        return {
+            "unixtime": utc,
+            "raw_offset": self.zone.std_offset,
+            "dst_offset": self.zone.dst_offset - self.zone.std_offset if dst else 0,
+            "dst": dst,
+        }
+
+
+time_server = TimeServer()
+
+
+class Response:
+    def __init__(self, data, status_code=200):
+        self._data = data
+        self.status_code = status_code
+
+    def json(self):
+        return self._data
+
+    def close(self):
+        pass
+
+
+class Session:
+    """
+    Stand-in for adafruit_requests.Session that only knows worldtimeapi.org.
+    """
+
+    def __init__(self, socket_pool, ssl_context=None):
+        self.socket_pool = socket_pool
+        self.ssl_context = ssl_context
+
+    def get(self, url, **kwargs):
+        if "worldtimeapi.org" in url:
+            return Response(time_server.response())
+        raise OSError(f"Simulated network has no route to {url}")
+
+
+adafruit_requests = SimpleNamespace(Session=Session)
+
+# Light sleeps on the host wait on the same clock as everything else.
+alarm.clock = time
@@ -0,0 +1,27 @@
+"""
+Raspberry Pi Pico W backend for hal.py.
+
+Re-exports the CircuitPython modules main.py uses, unchanged.  asyncio is CircuitPython's asyncio library, installed
+in /lib together with adafruit_ticks.  character_lcd is the Adafruit RGB LCD shield driver, only needed by
+lcd_controller.py, and is None when adafruit_character_lcd is not installed in /lib.
+"""
+import time
+
+import adafruit_requests
+import alarm
+import asyncio
+import board
+import busio
+import digitalio
+import keypad
+import microcontroller
+import rtc
+import socketpool
+import ssl
+import supervisor
+import wifi
+
+try:
+    import adafruit_character_lcd.character_lcd_rgb_i2c as character_lcd
+except ImportError:
+    character_lcd = None
@@ -0,0 +1,525 @@
+"""
+Non-blocking HTTP server for the Garden Controller's remote API.
+
+The controller can't stop for a web client: a relay stop or a button press must not wait while a slow client sends
+its request.  HttpServer therefore never blocks.  Its listening socket and every client socket are non-blocking, and
+each call to poll() does a bounded amount of work: it accepts waiting connections, reads whatever has arrived and
+sends whatever the network will take, then returns.  The controller calls poll() from a task between its other work.
+
+Requests are handled when their headers are complete.  The handler returns a Response, or an upload object for a
+request with a body, which receives the body in chunks as they arrive (see FileUpload).  A Response body is an
+iterator of chunks, and each chunk is sent before the next is asked for, so a schedule file or a relay status list is
+streamed in small pieces rather than built in RAM.  Every connection is closed after its response
+("Connection: close"), which keeps the server simple and one request per connection is plenty for a garden.
+
+Conditional requests are supported with ETags: a client that sends If-None-Match with the ETag it already has gets a
+304 without a body, so polling for changes costs a few hundred bytes.  See etag_matches().
+
+The socket pool is passed in, so the server works with socketpool.SocketPool on the Pico and with the stand-in in
+hal_host.py, backed by the host's sockets, on a host computer.  The module has no other hardware dependencies.
+"""
+import errno
+import json
+import os
+
+from hal import time
+
+# Reason phrases of the status codes the server sends.
+REASONS = {
+    200: "OK",
+    204: "No Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    411: "Length Required",
+    412: "Precondition Failed",
+    413: "Content Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+# Errors a non-blocking socket raises when it has nothing to give or can't take more yet.
+WOULD_BLOCK = (errno.EAGAIN, errno.ETIMEDOUT)
+
+# Headers a handler may need.  Only these are kept from a request, so a client can't fill the heap with headers.
+KEPT_HEADERS = ("content-length", "if-none-match", "if-match", "content-type")
+
+# Connection states.
+READING_HEAD = 0
+READING_BODY = 1
+SENDING = 2
+
+
+def would_block(error):
+    """
+    Returns True if an OSError from a non-blocking socket only means "try again later".
+    """
+    return error.errno in WOULD_BLOCK
+
+
+def etag_matches(header, etag):
+    """
+    Returns True if an If-None-Match or If-Match header value names etag.
+
+    The header is "*" or a comma separated list of ETags.  ETags are compared the weak way, ignoring a "W/" prefix,
+    as RFC 9110 asks for If-None-Match.
+
+    :parameters:
+        header (str): The header value, None if the request had no such header.
+        etag (str): The current ETag of the resource, including its quotes.
+    """
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def file_chunks(filename, chunk_size=256):
+    """
+    Yields the contents of a file in chunks of up to chunk_size bytes, for streaming it as a Response body.
+
+    One buffer is refilled for every chunk, so each chunk is only valid until the next one is asked for.  HttpServer
+    sends a chunk completely before it asks for the next.
+    """
+    buffer = bytearray(chunk_size)
+    with open(filename, "rb") as file:
+        while True:
+            count = file.readinto(buffer)
+            if not count:
+                return
+            yield memoryview(buffer)[:count]
+
+
+class Request:
+    """
+    The request line and kept headers of an HTTP request.
+
+    Attributes:
+        method (str): For example "GET".
+        path (str): The path without the query string, for example "/schedule".
+        query (str): The query string after "?", empty if there was none.
+        headers (dict): Values of the KEPT_HEADERS the request sent, by lower case name.
+        content_length (int): Length of the request body, None if the request didn't say.
+    """
+
+    def __init__(self, method, target, headers):
+        self.method = method
+        self.path, _, self.query = target.partition("?")
+        self.headers = headers
+        length = headers.get("content-length")
+        self.content_length = int(length) if length is not None else None
+
+
+class Response:
+    """
+    An HTTP response: status, headers and a body streamed from an iterator of chunks.
+
+    :parameters:
+        status (int): Status code, one of REASONS.
+        body: Iterable of bytes-like chunks, a bytes object, a str or None for no body.
+        content_type (str): Content-Type of the body.
+        etag (str): ETag of the resource, including its quotes, None to send none.
+        length (int): Length of the body if known, sent as Content-Length.  Worked out for bytes and str bodies.
+        headers (list): More (name, value) header pairs.
+    """
+
+    def __init__(self, status, body=None, content_type="application/json", etag=None, length=None, headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        if isinstance(body, bytes):
+            length = len(body)
+            body = (body,)
+        self.status = status
+        self.body = body or ()
+        self.content_type = content_type
+        self.etag = etag
+        self.length = length
+        self.headers = headers or []
+
+    def head(self):
+        """
+        Returns the status line and headers as bytes, ending with the empty line.
+        """
+        lines = [f"HTTP/1.1 {self.status} {REASONS.get(self.status, '')}", "Connection: close"]
+        if self.status not in (204, 304):
+            lines.append(f"Content-Type: {self.content_type}")
+            if self.length is not None:
+                lines.append(f"Content-Length: {self.length}")
+        if self.etag is not None:
+            lines.append(f"ETag: {self.etag}")
+        for name, value in self.headers:
+            lines.append(f"{name}: {value}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+def error_response(status, message=None):
+    """
+    Returns a small JSON error response, {"error": message}.
+    """
+    return Response(status, json.dumps({"error": message or REASONS.get(status, "")}))
+
+
+class FileUpload:
+    """
+    Receives a request body into a file, writing each chunk as it arrives, and swaps it in once it is complete.
+
+    The body is written to filename + ".new".  When it is complete, check(temporary_filename) is called; it raises
+    ValueError (or another exception) if the contents are not acceptable, the answer is 400 and the old file is kept.
+    Otherwise done(temporary_filename) puts the new contents to use and returns the Response to send.  Only if that
+    Response is a success does the new file replace filename, so the old file stays whenever the answer is an error.
+    An incomplete upload is deleted.
+
+    :parameters:
+        filename (str): The file the upload replaces.
+        check (function): Called with the temporary filename to check the new contents.
+        done (function): Called with the temporary filename to use the new contents, returns the Response to send.
+    """
+
+    def __init__(self, filename, check, done):
+        self.filename = filename
+        self.temporary = filename + ".new"
+        self.check = check
+        self.done = done
+        self.file = open(self.temporary, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def finish(self):
+        """
+        Checks the complete upload, uses it and then replaces the file with it.  Returns the Response to send.
+        """
+        self.file.close()
+        try:
+            self.check(self.temporary)
+        except Exception as e:
+            self.remove()
+            return error_response(400, str(e))
+        response = self.done(self.temporary)
+        if response.status >= 300:
+            self.remove()
+            return response
+        try:
+            try:
+                os.rename(self.temporary, self.filename)
+            except OSError:
+                # FAT can't rename over an existing file.
+                os.remove(self.filename)
+                os.rename(self.temporary, self.filename)
+        except OSError as e:
+            self.remove()
+            return error_response(500, f"Could not replace {self.filename}: {e}")
+        return response
+
+    def abort(self):
+        """
+        Throws the incomplete upload away.
+        """
+        self.file.close()
+        self.remove()
+
+    def remove(self):
+        try:
+            os.remove(self.temporary)
+        except OSError:
+            pass
+
+
+class Connection:
+    """
+    One client connection and where its request and response have got to.
+    """
+
+    def __init__(self, sock, buffer, now):
+        self.sock = sock
+        self.buffer = buffer  # Holds the request head, then chunks of the body.
+        self.size = 0  # Bytes of the request head in buffer.
+        self.last_active = now
+        self.state = READING_HEAD
+        self.upload = None
+        self.body_left = 0
+        self.chunks = None  # Iterator of the response chunks still to send.
+        self.pending = None  # memoryview of the part of the current chunk not sent yet.
+
+
+class HttpServer:
+    """
+    A small non-blocking HTTP/1.1 server that is driven by calling poll().
+
+    :parameters:
+        socket_pool: socketpool.SocketPool, or the stand-in from hal_host.py.
+        handler (function): Called with each Request once its headers are in.  Returns a Response, or an upload
+            object with write(data), finish() returning a Response and abort(), such as a FileUpload, to receive
+            the body.
+        port (int): TCP port to listen on.
+        max_connections (int): Most clients served at once, more are left waiting in the listen backlog.
+        buffer_size (int): Size of each connection's buffer, the longest request head accepted.
+        max_body (int): Longest request body accepted.
+        timeout (float): Seconds a connection may sit idle before it is closed.
+
+    Attributes:
+        requests (int): Number of requests handled.
+        errors (int): Number of connections closed by an error or timeout.
+    """
+
+    def __init__(self, socket_pool, handler, port=80, max_connections=2, buffer_size=512, max_body=8192, timeout=10):
+        self.socket_pool = socket_pool
+        self.handler = handler
+        self.port = port
+        self.max_body = max_body
+        self.timeout = timeout
+        self.listener = None
+        self.connections = []
+        # Buffers allocated once and handed to connections as they open.
+        self.free_buffers = [bytearray(buffer_size) for _ in range(max_connections)]
+        self.requests = 0
+        self.errors = 0
+
+    def start(self, host):
+        """
+        Starts listening on host, the address of the Wi-Fi interface.
+        """
+        pool = self.socket_pool
+        listener = pool.socket(pool.AF_INET, pool.SOCK_STREAM)
+        try:
+            listener.setsockopt(pool.SOL_SOCKET, pool.SO_REUSEADDR, 1)
+        except (AttributeError, OSError):
+            pass  # Not every CircuitPython version has socket options
+        listener.bind((host, self.port))
+        listener.listen(len(self.free_buffers))
+        listener.setblocking(False)
+        self.listener = listener
+
+    def stop(self):
+        """
+        Closes every connection and the listening socket.
+        """
+        for connection in list(self.connections):
+            self.close(connection)
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    def busy(self):
+        """
+        Returns True while a client is connected, so the caller should poll again soon.
+        """
+        return bool(self.connections)
+
+    def poll(self):
+        """
+        Accepts new clients and moves every connection along as far as it can go without waiting.
+        """
+        if self.listener is None:
+            return
+        now = time.monotonic()
+        while self.free_buffers:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError as e:
+                if would_block(e):
+                    break
+                raise
+            sock.setblocking(False)
+            self.connections.append(Connection(sock, self.free_buffers.pop(), now))
+
+        for connection in list(self.connections):
+            try:
+                if self.serve(connection, now):
+                    connection.last_active = now
+                elif now - connection.last_active > self.timeout:
+                    if connection.state == SENDING:
+                        self.errors += 1
+                        self.close(connection)  # The client stopped reading
+                    else:
+                        self.fail(connection, 408)
+            except Exception as e:
+                print(f"HTTP connection error: {e}")
+                self.errors += 1
+                self.close(connection)
+
+    def serve(self, connection, now):
+        """
+        Reads or sends what it can for one connection.  Returns True if anything moved.
+        """
+        if connection.state == READING_HEAD:
+            return self.read_head(connection)
+        if connection.state == READING_BODY:
+            return self.read_body(connection)
+        return self.send(connection)
+
+    def receive(self, connection, view):
+        """
+        Reads into view.  Returns the number of bytes read, 0 if none have arrived, or None if the client closed.
+        """
+        try:
+            count = connection.sock.recv_into(view)
+        except OSError as e:
+            if would_block(e):
+                return 0
+            raise
+        return count or None
+
+    def read_head(self, connection):
+        buffer = connection.buffer
+        if connection.size == len(buffer):
+            self.fail(connection, 431)
+            return True
+        count = self.receive(connection, memoryview(buffer)[connection.size:])
+        if count is None:
+            self.close(connection)
+            return True
+        if not count:
+            return False
+        start = max(connection.size - 3, 0)
+        connection.size += count
+        end = buffer[start:connection.size].find(b"\r\n\r\n")
+        if end < 0:
+            return True
+        end += start
+        try:
+            request = self.parse(bytes(buffer[:end]).decode())
+        except (ValueError, UnicodeError):
+            self.fail(connection, 400)
+            return True
+        self.requests += 1
+        try:
+            result = self.handler(request)
+        except Exception as e:
+            print(f"HTTP handler error: {e}")
+            self.fail(connection, 500)
+            return True
+        if isinstance(result, Response):
+            self.respond(connection, result)
+            return True
+        # The handler wants the body.
+        if request.content_length is None:
+            result.abort()
+            self.fail(connection, 411)
+            return True
+        if request.content_length > self.max_body:
+            result.abort()
+            self.fail(connection, 413)
+            return True
+        connection.upload = result
+        connection.body_left = request.content_length
+        connection.state = READING_BODY
+        # Part of the body may have come in with the head.
+        extra = memoryview(buffer)[end + 4:connection.size]
+        if len(extra) > connection.body_left:
+            extra = extra[:connection.body_left]
+        if len(extra):
+            result.write(extra)
+            connection.body_left -= len(extra)
+        self.finish_body(connection)
+        return True
+
+    def read_body(self, connection):
+        buffer = connection.buffer
+        view = memoryview(buffer)
+        if connection.body_left < len(buffer):
+            view = view[:connection.body_left]
+        count = self.receive(connection, view)
+        if count is None:
+            connection.upload.abort()
+            connection.upload = None
+            self.close(connection)
+            return True
+        if not count:
+            return False
+        connection.upload.write(view[:count])
+        connection.body_left -= count
+        self.finish_body(connection)
+        return True
+
+    def finish_body(self, connection):
+        if connection.body_left == 0:
+            upload, connection.upload = connection.upload, None
+            self.respond(connection, upload.finish())
+
+    def parse(self, head):
+        """
+        Parses the request line and headers.  Raises ValueError if they are malformed.
+        """
+        lines = head.split("\r\n")
+        method, target, version = lines[0].split(" ")
+        if not version.startswith("HTTP/"):
+            raise ValueError("Not an HTTP request")
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(":")
+            if not separator:
+                raise ValueError("Malformed header")
+            name = name.strip().lower()
+            if name in KEPT_HEADERS:
+                headers[name] = value.strip()
+        request = Request(method, target, headers)
+        if request.content_length is not None and request.content_length < 0:
+            raise ValueError("Negative Content-Length")
+        return request
+
+    def respond(self, connection, response):
+        """
+        Starts sending a response.
+        """
+        connection.state = SENDING
+        connection.pending = memoryview(response.head())
+        connection.chunks = iter(response.body)
+
+    def send(self, connection):
+        moved = False
+        while True:
+            if connection.pending is None or not len(connection.pending):
+                try:
+                    chunk = next(connection.chunks)
+                except StopIteration:
+                    self.close(connection)
+                    return True
+                connection.pending = memoryview(chunk)
+                continue
+            try:
+                sent = connection.sock.send(connection.pending)
+            except OSError as e:
+                if would_block(e):
+                    return moved
+                raise
+            if not sent:
+                return moved
+            connection.pending = connection.pending[sent:]
+            moved = True
+
+    def fail(self, connection, status):
+        """
+        Answers with an error status, dropping anything the client still has to send.
+        """
+        self.errors += 1
+        if connection.upload is not None:
+            connection.upload.abort()
+            connection.upload = None
+        self.respond(connection, error_response(status))
+
+    def close(self, connection):
+        """
+        Closes a connection and gives its buffer back.
+        """
+        try:
+            connection.sock.close()
+        except OSError:
+            pass
+        if connection in self.connections:
+            self.connections.remove(connection)
+            self.free_buffers.append(connection.buffer)
+        if connection.chunks is not None and hasattr(connection.chunks, "close"):
+            connection.chunks.close()  # Closes a file a generator was reading
@@ -0,0 +1,152 @@
+"""
+Host-side benchmark comparing the dirty-region LCD renderer with clearing the display and writing every line.
+
+The original SchedMenu.update_schedule_display() cleared the LCD and wrote every line again on each button event.
+lcd_controller.py now draws the menu through LcdRenderer (see lcd_renderer.py), which sends only the characters that
+changed.  This script replays the same menu edits both ways on hal_host's CharacterLcd, which counts the bytes sent to
+the display and the I2C transactions and time the Adafruit driver would spend on them.
+
+It also polls the shield's buttons while the right arrow is held, reading each button's property as the menu used to
+against one ButtonScanner read of the port expander per scan (see buttons.py).
+
+Run it on a host computer (not the Pico):
+    python lcd_benchmark.py
+"""
+import os
+
+os.environ["GARDEN_HAL"] = "host"
+
+from lcd_controller import LcdController, SchedMenu
+
+# Number of times to replay the menu edits.
+repeat = 5
+
+# Seconds between button scans, and seconds the right arrow is held.
+scan_interval = 0.02
+hold_time = 2.0
+
+
+def clear_and_write(menu):
+    """
+    Copy of the original SchedMenu.update_schedule_display(), which cleared the display and wrote every line.
+    """
+    lcd = menu.lcd.lcd
+    lcd.clear()
+    days_str = "\t".join(menu.day_abbreviations)
+    start_hour, start_minute = divmod(menu.start_time, 60)
+    duration_str = f"{menu.duration}"
+    lcd.message = "HH\tMM\t DD\n"
+    lcd.message = days_str + "\n"
+    if menu.current_selection == 1:
+        lcd.message = f"{start_hour}^\t{start_minute}\t{duration_str}"
+    elif menu.current_selection == 2:
+        lcd.message = f"{start_hour}\t{start_minute}^\t{duration_str}"
+    else:
+        lcd.message = f"{start_hour}\t{start_minute}\t{duration_str}"
+    lcd.message = "\t" * (4 - menu.lcd.current_day)
+
+
+def render(menu):
+    """
+    Draws the menu through the renderer, as lcd_controller.py does.
+    """
+    menu.update_schedule_display()
+
+
+def menu_edits():
+    """
+    Returns a list of functions, each making one edit to a SchedMenu as a button press would.
+    """
+    def select(selection):
+        def edit(menu):
+            menu.current_selection = selection
+        return edit
+
+    def toggle_day(day):
+        def edit(menu):
+            menu.lcd.current_day = day
+            menu.days_to_water[day] = not menu.days_to_water[day]
+        return edit
+
+    def next_minute(menu):
+        menu.start_time = (menu.start_time + 5) % (24 * 60)
+
+    def next_hour(menu):
+        menu.start_time = (menu.start_time + 60) % (24 * 60)
+
+    def next_duration(menu):
+        menu.duration = (menu.duration % 9) + 1
+
+    def nothing(menu):
+        pass  # A redraw with nothing changed, such as a button release
+
+    edits = [select(0)]
+    edits += [toggle_day(day) for day in (0, 2, 4, 6)]
+    edits += [select(1)] + [next_hour] * 6
+    edits += [select(2)] + [next_minute] * 9
+    edits += [select(3)] + [next_duration] * 4
+    edits += [nothing] * 5
+    return edits
+
+
+def replay(draw):
+    """
+    Replays the menu edits, drawing after each, and returns the display's counters per update and the final text.
+    """
+    controller = LcdController()
+    menu = SchedMenu(controller)
+    lcd = controller.lcd
+    draw(menu)  # First full draw, not counted
+    lcd.reset_counts()
+    edits = menu_edits()
+    for _ in range(repeat):
+        for edit in edits:
+            edit(menu)
+            draw(menu)
+    updates = repeat * len(edits)
+    controller.i2c.deinit()  # Free the pins for the next replay
+    return (lcd.bytes_sent / updates, lcd.transactions / updates, lcd.seconds / updates * 1000, lcd.clears,
+            lcd.text)
+
+
+def button_polling():
+    """
+    Holds the right arrow for hold_time seconds, polling every scan_interval, and returns the I2C reads per poll
+    reading each button's property, the I2C reads per scan with the ButtonScanner and the events the scanner gave.
+    """
+    controller = LcdController()
+    lcd = controller.lcd
+    polls = int(hold_time / scan_interval)
+    lcd.pressed.add("right")
+    for _ in range(polls):
+        for name in lcd.BUTTONS:
+            getattr(lcd, f"{name}_button")
+    property_reads = lcd.button_reads / polls
+
+    lcd.reset_counts()
+    events = 0
+    for poll in range(polls):
+        if controller.buttons.scan(poll * scan_interval):
+            events += 1
+    controller.i2c.deinit()
+    return property_reads, lcd.button_reads / polls, events
+
+
+def main():
+    print(f"{'Method':<20}{'Bytes/update':>14}{'I2C/update':>12}{'ms/update':>11}{'Clears':>8}")
+    results = []
+    for name, draw in (("Clear and write", clear_and_write), ("Dirty regions", render)):
+        bytes_sent, transactions, milliseconds, clears, text = replay(draw)
+        results.append(transactions)
+        print(f"{name:<20}{bytes_sent:>14.1f}{transactions:>12.0f}{milliseconds:>11.1f}{clears:>8}")
+        for line in text:
+            print(f"  |{line.replace(chr(0), 'v')}|")
+    print(f"\n{results[0] / results[1]:.1f}x fewer I2C transactions")
+
+    property_reads, scan_reads, events = button_polling()
+    print(f"\nButtons, right arrow held {hold_time:g} s: {property_reads:g} I2C reads per poll reading each button, "
+          f"{scan_reads:g} per scan, {events} events with auto-repeat")
+
+
+if __name__ == "__main__":
+    main()
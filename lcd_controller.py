@@ -1,6 +1,13 @@
-import time
-import board, busio
-import adafruit_character_lcd.character_lcd_rgb_i2c as character_lcd
+from buttons import ButtonScanner, SHIELD_LEFT, SHIELD_RIGHT, SHIELD_SELECT
+from hal import board, busio, character_lcd, time
+from lcd_renderer import LcdRenderer
+
+# Seconds an arrow button is held before it starts repeating, and seconds between repeats.
+button_repeat_delay = 0.5
+button_repeat_interval = 0.15
+
+# Names of the days of the week, Monday first, shown while the watering days are being edited.
+DAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
 
 # create I2C connection
 # i2c = busio.I2C(board.GP27, board.GP26)  # # Pi Pico RP2040
@@ -17,14 +24,22 @@ class LcdController:
         Initializes the LCD controller.
 
         This constructor initializes the I2C bus and connects to the LCD display.
-        It also sets up the backlight control pin and turns on the backlight by default.
+        Everything shown on the display goes through self.renderer (see lcd_renderer.py), which only sends the
+        characters that changed.
         """
-        i2c = busio.I2C(board.GP27, board.GP26)  # Initialize the I2C bus for Pico
-        self.lcd = character_lcd.Character_LCD_RGB_I2C(i2c, 16, 2)  # Initialize the LCD display
+        self.i2c = busio.I2C(board.GP27, board.GP26)  # Initialize the I2C bus for Pico
+        self.lcd = character_lcd.Character_LCD_RGB_I2C(self.i2c, 16, 2)  # Initialize the LCD display
+        self.renderer = LcdRenderer(self.lcd, 16, 2)
+
+        # The buttons are read in one I2C read of the port expander's port A per scan (see ButtonScanner in
+        # buttons.py).  The driver keeps no reference to the expander itself, but each of its pins does.
+        self.expander = self.lcd._select_button._mcp
+        self.buttons = ButtonScanner(self.read_button_port, repeat_delay=button_repeat_delay,
+                                     repeat_interval=button_repeat_interval)
 
         # Initialize the backlight control pin
         # self.current_menu = SchedMenu(self)
-        # self.current_day = 0  # Initialize with Monday
+        self.current_day = 0  # Initialize with Monday
 
     def set_backlight_color(self, color):
         # Define LCD colors using RGB values
@@ -49,7 +64,7 @@ class LcdController:
         else:
             raise ValueError("Invalid color specified")
 
-        self.lcd.color = (r, g, b)
+        self.renderer.set_color((r, g, b))
 
     def set_backlight(self, value):
         """
@@ -59,21 +74,35 @@ class LcdController:
             value (bool): True to turn on the backlight, False to turn it off.
         """
         if value:
-            self.lcd.color = (0, 100, 0)
+            self.renderer.set_color((0, 100, 0))
         else:
-            self.lcd.color = (0, 0, 0)
+            self.renderer.set_color((0, 0, 0))
+
+    def read_button_port(self):
+        """
+        Reads the port expander's port A, which holds the buttons, in one I2C transaction.
+        """
+        return self.expander.gpioa
 
-    def handle_buttons(self):
+    def handle_buttons(self, now=None):
         """
         Handles button presses on the LCD display.
 
-        This method checks if the select button on the LCD is pressed and prints a message.
+        This method scans the buttons and prints a message when the select button is pressed.
+
+        Parameters:
+            now (float): The current time.monotonic() value, read here if not given.
+
+        Returns:
+            events (int): Mask of the buttons pressed or repeating, bit SHIELD_SELECT and so on (see buttons.py).
 
         Example usage:
             lcd.set_backlight_color('red')  # Set the backlight color to red
         """
-        if self.lcd.select_button:
+        events = self.buttons.scan(time.monotonic() if now is None else now)
+        if events & (1 << SHIELD_SELECT):
             print("Select button pressed")
+        return events
 
 
 class SchedMenu:
@@ -87,13 +116,17 @@ class SchedMenu:
         self.start_time = 0  # Default start time
         self.duration = 1  # Default duration
 
-    def handle_buttons(self):
-        # Handle button presses to navigate and update selections
-        if self.lcd.left_button:
+    def handle_buttons(self, now=None):
+        # Handle button presses to navigate and update selections.  One scan reads every button, and a held arrow
+        # repeats.
+        events = self.lcd.buttons.scan(time.monotonic() if now is None else now)
+        if not events:
+            return
+        if events & (1 << SHIELD_LEFT):
             self.current_selection = (self.current_selection - 1) % 4
-        elif self.lcd.right_button:
+        elif events & (1 << SHIELD_RIGHT):
             self.current_selection = (self.current_selection + 1) % 4
-        elif self.lcd.select_button:
+        elif events & (1 << SHIELD_SELECT):
             if self.current_selection == 0:  # Days selection
                 self.days_to_water[self.lcd.current_day] = not self.days_to_water[self.lcd.current_day]
             elif self.current_selection == 1:  # HH selection
@@ -106,36 +139,29 @@ class SchedMenu:
         self.update_schedule_display()  # Update the LCD display based on selections
 
     def update_schedule_display(self):
-        # Clear the LCD display
-        self.lcd.clear()
+        """
+        Shows the schedule being edited, sending only the characters that changed since the last update.
 
-        # Join the day abbreviations to create the top row of days
-        days_str = "\t".join(self.day_abbreviations)
+        The top line is the days of the week, the start time and the duration, "MTWTFSS 18:45  8".  Below each day is
+        a check mark if it is a watering day, and below the start time and duration "^^" marks the selected one.
+        While the days are selected the day being edited is named instead.
+        """
+        check = self.lcd.renderer.glyph(self.check_mark)  # Uploaded to the LCD the first time only
 
         # Convert start time to hours and minutes
         start_hour, start_minute = divmod(self.start_time, 60)
 
-        # Prepare the duration as a string
-        duration_str = f"{self.duration}"
-
-        # Display the days of the week, and HH MM DD
-        self.lcd.message("HH\tMM\t DD\n")
-        self.lcd.message(days_str + "\n")
+        # Days of the week, and HH:MM DD
+        top = f"{''.join(self.day_abbreviations)} {start_hour:02d}:{start_minute:02d} {self.duration:2d}"
 
-        # Determine whether to display a check mark or space for the current day
-        day_marker = self.check_mark if self.days_to_water[self.lcd.current_day] else " "
-
-        # Display start time, minutes, and duration based on current selection
-        if self.current_selection == 1:
-            self.lcd.message(f"{start_hour}^\t{start_minute}\t{duration_str}")
-        elif self.current_selection == 2:
-            self.lcd.message(f"{start_hour}\t{start_minute}^\t{duration_str}")
+        # A check mark or space below each day, then the selection marker
+        marks = "".join(check if water else " " for water in self.days_to_water)
+        if self.current_selection == 0:
+            selected = f"<{DAY_NAMES[self.lcd.current_day]}"
         else:
-            self.lcd.message(f"{start_hour}\t{start_minute}\t{duration_str}")
-
-        self.lcd.message("\t" * (4 - self.lcd.current_day))  # Adjust to the right based on day position
-
+            selected = " " * (3 * self.current_selection - 3) + "^^"
 
+        self.lcd.renderer.render([top, f"{marks} {selected}"])
 
 
 # Create an instance of the LcdController class
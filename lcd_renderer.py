@@ -0,0 +1,141 @@
+"""
+Dirty-region renderer for the 16x2 character LCD.
+
+The LCD shield is an HD44780 display driven through an MCP23017 port expander on I2C.  Every character or command
+byte sent to it is 30 I2C transactions and a 1 ms pause in the Adafruit driver, and clear() blanks the whole display
+before anything is written again, so redrawing a screen by clearing it and writing every line is slow and flickers.
+
+LcdRenderer keeps a shadow copy of the characters on the display.  render() is given the whole screen, one string
+per line, and compares it with the shadow: only the runs of characters that changed are sent, each after a cursor
+move, and the display is never cleared.  Unchanged characters between two changed runs are sent again when that is
+cheaper than moving the cursor.  A screen that did not change sends nothing.
+
+Custom characters, such as a check mark, are uploaded to one of the display's 8 custom character slots the first
+time glyph() is asked for their pattern, and glyph() returns the character to put in a line to show them.  The
+backlight colour is only written when it changes.
+
+The LCD is passed in, an adafruit_character_lcd display or hal_host's CharacterLcd.
+"""
+
+# Number of custom character slots of the HD44780.
+GLYPH_SLOTS = 8
+
+# Bytes sent for a cursor move before a run of characters.  The Adafruit driver's message setter places the cursor
+# again itself, so a run costs its characters plus two command bytes.
+RUN_OVERHEAD = 2
+
+
+class LcdRenderer:
+    """
+    Draws whole screens on a character LCD by sending only the characters that changed.
+
+    Attributes:
+        lcd: The LCD driver.
+        frame (list): The characters on the display, one string per line, None for a line whose contents are unknown.
+        runs (int): Number of runs of characters sent.
+        characters (int): Number of characters sent.
+
+    :parameters:
+        lcd: The LCD driver, with clear(), cursor_position(), message, create_char() and color.
+        columns (int): Characters per line.
+        lines (int): Number of lines.
+    """
+
+    def __init__(self, lcd, columns=16, lines=2):
+        self.lcd = lcd
+        self.columns = columns
+        self.lines = lines
+        self.glyphs = {}  # Pattern bytes to the character showing it.
+        self.color = None
+        self.runs = 0
+        self.characters = 0
+        # Start from a known, blank display.
+        lcd.clear()
+        self.frame = [" " * columns for _ in range(lines)]
+
+    def invalidate(self):
+        """
+        Forgets what is on the display, so the next render() sends every line in full.
+
+        Use after something else has written to the display or it was reset.
+        """
+        self.frame = [None] * self.lines
+
+    def glyph(self, pattern):
+        """
+        Returns the character showing a custom character, uploading its pattern the first time it is asked for.
+
+        :parameters:
+            pattern (bytearray): 8 rows of 5 pixels, the low 5 bits of each byte.
+
+        :returns:
+            character (str): The character to put in a line passed to render().
+        """
+        key = bytes(pattern)
+        character = self.glyphs.get(key)
+        if character is None:
+            slot = len(self.glyphs)
+            if slot >= GLYPH_SLOTS:
+                raise ValueError(f"The LCD holds at most {GLYPH_SLOTS} custom characters")
+            self.lcd.create_char(slot, pattern)
+            character = chr(slot)
+            self.glyphs[key] = character
+        return character
+
+    def set_color(self, color):
+        """
+        Sets the backlight colour, (red, green, blue), if it is not already set to it.
+        """
+        color = tuple(color)
+        if color != self.color:
+            self.lcd.color = color
+            self.color = color
+
+    def render(self, lines):
+        """
+        Shows a screen, sending only the characters that differ from the display.
+
+        :parameters:
+            lines (list): The text of each line.  Shorter lines are padded with spaces and longer ones cut off, and
+                missing lines are blank.
+
+        :returns:
+            sent (int): Number of characters sent.
+        """
+        sent = 0
+        for row in range(self.lines):
+            text = lines[row] if row < len(lines) else ""
+            text = text[:self.columns]
+            if len(text) < self.columns:
+                text += " " * (self.columns - len(text))
+            for start, end in self.changed_runs(self.frame[row], text):
+                self.lcd.cursor_position(start, row)
+                self.lcd.message = text[start:end]
+                self.runs += 1
+                sent += end - start
+            self.frame[row] = text
+        self.characters += sent
+        return sent
+
+    def changed_runs(self, old, new):
+        """
+        Returns the (start, end) column ranges to send to turn line old into line new.
+
+        Runs separated by no more unchanged characters than a cursor move costs are joined into one.
+        """
+        if old is None:
+            return [(0, len(new))]
+        runs = []
+        start = end = None
+        for column in range(len(new)):
+            if new[column] == old[column]:
+                continue
+            if start is not None and column - end <= RUN_OVERHEAD:
+                end = column + 1
+            else:
+                if start is not None:
+                    runs.append((start, end))
+                start, end = column, column + 1
+        if start is not None:
+            runs.append((start, end))
+        return runs
@@ -0,0 +1,73 @@
+"""
+Host-side reader and decoder for the Garden Controller's log files.
+
+The controller can store its event log in formats that are not plain, in order text (see event_log.py):
+- log.dat, the circular log written when log_storage is "circular".  It is overwritten in place, so the newest
+  entries are not at the end of the file.  It holds either text lines or binary records.
+- log.bin, the binary log appended to when log_storage is "text" and log_format is "binary".
+
+Copy the log file off the Pico and run this script on a host computer to print its entries in chronological order as
+text, or as CSV with one column per record field:
+    python log_reader.py log.dat
+    python log_reader.py --csv log.bin > log.csv
+"""
+import argparse
+import csv
+import sys
+
+from event_log import (CIRCULAR_LOG_MAGIC, EVENT_CPU_TEMP, EVENT_NAMES, LOG_FORMAT_BINARY, NO_RELAY,
+                       format_message, format_record, format_timestamp, read_binary_log, read_circular_log)
+
+
+def read_log(filename):
+    """
+    Reads a circular or binary log file.
+
+    :returns:
+        record_format (str): LOG_FORMAT_TEXT if entries are text lines, LOG_FORMAT_BINARY if they are records.
+        entries (list): Entries in chronological order.
+    """
+    with open(filename, "rb") as log_file:
+        magic = log_file.read(len(CIRCULAR_LOG_MAGIC))
+    if magic == CIRCULAR_LOG_MAGIC:
+        return read_circular_log(filename)
+    return LOG_FORMAT_BINARY, read_binary_log(filename)
+
+
+def write_csv(records, output):
+    """
+    Writes binary log records as CSV: timestamp, epoch, event, relay, value and message.
+    """
+    writer = csv.writer(output)
+    writer.writerow(["timestamp", "epoch", "event", "relay", "value", "message"])
+    for record in records:
+        epoch_time, code, relay, value, message = record
+        writer.writerow([
+            format_timestamp(epoch_time), epoch_time, EVENT_NAMES.get(code, code),
+            "" if relay == NO_RELAY else relay,
+            value / 100 if code == EVENT_CPU_TEMP else value,
+            format_message(code, relay, value, message),
+        ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print a Garden Controller log file in chronological order.")
+    parser.add_argument("filename", nargs="?", default="log.dat", help="log.dat or log.bin copied from the Pico")
+    parser.add_argument("--csv", action="store_true", help="write binary records as CSV instead of text")
+    args = parser.parse_args(argv)
+
+    record_format, entries = read_log(args.filename)
+    if record_format != LOG_FORMAT_BINARY:
+        if args.csv:
+            parser.error("CSV output needs a binary log, this log holds text lines")
+        for line in entries:
+            print(line)
+    elif args.csv:
+        write_csv(entries, sys.stdout)
+    else:
+        for record in entries:
+            print(format_record(record))
+
+
+if __name__ == "__main__":
+    main()
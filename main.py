@@ -31,10 +31,31 @@ requires the ability to write to the filesystem for event logging and modifying
 file must be installed and placed at the root level of the CIRCUITPY filesystem. For more information,
 please refer to the "Note" section in the boot.py file.
 """
-import os, ssl, wifi, socketpool, adafruit_requests
-from digitalio import DigitalInOut, Direction, Pull
-import board, time, rtc, microcontroller
+import os
 import json
+import binascii
+# The CircuitPython hardware modules come from the hardware abstraction layer (see hal.py).  On the Pico these are the
+# real modules, on a host computer they are simulated so this program can run and be profiled off the device.
+from hal import board, digitalio, keypad, rtc, microcontroller, wifi, socketpool, ssl, adafruit_requests, time
+from hal import supervisor, asyncio
+from time_sync import SntpClient, ClockDiscipline, NS_PER_SECOND
+from time_zone import get_zone
+DigitalInOut, Direction, Pull = digitalio.DigitalInOut, digitalio.Direction, digitalio.Pull
+from water_schedule import ScheduleFile, load_schedule, file_signature, file_crc
+from scheduler import DeadlineQueue, EVENT_START, EVENT_STOP, EVENT_LOG, EVENT_RELOAD, EVENT_FLUSH, EVENT_DEBOUNCE
+from scheduler import EVENT_ZONE, EVENT_SYNC, EVENT_STEP, EVENT_API
+from http_api import HttpServer, Response, FileUpload, error_response, etag_matches, file_chunks
+from buttons import Debouncer, RateLimiter, event_time
+from relay_output import RelayOutputs
+from relay_state import RelayState, iter_bits
+from power import PowerManager, POWER_DEEP
+from sequencer import ZoneSequencer
+from event_log import LogBuffer, TextLogFile, BinaryLogFile, CircularLogFile, format_message
+from event_log import EVENT_TEXT, EVENT_MANUAL_ON, EVENT_MANUAL_OFF, EVENT_SCHEDULE_ON, EVENT_SCHEDULE_OFF
+from event_log import EVENT_CPU_TEMP, EVENT_LOOP_PHASE, NO_RELAY as LOG_NO_RELAY
+from event_log import EVENT_TIME_SYNC, EVENT_TIME_SYNC_FAILED, EVENT_CLOCK_DRIFT, EVENT_QUEUE_DELAY
+from profiler import LoopProfiler, PHASE_BUTTONS, PHASE_SCHEDULE_LOAD, PHASE_SCHEDULE, PHASE_CPU_LOG, PHASE_UPTIME
+from profiler import PHASE_SLEEP
 
 # Setting debug too True will print out messages to REPL.  Set it too False to keep the processor load down.
 debug = False
@@ -54,10 +75,123 @@ enable_logging = True
 # If logging is enabled, log_interval specifies how many minutes must pass before updating the log file.
 log_interval = 30
 
+# Log entries are kept in a small buffer in RAM and written to log.txt in blocks (see event_log.py).
+# log_buffer_size is the most entries held in RAM, the oldest are dropped if they can't be written.
+# log_flush_threshold is how many buffered entries trigger a write.
+# log_flush_interval is the longest time, in seconds, an entry waits in RAM before it is written.
+# The buffer is also written before a deep sleep, when the schedule is paused and when the program stops.
+log_buffer_size = 32
+log_flush_threshold = 8
+log_flush_interval = 120
+
+# Where log entries are stored.
+# "text" appends lines to log.txt, which keeps growing for as long as logging is enabled.
+# "circular" writes them to a fixed size file, log.dat, that is created once and then overwritten in place, oldest
+# entries first.  It never grows and every write costs the same.  Use log_reader.py on a host computer to read it.
+# log_circular_entries is the number of entries log.dat holds, each takes log_circular_entry_size bytes.
+log_storage = "text"
+circular_log_filename = "log.dat"
+log_circular_entries = 1024
+log_circular_entry_size = 64
+
+# How log entries are written.
+# "text" writes "YYYY-MM-DD HH:MM:SS: message" lines of about 60 bytes each.
+# "binary" writes fixed 8 byte records (time, event, relay and value) that cost far less flash space and formatting
+# time.  With log_storage = "text" they are appended to log.bin instead of log.txt, with "circular" they go to log.dat.
+# Use log_reader.py on a host computer to turn them into text or CSV.
+log_format = "text"
+binary_log_filename = "log.bin"
+
+# The controller runs as cooperative asyncio tasks (see run_tasks()): the buttons, the watering schedule, the log, the
+# clock and the LED.  Each task waits with asyncio until the next thing it has to do, or at most its own wakeup
+# period, and never with a blocking sleep, so a Wi-Fi retry or a flashing LED can't hold up a relay stop.
+# The schedule task waits until the next scheduled start, relay stop or schedule file check, and wakes straight away
+# when the pause schedule button changes.
+# max_sleep is the longest time, in seconds, the schedule task waits without running even if nothing is due.
+max_sleep = 60
+# schedule_check_interval is how often, in seconds, Water_Schedule.json is checked for changes.
+schedule_check_interval = 60
+# input_check_interval is the buttons task's wakeup period, how often, in seconds, the button events are read.
+# Presses are queued in the background, so a longer interval only delays them, it can't miss them.
+input_check_interval = 0.1
+# log_check_interval is the log task's wakeup period.  It also wakes when a CPU temperature entry or a log flush is due.
+log_check_interval = 60
+# clock_check_interval is the clock task's wakeup period.  It also wakes when a time sync or an RTC step is due.
+clock_check_interval = 60
+# Connecting to Wi-Fi and asking the time servers still block the Pico while they run, so the clock task holds them
+# back while a relay is due to stop within network_stop_margin seconds.
+network_stop_margin = 30
+
+# Low power sleep between watering events (see power.py).  When no relay is on and no manual button is held, the
+# Pico sleeps until the next deadline and is woken early by the manual buttons or the pause schedule button.
+# "none" keeps polling the buttons as described above, "light" uses light sleep, and "deep" uses deep sleep for any
+# wait of at least deep_sleep_min seconds (the Pico restarts main.py when it wakes from deep sleep).
+# NOTE: While the pause schedule button is latched on it can't wake the Pico, releasing it is noticed at the next
+# timed wake, which is at most max_sleep seconds away in "light" mode.
+power_mode = "light"
+deep_sleep_min = 300
+
+# Per-phase timing of the main loop (see profiler.py).  Each pass of a task records how long the buttons, schedule file
+# check, schedule evaluation, CPU temperature log, uptime print and wait took, in histograms and maximums that can be
+# read from the REPL with loop_profiler.print_report().  The report is also printed when the loop stops.
+# profile_log_interval is how often, in seconds, the longest time of each phase is written to the log, 0 never logs it.
+profile_loop = True
+profile_log_interval = 0
+
+# The buttons are scanned in the background by CircuitPython's keypad module every button_scan_interval seconds,
+# which queues every press and release with its time.  The buttons task reads the queue, so presses are not missed
+# however long the Pico sleeps.  The queue holds button_event_queue_size events.
+button_scan_interval = 0.02
+button_event_queue_size = 64
+
+# The manual buttons are debounced without sleeping (see buttons.py).  A button must read pressed for
+# button_press_time seconds before its relay turns on, and read released for button_release_time seconds before
+# it turns off.  A chattering contact can log at most button_log_limit relay events every button_log_window seconds,
+# the entries over the limit are counted and noted in the log once the button settles down.
+button_press_time = 0.05
+button_release_time = 0.05
+button_log_limit = 6
+button_log_window = 60
+
+# The RTC is set from the Internet at start up (see time_sync.py).  The UTC time comes from the SNTP servers in
+# ntp_servers, tried in order, over UDP, which needs no TLS handshake.  ntp_timeout is how long, in seconds, to wait
+# for each server's answer.  If no SNTP server answers, the UTC time is looked up from worldtimeapi.org over HTTPS.
+ntp_servers = ["pool.ntp.org", "time.google.com"]
+ntp_timeout = 2
+
+# The clock is synced again while the program runs (see ClockDiscipline in time_sync.py).  Between syncs the crystal's
+# measured drift is corrected by stepping the RTC a second at a time, so it stays within half a second of UTC.  The
+# time between syncs starts at time_sync_min_interval seconds and doubles, up to time_sync_max_interval, while each
+# sync finds the clock within a quarter of time_sync_accuracy seconds, so a good crystal needs the radio only every
+# few days.  A failed sync is retried after time_sync_min_interval seconds.
+time_sync_min_interval = 3600
+time_sync_max_interval = 4 * 86400
+time_sync_accuracy = 0.25
+
+# The RTC keeps local time for timezone, a zone name from time_zone.py's ZONES or a POSIX TZ rule such as
+# "PST8PDT,M3.2.0,M11.1.0".  The UTC offset and the daylight saving time (DST) changes are worked out on the Pico from
+# the zone's rules, and the RTC is moved to the new offset at the moment DST starts or ends.
+timezone = "America/Los_Angeles"  # Change your timezone to match.
+
+# Remote API (see http_api.py).  When http_api_enabled is True the Pico serves a small HTTP API on http_api_port:
+#   GET /schedule         returns Water_Schedule.json.
+#   PUT /schedule         replaces Water_Schedule.json.  The new schedule is checked before it replaces the old one.
+#   GET /relays           returns the state of every relay as JSON.
+#   POST /relays/N/on     turns relay N on until it is turned off again, like holding its manual button.
+#   POST /relays/N/off    turns relay N off, ending its scheduled run if it has one.
+# GET answers carry an ETag.  Send it back in If-None-Match to get a short 304 answer when nothing has changed.
+# The server is polled every http_api_poll_interval seconds and never waits for a client, so a slow client can't hold
+# up the relays.
+# NOTE: The API keeps Wi-Fi connected and the Pico awake between polls, so low power sleep is not used while it is
+# enabled.
+http_api_enabled = False
+http_api_port = 80
+http_api_poll_interval = 0.25
+
 # Constants for relay state: RELAY_ACTIVE and RELAY_INACTIVE
 # RELAY_ACTIVE is used to indicate that a relay is turned on or activated.
 # RELAY_INACTIVE is used to indicate that a relay is turned off or deactivated.
-# In this code, the relays are controlled by setting their values to these constants.
+# In this code, relay_outputs (see below) controls the relays by setting their values to these constants.
 # For most relay modules, activating a relay requires setting its GPIO pin to a logic level that energizes the relay.
 # The actual behavior may depend on how the relay module is connected and whether it is active LOW or active HIGH.
 # These constants help to provide clear and consistent names for the relay states throughout the code.
@@ -72,33 +206,83 @@ RELAY_INACTIVE = True
 relay_pins = [board.GP0, board.GP1, board.GP2, board.GP3, board.GP4, board.GP5, board.GP6, board.GP7]
 button_pins = [board.GP8, board.GP9, board.GP10, board.GP11, board.GP12, board.GP13, board.GP14, board.GP15]
 
-# Create DigitalInOut instances for each GPIO pin in 'relay_pins' and 'button_pin' to control the corresponding
-# relays and buttons.
+# Zone sequencing (see sequencer.py).  Scheduled starts that fall in the same minute are queued and opened back to
+# back instead of all at once, so the solenoids don't all draw their current from the battery together.
+# max_open_valves is the most valves open at once, 0 for no limit.
+# zone_current is the current, in amps, each relay's solenoid draws, in relay order, and current_budget is the most
+# total current, in amps, the open valves may draw, None for no limit.  Valves held open by a manual button count
+# towards both limits but are never held back.
+# Each zone still runs for its full duration from the moment its valve opens, and a start that had to wait is logged
+# with the time it waited.
+# Neither limit is set by default, so every scheduled start opens on time.  For example max_open_valves = 2 opens at
+# most two valves at once, and current_budget = 1.0 with 0.5 A solenoids does the same by current.
+max_open_valves = 0
+zone_current = [0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5]
+current_budget = None
+
+# Define the GPIO pin for the pause button.
+# Change the pin number (GP16) to match the pin you are using for the new button.
+pause_button_pin = board.GP16
+
+# Create DigitalInOut instances for each GPIO pin in 'relay_pins' to control the corresponding relays.
 relays = [DigitalInOut(pin) for pin in relay_pins]
-buttons = [DigitalInOut(pin) for pin in button_pins]
 
-# Set relays as output and set them to inactive or off.  The relays should remain off when the system boots.
+# Set relays as output.  The relays should remain off when the system boots.
 for relay in relays:
     relay.direction = Direction.OUTPUT
-    relay.value = RELAY_INACTIVE
 
-# Set buttons as input.  Buttons are wired to ground so use internal Pull.UP resisters.
-for button in buttons:
-    button.direction = Direction.INPUT
-    button.pull = Pull.UP
+# Shadow register of the relay outputs (see relay_output.py), which turns every relay off.  The code below only sets
+# the state each relay should be in, and relay_outputs.apply() writes the pins that changed once per pass of a task.
+relay_outputs = RelayOutputs(relays, RELAY_ACTIVE)
+
+# keypad.Keys scanning the buttons: key 0 is the pause schedule button and key i + 1 is manual button i.
+button_keys = None
+# Button states built from the keypad events, laid out like read_inputs() returns them.
+button_state = 0
+# Reused for every event read from the queue, so reading events allocates no memory.
+key_event = keypad.Event()
+
+
+def setup_buttons():
+    """
+    Starts the background scanning of the manual buttons and the pause schedule button.
+
+    Buttons are wired to ground so keypad enables the internal pull-up resistors and a key is pressed when its pin
+    reads LOW.  This is called at start up and again after a light sleep, because the button pins have to be released
+    for the sleep's pin alarms.  keypad reports every button that is already held as a new press.
+
+    :returns: None
+    """
+    global button_keys, button_state
+
+    button_keys = keypad.Keys([pause_button_pin] + button_pins, value_when_pressed=False, pull=True,
+                              interval=button_scan_interval, max_events=button_event_queue_size)
+    button_state = 0
+
+
+def release_buttons():
+    """
+    Releases the button pins so they can be used by the pin alarms that wake the Pico from sleep.
+
+    :returns:
+        watch_pins (list): List of (pin, value) pairs with each button pin and its value before it was released.
+    """
+    inputs = read_inputs()
+    watch_pins = [(pin, not inputs & (2 << i)) for i, pin in enumerate(button_pins)]
+    watch_pins.append((pause_button_pin, not inputs & 1))
+    button_keys.deinit()
+    return watch_pins
 
-# Define the GPIO pin for the pause button.
-# Change the pin number (GP16) to match the pin you are using for the new button.
-pause_schedule_button = DigitalInOut(board.GP16)
 
-# Set the new button as input and enable internal pull-up resistor.
-pause_schedule_button.direction = Direction.INPUT
-pause_schedule_button.pull = Pull.UP
+setup_buttons()
 
 # # Define onboard LED and set it to OUTPUT
 led = DigitalInOut(board.LED)
 led.direction = Direction.OUTPUT
 
+# The Pico's Real-Time Clock.  The main loop reads it once per pass.
+real_time_clock = rtc.RTC()
+
 
 def check_for_logging():
     """
@@ -106,7 +290,8 @@ def check_for_logging():
 
     This function checks if event logging is enabled. If logging is enabled and
     a 'log.txt' file does not exist in the current directory, it creates an
-    empty 'log.txt' file.
+    empty 'log.txt' file ('log.bin' when log_format is "binary").  When log_storage is "circular" it creates
+    and preallocates 'log.dat' instead, if it doesn't already exist.
 
     :parameter:
         None
@@ -117,17 +302,25 @@ def check_for_logging():
     Example:
         check_for_logging()
     """
-    if enable_logging:
+    if enable_logging and log_storage == "circular":
+        log_file.prepare()  # Open log.dat, creating it at its full size if necessary
+    elif enable_logging:
         # # Check if the log file exists
         try:
-            with open(log_filename, "r"):
+            with open(log_file.filename, "r"):
                 pass  # File exists, do nothing
         except OSError:
             # File doesn't exist, create it
-            with open(log_filename, "a"):
+            with open(log_file.filename, "a"):
                 pass  # Create an empty file
 
 
+# LED pattern waiting to be played by led_task(), as (times, on_duration, off_duration), and whether one is playing.
+led_pattern = None
+led_playing = False
+led_changed = asyncio.Event()
+
+
 def flash_led(times, on_duration, off_duration):
     """
     Flashes Pico onboard LED a specified number of times with given on and off durations.
@@ -137,6 +330,8 @@ def flash_led(times, on_duration, off_duration):
     This cycle is repeated for the specified number of times. The function provides a simple way to create
     a visual indicator that can be used for different purposes, such as signaling errors, successful events,
     or certain conditions in your program.
+    The flashes are played by led_task() and this function returns at once, so flashing the LED never holds up the
+    relays.  A pattern asked for while another is playing replaces the rest of it.
 
     :parameters:
         times (int): Number of times to flash the LED.
@@ -147,15 +342,52 @@ def flash_led(times, on_duration, off_duration):
 
     Example: flash_led(4, 1, .1) or flash_led(times=4, on_duration=1, off_duration=.1)
 
+    """
+    global led_pattern
+    led_pattern = (times, on_duration, off_duration)
+    led_changed.set()
+
+
+def led_idle():
+    """
+    Returns True if led_task() has no LED pattern to play, so the Pico may enter low power sleep.
+    """
+    return led_pattern is None and not led_playing
+
+
+async def play_led(times, on_duration, off_duration):
+    """
+    Flashes the LED, waiting between changes with asyncio so the other tasks keep running.  See flash_led().
     """
     for _ in range(times):
         led.value = True  # Turn on the LED
-        time.sleep(on_duration)
+        await asyncio.sleep(on_duration)
         led.value = False  # Turn off the LED
-        time.sleep(off_duration)
+        await asyncio.sleep(off_duration)
+        if led_changed.is_set():
+            return  # A new pattern replaces this one
 
 
-def wifi_connect(max_retries=5, retry_interval=5, simulate_failure=False):
+async def led_task():
+    """
+    Task that plays the LED patterns asked for with flash_led().
+
+    :returns: None
+    """
+    global led_pattern, led_playing
+    while True:
+        await led_changed.wait()
+        led_changed.clear()
+        pattern = led_pattern
+        led_pattern = None
+        led_playing = True
+        try:
+            await play_led(*pattern)
+        finally:
+            led_playing = False
+
+
+async def wifi_connect(max_retries=5, retry_interval=5, simulate_failure=False):
     """
     Establishes a Wi-Fi connection using the provided SSID and password.
 
@@ -163,8 +395,9 @@ def wifi_connect(max_retries=5, retry_interval=5, simulate_failure=False):
     settings.toml file. It will retry the connection up to the specified number of times, with a
     defined interval between retries. If the connection is successful, it displays a confirmation
     message and turns off an LED indicator. If the maximum number of retries is reached without a
-    successful connection, it displays an error message, flashes the LED to indicate failure, and
-    turns off the LED after a brief delay.
+    successful connection, it displays an error message and flashes the LED to indicate failure.
+    The wait between retries is an asyncio sleep, so the other tasks, the relays among them, keep running while the
+    connection is retried.  Each connection attempt itself still blocks until the radio gives up.
 
     :parameters
         max_retries (int): Maximum number of connection attempts before giving up.
@@ -173,7 +406,7 @@ def wifi_connect(max_retries=5, retry_interval=5, simulate_failure=False):
 
     :returns: None
 
-    Example: wifi_connect(max_retries=3, retry_interval=10, simulate_failure=False)
+    Example: await wifi_connect(max_retries=3, retry_interval=10, simulate_failure=False)
     """
     retries = 0
 
@@ -196,127 +429,299 @@ def wifi_connect(max_retries=5, retry_interval=5, simulate_failure=False):
             retries += 1
             # Flash the LED five times fairly quickly to indicate connection failure.
             flash_led(5, 0.1, 0.1)  # Flash LED 5 times, each flash is 0.1s on, 0.1s off
-            time.sleep(retry_interval)
+            await asyncio.sleep(retry_interval)
 
     # Display an error message if maximum retries are reached without successful connection.
     if debug: print(f"Error: Unable to establish a WiFi connection after {max_retries} attempts.")
     # Flash the LED five times fairly quickly to indicate connection failure.
     flash_led(5, 0.1, 0.1)  # Flash LED 5 times, each flash is 0.1s on, 0.1s off
-    time.sleep(1)  # Wait for 1 second before turning off the LED.
-    led.value = False  # Turn off the LED.
 
 
-def get_local_time():
+# Socket pool, HTTPS session and SNTP client, made once by network_session() and kept for the life of the program.
+socket_pool = None
+requests_session = None
+time_client = None
+# Drift tracking and resync planning for the clock.
+clock_discipline = ClockDiscipline(time_sync_min_interval, time_sync_max_interval,
+                                   int(time_sync_accuracy * NS_PER_SECOND))
+# Rules of timezone, the UTC offset in seconds the RTC is set to (None until it is set) and the UTC time of the next
+# DST change (None if the zone has none).
+local_zone = get_zone(timezone)
+utc_offset = None
+next_zone_change = None
+
+
+def network_session():
+    """
+    Creates the socket pool, the HTTPS session and the SNTP client the first time it is called.
+
+    Every Internet lookup shares them, so the pool's sockets and the session's memory are only allocated once.
+
+    :returns: None
+    """
+    global socket_pool, requests_session, time_client
+    if socket_pool is None:
+        socket_pool = socketpool.SocketPool(wifi.radio)
+        requests_session = adafruit_requests.Session(socket_pool, ssl.create_default_context())
+        time_client = SntpClient(socket_pool, ntp_servers, clock_utc_ns, ntp_timeout)
+
+
+def rtc_utc_time():
+    """
+    Returns the RTC date/time as UTC seconds since the epoch.
+    """
+    return time.time() - (utc_offset or 0)
+
+
+def clock_utc_ns():
+    """
+    Returns the controller's best idea of the UTC time in nanoseconds since the epoch, the clock the SNTP offsets are
+    measured against.
+
+    That is clock_discipline's drift corrected estimate once the clock has been synced, and the RTC before.
+    """
+    utc_ns = clock_discipline.utc_ns(time.monotonic_ns())
+    if utc_ns is None:
+        return rtc_utc_time() * NS_PER_SECOND
+    return utc_ns
+
+
+async def wait_for_utc_second():
+    """
+    Waits for the start of the next second of clock_discipline's UTC estimate, so the RTC starts counting it on time.
+
+    :returns:
+        utc_time (int): The UTC second that just started, in seconds since the epoch.
     """
-    Retrieves and returns the current local time based on a specified timezone.
+    utc_ns = clock_discipline.utc_ns(time.monotonic_ns())
+    await asyncio.sleep((NS_PER_SECOND - utc_ns % NS_PER_SECOND) / NS_PER_SECOND)
+    return utc_ns // NS_PER_SECOND + 1
 
-    This function retrieves the current local time from an online time API based on a specified timezone.
-    It makes an HTTP GET request to the worldtimeapi.org API, retrieves JSON data containing world time information,
-    and processes the data to calculate the current local time. The function takes into account the timezone offset,
-    raw offset, and daylight saving time (DST) information to accurately determine the current time.
-    The resulting time is returned as a time.struct_time object, which provides various components of the time
-    (hour, minute, second, etc.) in a structured format.
+
+def lookup_utc_time():
+    """
+    Looks up the UTC time from worldtimeapi.org, used when no SNTP server answers.
 
     :returns:
-        current_time (time.struct_time): A struct_time object representing the current local time.
+        unixtime (int): The UTC time in seconds since the epoch.
     """
-    # Create a new socket pool for this function's use
-    pool = socketpool.SocketPool(wifi.radio)
-    # Create an Adafruit Requests session using the socket pool and SSL context.
-    request = adafruit_requests.Session(pool, ssl.create_default_context())
-    # Define the URL for querying world time based on the specified timezone.
-    url = "https://worldtimeapi.org/api/timezone/"
-    timezone = "America/Los_Angeles"  # Change your timezone to match.
-    url = url + timezone
+    network_session()
+    url = "https://worldtimeapi.org/api/timezone/Etc/UTC"
 
     # Display a message indicating the URL being accessed.
     if debug: print(f"Accessing URL \n{url}")
     # Send a GET request to the URL and retrieve JSON data containing world time information.
-    response = request.get(url)
-    json_data = response.json()
-    # Extract the Unix timestamp and time zone offset from the JSON data.
-    unixtime = json_data["unixtime"]
-    raw_offset = json_data["raw_offset"]
-    # Check for daylight savings time and retrieve its offset if applicable.
-    dst_offset = json_data.get("dst_offset", 0)
-    # Calculate the location time by adding the Unix timestamp and raw offset.
-    location_time = unixtime + raw_offset
-    # Determine if Daylight Saving Time (DST) is in effect.
-    dst_active = bool(json_data.get("dst", False))
-    # Display whether DST is active.
-    if debug: print(f"Is DST Active: {dst_active}")
-    # Adjust the location time for daylight savings time if applicable.
-    if dst_active:
-        location_time += dst_offset
-    # Convert the location time to a time.struct_time object representing the current time.
-    current_time = time.localtime(location_time)
-    return current_time
-
-
-def set_rtc_datetime():
+    response = requests_session.get(url)
+    try:
+        json_data = response.json()
+    finally:
+        response.close()
+    return json_data["unixtime"]
+
+
+def sync_clock():
     """
-    Sets the Real-Time Clock (RTC) of the device with the current local time.
+    Asks the SNTP servers in ntp_servers for the time (see time_sync.py) and passes the answer to clock_discipline,
+    which measures the drift and plans the next sync.
+
+    :returns:
+        sample (TimeSample): The server's answer, or None if no server answered.
+    """
+    network_session()
+    sample = time_client.sync()
+    clock_discipline.update(sample, time.monotonic_ns())
+    if sample is None:
+        if debug: print(f"SNTP failed: {time_client.last_error}")
+    elif debug:
+        print(f"SNTP server {ntp_servers[sample.server]}: round trip {sample.round_trip_ns // 1_000_000} ms, "
+              f"offset {sample.offset_ns // 1_000_000} ms, next sync in {clock_discipline.interval} s")
+    return sample
+
+
+def log_time_sync(sample, log_offset=True):
+    """
+    Logs the result of a sync: the offset it found and the measured drift, or a failed sync if sample is None.
+
+    :parameters:
+        sample (TimeSample): The server's answer, or None if no server answered.
+        log_offset (bool): False for the sync that first sets the RTC at start up.  The RTC may still be at its
+            power on date then, so the offset says nothing about the clock and doesn't fit in a log record.
+
+    :returns: None
+    """
+    if sample is None:
+        log_event(EVENT_TIME_SYNC_FAILED)
+        return
+    if log_offset:
+        log_event(EVENT_TIME_SYNC, sample.server, sample.offset_ns // 1_000_000)
+    if clock_discipline.rate_known:
+        log_event(EVENT_CLOCK_DRIFT, value=clock_discipline.rate_ppb // 10)  # Hundredths of a ppm
+
 
-    This function retrieves the current local time from an online time API using the `get_local_time` function.
-    It then creates an instance of the RTC to manage the device's internal clock and sets the RTC datetime using
-    the retrieved current time. The function also displays the newly set RTC date and time, as well as the
-    current time in a formatted, human-readable format.
+def set_rtc_utc(utc_time, step=False):
+    """
+    Sets the RTC to the local time of a UTC time.
+
+    The UTC offset in effect is kept in utc_offset and the next DST change in next_zone_change, so the main loop can
+    move the RTC to the new offset when DST starts or ends.  clock_discipline is told when the RTC was set, so it
+    can work out when drift will have put it half a second off.
+
+    :parameters:
+        utc_time (int): UTC time in seconds since the epoch.
+        step (bool): True if this is a drift correction step.
 
     :returns: None
     """
-    # Obtain the current local time from the network using get_local_time() function.
-    current_time = get_local_time()
+    global utc_offset, next_zone_change
+    utc_offset = local_zone.utc_offset(utc_time)
+    next_zone_change = local_zone.next_change(utc_time)
+    real_time_clock.datetime = time.localtime(utc_time + utc_offset)
+    clock_discipline.rtc_set(utc_time, time.monotonic_ns(), step)
+
 
-    # Create an instance of the Real-Time Clock (RTC) to manage the device's internal clock.
-    clock = rtc.RTC()
+def change_utc_offset():
+    """
+    Moves the RTC to the UTC offset of the DST change in next_zone_change, which has been reached.
 
-    # Set the internal RTC datetime using the retrieved current_time as a struct_time object.
-    clock.datetime = time.struct_time(current_time)
+    The schedule task wakes for the change at the start of an RTC second (see plan_wakeups()), so the RTC is set at once
+    without losing the part of a second it has counted.
+
+    :returns: None
+    """
+    utc_time = rtc_utc_time()
+    set_rtc_utc(utc_time)
+    log_data(f"Clock changed to {local_zone.name(utc_time)}, UTC offset {utc_offset // 60} min.")
+
+
+async def set_rtc_datetime():
+    """
+    Sets the Real-Time Clock (RTC) of the device with the current local time.
+
+    This function gets the current UTC time from the SNTP servers with sync_clock(), or from worldtimeapi.org if
+    none of them answers, and sets the RTC to the local time for it with set_rtc_utc().  An SNTP time is accurate to
+    a fraction of a second, so the RTC is set at the start of the next second.  The function also displays the newly
+    set RTC date and time in a formatted, human-readable format and logs the result of the sync.
+
+    :returns: None
+    """
+    sample = sync_clock()
+    set_rtc_utc(lookup_utc_time() if sample is None else await wait_for_utc_second())
 
     # Display the newly set RTC date and time.
-    current_date_time = clock.datetime
-    if debug: print(f"RTC Date/Time Set: {current_date_time}")
+    current_date_time = real_time_clock.datetime
+    if debug: print(f"RTC Date/Time Set: {current_date_time} {local_zone.name(rtc_utc_time())}")
 
     # Format and print the current time in a human-readable format.
-    if debug: print(f"Formatted Time: {current_time.tm_hour:d}:{current_time.tm_min:02d}:{current_time.tm_sec:02}")
+    if debug: print(f"Formatted Time: {current_date_time.tm_hour:d}:{current_date_time.tm_min:02d}:"
+                    f"{current_date_time.tm_sec:02}")
+
+    # Log the result of the sync, now that the RTC gives the log entry the right time.  The offset is only logged by
+    # resync_clock(), this one is measured against whatever the RTC held before it was first set.
+    log_time_sync(sample, log_offset=False)
+
+
+async def resync_clock():
+    """
+    Syncs the clock again once clock_discipline says a sync is due, and sets the RTC from the new estimate.
+
+    Wi-Fi is reconnected with a single attempt if it has dropped.  If no server answers, the RTC keeps running on the
+    drift corrected estimate and the sync is retried after time_sync_min_interval seconds.
+
+    :returns: None
+    """
+    if not wifi.radio.connected:
+        await wifi_connect(max_retries=1, retry_interval=0)
+    sample = sync_clock()
+    if sample is not None:
+        set_rtc_utc(await wait_for_utc_second())
+    log_time_sync(sample)
+
+
+def network_held_until(now):
+    """
+    Returns the time.monotonic() value until which blocking network work has to wait, or None if it can start now.
+
+    Connecting to Wi-Fi and asking the time servers block the Pico for up to a few seconds, so they are held back
+    while a relay is due to stop within network_stop_margin seconds, until that relay has stopped.
+
+    :parameters:
+        now (float): The current time.monotonic() value.
+    """
+    soonest = None
+    for i in iter_bits(relay_state.running):
+        if soonest is None or relay_state.stop_at[i] < soonest:
+            soonest = relay_state.stop_at[i]
+    if soonest is None or soonest - now >= network_stop_margin:
+        return None
+    return soonest
+
+
+# Buffered writer for the log file and the time of the last log entry, used to space out the CPU temperature entries.
+if log_storage == "circular":
+    log_file = CircularLogFile(circular_log_filename, log_circular_entries, log_circular_entry_size, log_format)
+elif log_format == "binary":
+    log_file = BinaryLogFile(binary_log_filename)
+else:
+    log_file = TextLogFile(log_filename)
+log_buffer = LogBuffer(log_file, log_buffer_size, log_flush_threshold, log_flush_interval)
+last_log_time = None
+
+
+def log_event(code, relay=LOG_NO_RELAY, value=0, message=None):
+    """
+    Add an event to the log with the current date and time.
+
+    If enable_logging is True/Enabled, this function adds an event record to the log buffer along with the current
+    date and time obtained from the RTC (Real Time Clock) module.  The buffered entries are written to the log file
+    in blocks by log_buffer (see log_flush_threshold and log_flush_interval), so a burst of relay events costs one
+    flash write instead of one per event.  Records are only formatted as "YYYY-MM-DD HH:MM:SS: message" text when a
+    text log is written, binary logs store them as they are (see log_format).
+
+    :parameters
+        code (int): Event code, one of the EVENT_* constants from event_log.py.
+        relay (int): Index of the relay the event is about, if any.
+        value (int): Event value, for CPU temperature events the temperature in hundredths of a degree.
+        message (str): Text for EVENT_TEXT events.
+
+    :returns: None
+
+    Example: log_event(EVENT_SCHEDULE_ON, i)
+    """
+    global last_log_time
+
+    if enable_logging:  # log_update must be set to True for logging to run
+        # time.time() reads the RTC as seconds since the epoch
+        last_log_time = int(time.time())
+        log_buffer.add(last_log_time, code, relay, value, message)
+        log_added.set()  # Wake log_task() to plan the flush
+        if debug: print(f"Log Entry: {format_message(code, relay, value, message)}")
 
 
 def log_data(log_text):
     """
     Update a log file with the provided text, date, and time.
 
-    If enable_logging is True/Enabled, this function takes a text string as input and appends it to a
-    log file along with the current date and time obtained from the RTC (Real Time Clock) module.
-    The date and time are formatted as: "YYYY-MM-DD HH:MM:SS".
-
-    If the log file doesn't exist, this function will create it.
+    Adds a free text EVENT_TEXT entry with log_event().  The text is only kept when log_format is "text", binary
+    logs record that a message was logged but not its text.
 
     :parameters
         log_text: (str): The text to be added to the log.
 
     :returns: None
 
-    Example: log_data(f"Relay {i}: was activated")
+    Example: log_data("Schedule file updated")
     """
-    global log_filename
+    log_event(EVENT_TEXT, message=log_text)
 
-    if enable_logging:  # log_update must be set to True for logging to run
-        # Get the current date and time from the RTC
-        rtc_datetime = rtc.RTC().datetime
-        current_datetime = "{:04}-{:02}-{:02} {:02}:{:02}:{:02}".format(
-            rtc_datetime.tm_year, rtc_datetime.tm_mon, rtc_datetime.tm_mday,
-            rtc_datetime.tm_hour, rtc_datetime.tm_min, rtc_datetime.tm_sec)
-        # Format the log entry
-        log_entry = f"{current_datetime}: {log_text}\n"
-        try:
-            # Append the log entry to the log file
-            with open(log_filename, "a") as log_file:
-                print(f"Log Entry: {log_entry}")
-                log_file.write(log_entry)
-                log_file.flush()
-                if debug: print("Event Logged!")
-        except OSError as e:
-            print(f"Unexpected error in log_data(): {e}")
+
+def flush_log():
+    """
+    Writes any buffered log entries to the log file now.
+
+    :returns: None
+    """
+    if log_buffer.flush():
+        if debug: print("Events Logged!")
 
 
 def cpu_temp():
@@ -335,37 +740,65 @@ def cpu_temp():
     return temp
 
 
-def log_cpu_temp():
+def log_cpu_temp(current_time):
     """
     Logs the current CPU temperature in Celsius to a log file if more than X minutes have passed since the last entry.
 
-    This function checks the last modification time of the specified log file. If the time elapsed since the last
-    log entry is greater than or equal to the specified log interval in minutes, it retrieves the current
-    CPU temperature and creates a log entry with the temperature information. The log entry is appended to the
-    log file along with the current date and time.
+    This function checks the time of the last log entry, which at start up is the last modification time of the
+    log file. If the time elapsed since the last log entry is greater than or equal to the specified log interval
+    in minutes, it retrieves the current CPU temperature and creates a log entry with the temperature information.
+    The log entry is appended to the log file along with the current date and time.
 
-    :parameter: None
+    :parameter:
+        current_time (int): The RTC date/time read at the top of this pass of the loop, in seconds since the epoch.
+
+    :returns:
+        due_in (float): Seconds until the next CPU temperature log entry is due.
+    """
+    global last_log_time
+    if last_log_time is None:
+        try:
+            stat_result = os.stat(log_file.filename)
+            last_log_time = stat_result[8]  # Index 8 corresponds to st_mtime
+        except OSError:
+            last_log_time = 0
+    # Check if the time elapsed since the last log entry is greater than or equal to the specified log interval
+    # in seconds.  Convert log_interval from minutes to seconds by multiplying it by 60.
+    if current_time - last_log_time >= (log_interval * 60):
+        # Get CPU temperature
+        cpu_temperature = cpu_temp()
+
+        # Update the log with the CPU temperature in hundredths of a degree
+        log_event(EVENT_CPU_TEMP, value=round(cpu_temperature * 100))
+        return log_interval * 60
+    return log_interval * 60 - (current_time - last_log_time)
+
+
+# Timing of each phase of the main loop and the time.monotonic() value its maximums were last logged at.
+loop_profiler = LoopProfiler(enabled=profile_loop)
+last_profile_log = time.monotonic()
+
+
+def log_loop_profile(now):
+    """
+    Logs the longest time each main loop phase took, in milliseconds, every profile_log_interval seconds.
+
+    Each phase gets one log entry whose relay number is the phase number from profiler.py, so a stall shows up in the
+    log next to the events around it.  The maximums start again from zero after they are logged.
+
+    :parameters:
+        now (float): The time.monotonic() value read at the top of this pass of the loop.
 
     :returns: None
     """
-    global log_filename
-    try:
-        # # Get the last modification time of the log file
-        # last_mod_time = os.stat(log_filename).st_mtime
-        current_time = time.time()
-        stat_result = os.stat(log_filename)
-        last_mod_time = stat_result[8]  # Index 8 corresponds to st_mtime
-        # Check if the time elapsed since the last log entry is greater than or equal to the specified log interval
-        # in seconds.  Convert log_interval from minutes to seconds by multiplying it by 60.
-        if current_time - last_mod_time >= (log_interval * 60):
-            # Get CPU temperature
-            cpu_temperature = cpu_temp()
-            log_text = f"CPU Temp: {cpu_temperature:.2f} °C"
-
-            # Update the log with the CPU temperature
-            log_data(log_text)
-    except OSError:
-        pass
+    global last_profile_log
+    if not (enable_logging and loop_profiler.enabled and profile_log_interval):
+        return
+    if now - last_profile_log < profile_log_interval:
+        return
+    last_profile_log = now
+    for phase, longest_us in enumerate(loop_profiler.end_window()):
+        log_event(EVENT_LOOP_PHASE, phase, longest_us // 1000)
 
 
 def uptime():
@@ -390,58 +823,85 @@ def uptime():
     print(f"Current Uptime: {uptime_hours} hours, {uptime_minutes} minutes, {uptime_seconds} seconds")
 
 
+# Define the name of the watering schedule file
+schedule_filename = "Water_Schedule.json"
+
+# How load_schedule_data() decides the schedule file has changed and needs to be parsed again.
+# "stat" compares the file size and modification time, which costs no flash reads.
+# "crc" also compares a checksum of the file contents, use it if you edit the schedule in place without changing
+# its size within a couple of seconds of the last edit.
+schedule_change_check = "stat"
+
+# The compiled schedule is kept in a binary cache file next to the JSON, so start up reads it without parsing the
+# JSON.  The cache is rebuilt whenever Water_Schedule.json changes, which stays the file to edit.  Set
+# schedule_cache_filename to None to always parse the JSON.
+schedule_cache_filename = "Water_Schedule.bin"
+schedule_file = ScheduleFile(schedule_filename, schedule_change_check, schedule_cache_filename)
+
 # Initialize scheduling data with empty lists for load_schedule_data
+# schedule holds the compiled activation index used by the main loop, watering_days and watering_times are kept for
+# debugging and for is_watering_day() / is_watering_time().
+schedule = schedule_file.schedule
 watering_days = []
 watering_times = []
 
 
-def load_schedule_data():
+def load_schedule_data(force=False):
     """
     Load watering schedule data from a JSON file and create lists for watering days and times.
 
-    This function reads a JSON file containing watering schedule data and creates two lists:
-    one for watering days and the other for watering times. It retrieves the relay order from the JSON data,
-    then iterates through each relay name in the order, appending the corresponding schedule and time data to the lists.
-    The resulting lists are returned, and debug messages are printed during the process if the debug flag is set.
-    If an error occurs while loading the data, empty lists are returned as a fallback.
+    This function reads a JSON file containing watering schedule data and compiles it into a Schedule (see
+    water_schedule.py).  Along with the watering days and watering times lists, the Schedule holds an activation
+    index keyed by minute of the week, so the main loop can find every relay due to start with a single lookup
+    instead of scanning each relay's lists on every tick.
+    The file is only read and parsed again when it has changed since the last load (see schedule_change_check), so
+    this function is cheap enough to call on every pass of the main loop.  The new schedule replaces the old one in
+    a single step.
+    Debug messages are printed during the process if the debug flag is set.
+    If an error occurs while loading the data, the previously loaded schedule is kept and its lists are returned.
+
+    :parameters:
+        force (bool): If True, read the file even if it looks unchanged, used after it is replaced over the API.
 
     :returns:
         watering_days (list):  List of watering days for relays
         watering_times (list): List of watering times for relays
     """
-    global watering_days, watering_times
-
     try:
-        # Open the Water_Schedule.json file for reading
-        with open('Water_Schedule.json', 'r') as file:
-            # Load JSON data from the file
-            schedule_data = json.load(file)
+        install_schedule(force)
+    except Exception as e:
+        print(f"Error loading schedule data: {e}")
 
-            # Extract and sort the keys from "watering_days" that start with "relay" in alphabetical order
-            relay_order = sorted([key for key in schedule_data["watering_days"] if key.startswith("relay")])
+    return watering_days, watering_times
 
-            # Reset the lists before populating them as we are using .append to build each list
-            watering_days = []
-            watering_times = []
 
-            # Iterate through each relay name in the order and build both lists for scheduling
-            for relay_name in relay_order:
-                if relay_name in schedule_data["watering_days"]:
-                    watering_days.append(schedule_data["watering_days"][relay_name])
-                    watering_times.append(schedule_data["watering_times"][relay_name])
-                else:
-                    print(f"Relay {relay_name} not found in schedule data.")
+def install_schedule(force=False, filename=None):
+    """
+    Reloads the schedule file if it has changed and makes its schedule the one the main loop runs.
 
-            # Print oout lists to the console
-            if debug: print(f"Relay Order: {relay_order}")
-            if debug: print(f"Garden Bed Schedule List: {watering_days}")
-            if debug: print(f"Watering Times List: {watering_times}")
+    Raises the errors of ScheduleFile.reload() if the file cannot be read or parsed, and the current schedule is kept.
 
-            return watering_days, watering_times
+    :parameters:
+        force (bool): If True, read the file even if it looks unchanged.
+        filename (str): Read this file instead, an upload about to replace the schedule file.
 
-    except Exception as e:
-        print(f"Error loading schedule data: {e}")
-        return [], []
+    :returns:
+        installed (bool): True if a new schedule was installed.
+    """
+    global schedule, watering_days, watering_times
+
+    # Re-read and compile the schedule file only if it has changed
+    if not schedule_file.reload(force, filename):
+        return False
+    schedule = schedule_file.schedule
+    watering_days = schedule.watering_days
+    watering_times = schedule.watering_times
+
+    # Print out lists to the console
+    if debug: print(f"Relay Order: {schedule.relay_order}")
+    if debug: print(f"Garden Bed Schedule List: {watering_days}")
+    if debug: print(f"Watering Times List: {watering_times}")
+    return True
 
 
 load_schedule_data()  # Grab scheduling data before we get started
@@ -489,14 +949,41 @@ def is_watering_time(relay_bed_index, current_time):
 
 
 # Define variables for the main loop.
-manual_activation_flags = [False] * len(relays)  # When relay is manually activated set this flag for that relay
-schedule_running = [False] * len(relays)  # When a relay is activated due to schedule set its schedule running flag
-start_time = [time.struct_time((1970, 1, 1, 0, 0, 0, 3, 1, -1))] * len(relays)  # Initialize a list to store start time for each relay
-end_time = [-1] * len(relays)  # Initialize a list to store end time for each relay
-event_logged = [False] * len(relays)
+# relay_state holds, for every relay, whether it was manually activated, whether it is running on schedule, whether
+# its activation was logged, and the start and end times of its scheduled run (see relay_state.py).  Bit i of
+# relay_state.manual, relay_state.running and relay_state.logged belongs to relay i.
+relay_state = RelayState(len(relays))
+
+# Queue of scheduled starts waiting for a valve to close (see max_open_valves).
+zone_sequencer = ZoneSequencer(len(relays), max_open_valves, current_budget, zone_current)
 
+# Debounced manual button states and the limit on how often each button can add relay events to the log.
+button_debouncer = Debouncer(len(button_pins), button_press_time, button_release_time)
+button_log_limiter = RateLimiter(len(button_pins), button_log_limit, button_log_window)
 
-def check_manual_button():
+
+def log_button_event(code, relay, now):
+    """
+    Logs a manual relay event unless the relay's button has used up its button_log_limit entries.
+
+    When a button is allowed to log again after entries were held back, a text entry records how many were missed.
+
+    :parameters:
+        code (int): EVENT_MANUAL_ON or EVENT_MANUAL_OFF.
+        relay (int): Index of the relay.
+        now (float): The time.monotonic() value read at the top of this pass of the loop.
+
+    :returns: None
+    """
+    if not button_log_limiter.allow(relay, now):
+        return
+    suppressed = button_log_limiter.pop_suppressed(relay)
+    if suppressed:
+        log_data(f"Relay {relay}: {suppressed} button events not logged.")
+    log_event(code, relay)
+
+
+def check_manual_button(inputs, now):
     """
     Check the state of manual buttons and control the corresponding relays.
 
@@ -505,57 +992,64 @@ def check_manual_button():
     the corresponding relay is activated, and a manual activation flag is set. If the button is released,
     the relay is deactivated, and the manual activation flag is reset. Relay events are logged once when they
     are turned on or off.
+    A relay turned on over the HTTP API (see remote_relays) is handled as if its button were held.
+    The buttons are debounced by button_debouncer, which never sleeps, so the check takes the same time however many
+    buttons are held.  A change that has not been stable long enough is picked up by a later pass (see plan_wakeups()).
+
+    :parameters:
+        inputs (int): The button states from read_inputs().
+        now (float): The time.monotonic() value read at the top of this pass of the loop.
 
     :returns: None
     """
-    for i, manual_button_state in enumerate(buttons):
-        # Check if the manual button is pressed (active LOW), indicating manual relay activation.
-        if not manual_button_state.value:
-            time.sleep(.1)  # Introduce a small delay (0.1 seconds) for debounce and smoother button handling.
-            # Activate the corresponding relay by setting its value to RELAY_ACTIVE.
-            relays[i].value = RELAY_ACTIVE
-            # Set the manual activation flag for the relay to True.
-            manual_activation_flags[i] = True
-
-            # If logging is enabled and the event has not yet been logged, log it.
-            if enable_logging and not event_logged[i]:
-                # Log the relay event with the relay number and state
-                log_data(f"Relay {i}: was manually activated.")
-                event_logged[i] = True  # Set relays event logged flag to True
-
-        else:
-            # If the manual button is not pressed.
-            if not schedule_running[i]:  # We may have relay running under a schedule and don't want to turn it off.
-                # Deactivate the relay.
-                relays[i].value = RELAY_INACTIVE
-                # Reset the manual activation flag for the relay to False.
-                manual_activation_flags[i] = False
-
-                # if logging is enabled and the event HAS been logged, log the deactivation of relay.
-                if enable_logging and event_logged[i]:
-                    log_data(f"Relay {i}: was manually deactivated.")
-                    event_logged[i] = False  # set relays event logged flag to False
+    # Bit i is set while manual button i is pressed, or if it was pressed since the last check and already released.
+    # Relays turned on over the API count as held.
+    pressed = button_debouncer.update(inputs >> 1, now) | button_debouncer.take_presses() | remote_relays
+    pressed &= relay_state.all
+
+    # Check if the manual buttons are pressed, indicating manual relay activation.
+    for i in iter_bits(pressed):
+        # Activate the corresponding relay.
+        relay_outputs.on(i)
+        # Set the manual activation flag for the relay.
+        relay_state.manual |= 1 << i
+
+        # If logging is enabled and the event has not yet been logged, log it.
+        if enable_logging and not relay_state.logged & (1 << i):
+            # Log the relay event with the relay number and state
+            log_button_event(EVENT_MANUAL_ON, i, now)
+            relay_state.logged |= 1 << i  # Set relays event logged flag
+
+    # Manually activated relays whose button is no longer pressed.  We may have a relay running under a schedule and
+    # don't want to turn it off.
+    for i in iter_bits(relay_state.manual & ~pressed & ~relay_state.running):
+        # Deactivate the relay.
+        relay_outputs.off(i)
+        # Reset the manual activation flag for the relay.
+        relay_state.manual &= ~(1 << i)
+
+        # if logging is enabled and the event HAS been logged, log the deactivation of relay.
+        if enable_logging and relay_state.logged & (1 << i):
+            log_button_event(EVENT_MANUAL_OFF, i, now)
+            relay_state.logged &= ~(1 << i)  # Clear relays event logged flag
 
 
 def calculate_end_time(start, duration_minutes):
     """
     Calculate the watering end time based on the provided start time and duration in minutes.
 
-    This function takes a starting time (in the form of a time.struct_time object) and a duration in minutes
-    as inputs. The end time is calculated by multiplying the duration in minutes by 60 then adding that to start_time.
-    The result is returned as a time.struct_time object representing the calculated end time.
+    This function takes a starting time in whole seconds of the monotonic clock and a duration in minutes as inputs.
+    The end time is calculated by multiplying the duration in minutes by 60 then adding that to start.  Being on the
+    monotonic clock, the end time is not moved when set_rtc_datetime() changes the RTC during the run.
 
     :parameters:
-        start (time.struct_time): The starting time as a time.struct_time object.
+        start (int): The starting time in whole seconds of time.monotonic().
         duration_minutes (int): The duration in minutes to add to the start time.
 
     :returns:
-        end_time_local (time.struct_time): The calculated end time as a time.struct_time object.
+        end_time (int): The calculated end time in whole seconds of time.monotonic().
     """
-    start_timestamp = time.mktime(start)
-    end_timestamp = start_timestamp + (duration_minutes * 60)
-    end_time_local = time.localtime(end_timestamp)
-    return end_time_local
+    return start + duration_minutes * 60
 
 
 def print_relay_properties():
@@ -570,21 +1064,741 @@ def print_relay_properties():
     :returns: None
     """
     for relay_index in range(len(relays)):
+        bit = 1 << relay_index
         print("\n")
         print(f"Relay Index: {relay_index}")
-        current_date_time = rtc.RTC().datetime  # Get current time and day of the week from Pico RTC.
+        current_date_time = real_time_clock.datetime  # Get current time and day of the week from Pico RTC.
         current_time = (current_date_time.tm_hour, current_date_time.tm_min,
                         current_date_time.tm_sec)  # Extract the current time as a tuple (hour, minute)
         print(f"Current Time: {current_time}")  # hour, minute and seconds
-        print(f"Manual Activation Flag: {manual_activation_flags[relay_index]}")
+        print(f"Manual Activation Flag: {bool(relay_state.manual & bit)}")
         print(f"Watering Days: {watering_days[relay_index]}")
         print(f"Watering Time and Duration: {watering_times[relay_index]}")  # Starting Hour, Minute and duration of watering
-        print(f"Watering Start Time: {start_time[relay_index]}")
-        print(f"Watering End Time: {end_time[relay_index]}")
-        print(f"Schedule Running: {schedule_running[relay_index]}")
+        print(f"Watering Start Time: {relay_state.start_time[relay_index]}")  # Seconds since the epoch, -1 if none
+        print(f"Watering End Time: {relay_state.stop_at[relay_index]}")  # Seconds of uptime, -1 if none
+        print(f"Schedule Running: {bool(relay_state.running & bit)}")
         print("\n")
 
 
+# Queue of upcoming deadlines (see scheduler.py).  Every task keeps the next moment it has to run in it, so a low
+# power sleep can last until the earliest of them.
+wakeups = DeadlineQueue()
+# Relays with an EVENT_STOP in wakeups, as a bitmask.
+planned_stops = 0
+
+# Low power sleep between watering events (see power.py).
+power = PowerManager(power_mode, deep_sleep_min)
+
+# Events that wake a waiting task early.  buttons_changed wakes buttons_task() when a button may have changed, for
+# example after a pin alarm ended a light sleep.  schedule_changed wakes schedule_task() when the pause schedule button
+# changed or the RTC was set.  log_added wakes log_task() when an entry is buffered.  clock_ready is set once the RTC
+# has been set at start up, schedule_task() waits for it.
+buttons_changed = asyncio.Event()
+schedule_changed = asyncio.Event()
+log_added = asyncio.Event()
+clock_ready = asyncio.Event()
+
+
+def read_inputs():
+    """
+    Reads every queued button event and returns the button states packed into a single integer.
+
+    Bit 0 is set while the pause schedule button is pressed and bit i + 1 is set while manual button i is pressed.
+    Comparing two results is a cheap way to tell whether any button has changed.  Each manual button event is also
+    passed to button_debouncer with the time it happened, so presses that came and went since the last call still
+    count.  If the queue overflowed, keypad is reset so it reports the buttons that are held again.
+
+    :returns:
+        inputs (int): Bitmask of pressed buttons.
+    """
+    global button_state
+    now = time.monotonic()
+    ticks_now = supervisor.ticks_ms()
+    while True:
+        while button_keys.events.get_into(key_event):
+            if key_event.pressed:
+                button_state |= 1 << key_event.key_number
+            else:
+                button_state &= ~(1 << key_event.key_number)
+            if key_event.key_number:
+                button_debouncer.update(button_state >> 1, event_time(key_event.timestamp, ticks_now, now))
+        if not button_keys.events.overflowed:
+            return button_state
+        if debug: print("Button event queue overflowed")
+        button_keys.events.clear()
+        button_keys.reset()
+        button_state = 0
+
+
+def plan_wakeups(current_date_time, now_ns):
+    """
+    Updates the wakeups queue with the next deadline for every kind of event schedule_task() handles, and returns the
+    earliest of them.
+
+    The next scheduled start comes from the compiled schedule, stop times come from relay_state.stop_at for every
+    relay running under the schedule, and schedule file checks are periodic.  The next start is converted from the
+    RTC's wall clock into time.monotonic() seconds so it can be waited for, stop times already are monotonic.  The
+    RTC's seconds started when it was last set, so the conversion counts from the start of the current RTC second
+    rather than from now, and the start is not late by a fraction of a second.
+
+    :parameters:
+        current_date_time (time.struct_time): The RTC date and time read at the top of this pass of the loop.
+        now_ns (int): The time.monotonic_ns() value read at the top of this pass of the loop.
+
+    :returns:
+        deadline (float): The earliest time.monotonic() deadline of the schedule task.
+    """
+    global planned_stops
+
+    now = now_ns / NS_PER_SECOND
+    # time.monotonic() when the RTC started counting its current second.
+    rtc_second_start = now - clock_discipline.rtc_fraction_ns(now_ns) / NS_PER_SECOND
+
+    # Schedule file checks are periodic, the next one is planned once the last has passed.
+    deadline = wakeups.deadline(EVENT_RELOAD)
+    if deadline is None or deadline <= now:
+        deadline = now + schedule_check_interval
+        wakeups.set(EVENT_RELOAD, deadline)
+
+    # Next scheduled start.  Starts are matched on the minute so wake at the start of that minute.
+    minutes = schedule.minutes_until_next_start(current_date_time.tm_wday, current_date_time.tm_hour,
+                                                current_date_time.tm_min)
+    if minutes is None:
+        wakeups.cancel(EVENT_START)
+    else:
+        start_at = rtc_second_start + minutes * 60 - current_date_time.tm_sec
+        wakeups.set(EVENT_START, start_at)
+        deadline = min(deadline, start_at)
+
+    # Stop time of every relay running under the schedule, and no stop for relays that have stopped since last time.
+    for i in iter_bits(planned_stops & ~relay_state.running):
+        wakeups.cancel(EVENT_STOP, i)
+    for i in iter_bits(relay_state.running):
+        wakeups.set(EVENT_STOP, relay_state.stop_at[i], i)
+        deadline = min(deadline, relay_state.stop_at[i])
+    planned_stops = relay_state.running
+
+    # Moment daylight saving time starts or ends and the RTC moves to the new UTC offset.
+    if next_zone_change is None:
+        wakeups.cancel(EVENT_ZONE)
+    else:
+        zone_at = rtc_second_start + next_zone_change - (time.mktime(current_date_time) - utc_offset)
+        wakeups.set(EVENT_ZONE, zone_at)
+        deadline = min(deadline, zone_at)
+    return deadline
+
+
+def relays_idle():
+    """
+    Returns True if no relay is running and no manual button is held, the only time the Pico may enter low power sleep.
+    """
+    return relay_state.idle()
+
+
+def low_power_sleep(wake_at):
+    """
+    Puts the Pico into light or deep sleep until wake_at, or until a button is pressed.
+
+    The whole Pico sleeps, every task with it, so this is only called when no task has anything to do before wake_at
+    (see wait_for_next_event()).  The button pins are released for the pin alarms during the sleep and set up again
+    afterwards.  A deep sleep saves the relay flags and the UTC time and does not return (see
+    restore_after_deep_sleep()).
+
+    :parameters:
+        wake_at (float): time.monotonic() value to wake at.
+
+    :returns:
+        woken (bool): True if a button ended the sleep.
+    """
+    duration = wake_at - time.monotonic()
+    watch_pins = release_buttons()
+    try:
+        if power.wants_deep_sleep(duration):
+            if debug: print(f"Deep sleeping for {duration:.1f} seconds")
+            flush_log()  # RAM is lost in deep sleep, write out any buffered log entries first
+            power.deep_sleep(duration, watch_pins, rtc_utc_time(), relay_state.manual,
+                             relay_state.running, relay_state.logged)
+        woken = power.light_sleep(wake_at, watch_pins)
+        if woken and debug: print("Woken by a button")
+        return woken
+    finally:
+        setup_buttons()
+
+
+def restore_after_deep_sleep():
+    """
+    Restores the relay flags and RTC date/time saved before a deep sleep.
+
+    The time is saved as UTC, so the RTC comes back on the right UTC offset even if DST started or ended during the
+    sleep.
+
+    :returns:
+        rtc_restored (bool): True if the RTC was set from the saved time, False if it still needs setting from the
+        Internet (normal start up, or a button ended the deep sleep so the time asleep is unknown).
+    """
+    state = power.restore_state()
+    if state is None:
+        return False
+    relay_state.restore(state["manual_mask"], state["running_mask"], state["logged_mask"])
+    if state["epoch_time"] is None:
+        return False
+    set_rtc_utc(state["epoch_time"])
+    if debug: print(f"RTC restored after deep sleep: {real_time_clock.datetime}")
+    return True
+
+
+async def wait_until(event, deadline):
+    """
+    Waits until event is set or time.monotonic() reaches deadline, whichever comes first, then clears the event.
+
+    This is how every task waits, the other tasks run in the meantime.  A deadline that has already passed still
+    lets them run once before the task carries on.
+
+    :parameters:
+        event (asyncio.Event): The event that wakes the task early.
+        deadline (float): time.monotonic() value to wait until.
+
+    :returns:
+        woken (bool): True if the event was set.
+    """
+    timeout = deadline - time.monotonic()
+    if event.is_set() or timeout <= 0:
+        await asyncio.sleep(0)
+    else:
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    woken = event.is_set()
+    event.clear()
+    return woken
+
+
+async def wait_for_next_event(deadline):
+    """
+    Waits until the schedule task's next deadline, or until the pause schedule button changes or the RTC is set.
+
+    When no relay is on, no manual button is held and the LED is idle, and power_mode allows it, the Pico enters low
+    power sleep instead.  The other tasks are given the chance to run first, so every deadline in the wakeups queue
+    is current, and the sleep ends at the earliest of them.  In "deep" mode the periodic checks and max_sleep are
+    ignored for the deep sleep, the schedule is read again anyway when main.py restarts after the wake.
+
+    :parameters:
+        deadline (float): The schedule task's earliest deadline from plan_wakeups().
+
+    :returns: None
+    """
+    wake_at = time.monotonic() + max_sleep
+    if deadline < wake_at:
+        wake_at = deadline
+    if debug: print(f"Next event: {wakeups.next_event()}, waiting {wake_at - time.monotonic():.1f} seconds")
+
+    if power.enabled() and relays_idle() and led_idle():
+        await asyncio.sleep(0)  # Let every task that is ready plan its next deadline
+        sleep_until = wakeups.next_deadline()
+        if sleep_until is None or sleep_until > wake_at:
+            sleep_until = wake_at
+        if power.mode == POWER_DEEP and not http_api_enabled:
+            # Sleep until the next start or log entry, ignoring the checks that only matter while awake.
+            deadlines = [wakeups.deadline(kind) for kind in (EVENT_START, EVENT_LOG)]
+            deadlines = [deadline for deadline in deadlines if deadline is not None]
+            if deadlines and power.wants_deep_sleep(min(deadlines) - time.monotonic()):
+                sleep_until = min(deadlines)
+        if (relays_idle() and led_idle() and not schedule_changed.is_set()
+                and sleep_until - time.monotonic() >= power.min_sleep):
+            if low_power_sleep(sleep_until):
+                buttons_changed.set()
+            return
+
+    await wait_until(schedule_changed, wake_at)
+
+
+def loop_pass():
+    """
+    Runs one pass of the schedule task and returns when it next has to run.
+
+    Each pass reads the RTC and the pause schedule button, moves the RTC to a new UTC offset when DST starts or ends,
+    reloads the schedule if it has changed and starts and stops relays on schedule.  schedule_task() calls it and
+    then waits in wait_for_next_event(), simulator.py times it.
+
+    :returns:
+        deadline (float): The earliest time.monotonic() deadline of the schedule task, see plan_wakeups().
+    """
+    if debug: print("Entering main loop...")
+    loop_profiler.start()
+
+    # Read the clocks once for the whole pass.  The monotonic clock is read as an integer so that whole seconds keep
+    # their precision however long the Pico has been up, relay stop times are kept in them.
+    now_ns = time.monotonic_ns()
+    now_seconds = now_ns // 1_000_000_000
+    # Get the current date and time from the Pico's Real-Time Clock (RTC).
+    current_date_time = real_time_clock.datetime
+    current_timestamp = time.mktime(current_date_time)  # The same moment in seconds since the epoch
+    if next_zone_change is not None and current_timestamp - utc_offset >= next_zone_change:
+        # Daylight saving time starts or ends, move the RTC to the new UTC offset and read it again.
+        change_utc_offset()
+        current_date_time = real_time_clock.datetime
+        current_timestamp = time.mktime(current_date_time)
+    current_day = current_date_time.tm_wday  # Extract the current day of the week (0-6, Monday is 0)
+    current_time = (current_date_time.tm_hour, current_date_time.tm_min)  # Current time as (hour, minute)
+
+    if debug:
+        # Define a list of weekday names for debug use
+        weekday_names = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+        print("Current day:", current_day, "(", weekday_names[current_day], ")")
+        print("Current Real Time:", f"{current_time[0]:02d}:{current_time[1]:02d}")
+        print(f"Current Structured Time: {current_time}")
+
+    inputs = read_inputs()  # Snapshot of the buttons this pass acts on, the manual buttons are left to buttons_task()
+    load_schedule_data()  # Reload schedule data if the file has changed
+    loop_profiler.mark(PHASE_SCHEDULE_LOAD)
+
+    if not inputs & 1:  # Pause schedule button not pressed
+        if debug: print("Scheduling active")
+        # Look up every relay due to start this minute in the compiled schedule index, and queue it to open.
+        for i, watering_duration in schedule.starts_at(current_day, current_time[0], current_time[1]):
+            if i >= len(relays):
+                continue  # Schedule lists more relays than are wired up
+            if not relay_state.manual & (1 << i) and not relay_state.scheduled(i):
+                zone_sequencer.request(i, watering_duration, now_seconds)
+            else:
+                if debug: print(f"Relay {i} for Garden Bed {i + 1} was manually activated")
+
+        # Deactivate every running relay whose scheduled end time has been reached.
+        due = relay_state.due(now_seconds)
+        # A relay whose manual button or API hold is still on stays on as a manual relay, check_manual_button()
+        # turns it off once it is released.  Wake buttons_task() to look at it now rather than at its next check.
+        held = due & relay_state.manual
+        if held:
+            buttons_changed.set()
+        relay_outputs.set_mask(due & ~held, False)
+        for i in iter_bits(due & ~held):
+            if enable_logging and relay_state.logged & (1 << i):
+                # Log the deactivation of relay
+                log_event(EVENT_SCHEDULE_OFF, i)
+                relay_state.logged &= ~(1 << i)
+        relay_state.stop(due)
+
+        # Open the queued zones the valve and current limits allow, now that the due relays have closed.
+        zone_sequencer.cancel(relay_state.manual)  # Manually activated since it was queued
+        for i, watering_duration, delay in zone_sequencer.admit(relay_state.running | relay_state.manual,
+                                                                 now_seconds):
+            # Activate relay and set its start and end times
+            relay_outputs.on(i)
+            relay_state.start(i, current_timestamp, calculate_end_time(now_seconds, watering_duration))
+
+            if enable_logging and not relay_state.logged & (1 << i):
+                # Log the scheduled relay event
+                log_event(EVENT_SCHEDULE_ON, i)
+                relay_state.logged |= 1 << i
+                if delay:
+                    log_event(EVENT_QUEUE_DELAY, i, min(delay, 0x7FFF))  # Started late, waiting for a valve
+
+    else:
+        if debug: print("Scheduling paused")
+        zone_sequencer.clear()  # Queued starts are skipped like the ones that are due while paused
+        flush_log()  # Write out buffered log entries while the system is paused
+        # Deactivate every relay not held on manually if scheduling is paused
+        relay_outputs.set_mask(relay_state.not_manual(), False)
+        relay_state.stop(relay_state.not_manual())
+
+    relay_outputs.apply()  # Write the relays that changed in this pass
+    if debug: print_relay_properties()
+    loop_profiler.mark(PHASE_SCHEDULE)
+
+    uptime()  # Print the Pico's uptime for debugging
+    loop_profiler.mark(PHASE_UPTIME)
+
+    return plan_wakeups(current_date_time, now_ns)
+
+
+async def schedule_task():
+    """
+    Task that starts and stops the relays on schedule.
+
+    Waits for the RTC to be set at start up, then runs loop_pass() whenever a start, stop, DST change or schedule file
+    check is due, or the pause schedule button changes.
+
+    :returns: None
+    """
+    await clock_ready.wait()
+    while True:
+        deadline = loop_pass()
+        await wait_for_next_event(deadline)
+        loop_profiler.mark(PHASE_SLEEP)
+
+
+async def buttons_task():
+    """
+    Task that reads the button events every input_check_interval seconds and controls the manual relays.
+
+    A button change that is still bouncing is waited for exactly, and a change of the pause schedule button wakes
+    schedule_task() straight away.
+
+    :returns: None
+    """
+    inputs = 0
+    while True:
+        started_ns = time.monotonic_ns()
+        now = started_ns / NS_PER_SECOND
+        last_inputs, inputs = inputs, read_inputs()
+        manual = relay_state.manual
+        check_manual_button(inputs, now)
+        relay_outputs.apply()
+        if (inputs ^ last_inputs) & 1:
+            schedule_changed.set()  # The pause schedule button changed
+        elif relay_state.manual != manual and zone_sequencer.pending():
+            schedule_changed.set()  # A manual relay changed while zones wait for a valve
+        loop_profiler.record_since(PHASE_BUTTONS, started_ns)
+
+        deadline = now + input_check_interval
+        # Moment a button change that is still bouncing becomes stable.
+        debounce_deadline = button_debouncer.next_deadline()
+        if debounce_deadline is None:
+            wakeups.cancel(EVENT_DEBOUNCE)
+        else:
+            wakeups.set(EVENT_DEBOUNCE, debounce_deadline)
+            deadline = min(deadline, debounce_deadline)
+        await wait_until(buttons_changed, deadline)
+
+
+async def log_task():
+    """
+    Task that logs the CPU temperature and the loop profile and writes out the log buffer when they are due.
+
+    Starts once the RTC is set, so the first CPU temperature entry has the right date and time.
+
+    :returns: None
+    """
+    await clock_ready.wait()
+    while True:
+        started_ns = time.monotonic_ns()
+        now = started_ns / NS_PER_SECOND
+        deadline = now + log_check_interval
+        if enable_logging:
+            cpu_log_due_in = log_cpu_temp(time.time())  # Log CPU temperature if logging is enabled
+            log_loop_profile(now)  # Log the longest time of each loop phase if profile_log_interval has passed
+            log_buffer.flush_if_due()  # Write buffered log entries that have waited long enough
+            wakeups.set(EVENT_LOG, now + cpu_log_due_in)
+            deadline = min(deadline, now + cpu_log_due_in)
+        loop_profiler.record_since(PHASE_CPU_LOG, started_ns)
+
+        # Time based flush of the buffered log entries, only while there are entries waiting.
+        flush_deadline = log_buffer.flush_deadline()
+        if flush_deadline is None:
+            wakeups.cancel(EVENT_FLUSH)
+        else:
+            wakeups.set(EVENT_FLUSH, flush_deadline)
+            deadline = min(deadline, flush_deadline)
+        await wait_until(log_added, deadline)
+
+
+async def clock_task(rtc_restored):
+    """
+    Task that sets the RTC at start up and then keeps it on time.
+
+    Unless the RTC was restored after a deep sleep, it connects to Wi-Fi and sets the RTC from the Internet, then lets
+    schedule_task() start.  After that it syncs the clock again when clock_discipline says a sync is due, holding the
+    network work back while a relay is about to stop (see network_held_until()), and steps the RTC when drift has put
+    it half a second off.  Each change of the RTC wakes schedule_task() so it plans the next start again.
+
+    :parameters:
+        rtc_restored (bool): True if restore_after_deep_sleep() set the RTC.
+
+    :returns: None
+    """
+    if rtc_restored:
+        # The restored RTC has not been checked against a time server, sync it once the Pico stays awake long enough.
+        clock_discipline.schedule_sync(time.monotonic_ns())
+    else:
+        # Attempt to connect to Wi-Fi
+        await wifi_connect(max_retries=3, retry_interval=10, simulate_failure=False)
+        # Get current local day of the week and time from the Internet and update RTC
+        await set_rtc_datetime()
+    clock_ready.set()
+
+    while True:
+        now_ns = time.monotonic_ns()
+        now = now_ns / NS_PER_SECOND
+        deadline = now + clock_check_interval
+
+        sync_at = clock_discipline.next_sync_ns
+        if sync_at is None:
+            wakeups.cancel(EVENT_SYNC)
+        else:
+            held_until = network_held_until(now)
+            if now_ns >= sync_at and held_until is None:
+                await resync_clock()
+                schedule_changed.set()
+                continue
+            sync_at = max(sync_at / NS_PER_SECOND, held_until or 0)
+            wakeups.set(EVENT_SYNC, sync_at)
+            deadline = min(deadline, sync_at)
+
+        # Moment drift will have put the RTC half a second off and it is stepped.
+        step_at = clock_discipline.next_step_ns()
+        if step_at is None:
+            wakeups.cancel(EVENT_STEP)
+        else:
+            if now_ns >= step_at:
+                set_rtc_utc(await wait_for_utc_second(), step=True)
+                schedule_changed.set()
+                continue
+            wakeups.set(EVENT_STEP, step_at / NS_PER_SECOND)
+            deadline = min(deadline, step_at / NS_PER_SECOND)
+
+        await asyncio.sleep(max(deadline - time.monotonic(), 0))
+
+
+# Relays turned on over the HTTP API, bit i for relay i.  check_manual_button() treats them as held buttons.
+remote_relays = 0
+# The HTTP API server, made by api_task(), and the ETag of the schedule file with the file signature it was made for.
+http_server = None
+schedule_etag_signature = None
+schedule_etag_value = None
+
+
+def schedule_etag(filename=schedule_filename):
+    """
+    Returns the ETag of Water_Schedule.json, or of an upload about to replace it, a CRC32 of its contents.
+
+    The CRC is only worked out again when the file's size or modification time has changed.
+    """
+    global schedule_etag_signature, schedule_etag_value
+    signature = file_signature(filename)
+    if signature != schedule_etag_signature:
+        schedule_etag_value = f'"{file_crc(filename):08x}"'
+        schedule_etag_signature = signature
+    return schedule_etag_value
+
+
+def relay_status_etag():
+    """
+    Returns the ETag of the relay status, which changes whenever a relay starts or stops or the schedule is paused.
+
+    It is a weak ETag: the seconds remaining in a scheduled run count down without changing it.
+    """
+    return (f'W/"{button_state & 1:x}-{relay_state.manual:x}-{relay_state.running:x}-{remote_relays:x}-'
+            f'{relay_outputs.total_transitions():x}-{binascii.crc32(relay_state.start_time):08x}"')
+
+
+def json_bool(value):
+    """
+    Returns "true" or "false" for a truth value, as written in JSON.
+    """
+    return "true" if value else "false"
+
+
+def relay_status_chunks():
+    """
+    Yields the relay status as JSON, one relay at a time, for GET /relays.
+
+    {"paused": false, "relays": [{"relay": 0, "on": true, "transitions": 12, "manual": false, "remote": false,
+    "scheduled": true, "started": 1717430400, "remaining": 95}, ...]}, where transitions counts the times the relay
+    was switched on or off since start up, started is the RTC time the scheduled run started, in seconds since the
+    epoch, and remaining is the seconds until it stops.  Both are null without a scheduled run.
+    """
+    now_seconds = time.monotonic_ns() // NS_PER_SECOND
+    yield f'{{"paused": {json_bool(button_state & 1)}, "relays": ['.encode()
+    for i in range(len(relays)):
+        bit = 1 << i
+        started = remaining = "null"
+        if relay_state.running & bit:
+            started = relay_state.start_time[i]
+            remaining = max(relay_state.stop_at[i] - now_seconds, 0)
+        yield (f'{", " if i else ""}{{"relay": {i}, "on": {json_bool(relay_outputs.is_on(i))}, '
+               f'"transitions": {relay_outputs.transitions[i]}, "manual": {json_bool(relay_state.manual & bit)}, '
+               f'"remote": {json_bool(remote_relays & bit)}, '
+               f'"scheduled": {json_bool(relay_state.running & bit)}, "started": {started}, '
+               f'"remaining": {remaining}}}').encode()
+    yield b"]}"
+
+
+def set_remote_relay(i, on):
+    """
+    Turns a relay on or off for the HTTP API.
+
+    On holds the relay on like its manual button until it is turned off over the API.  Off releases that hold and
+    also ends a scheduled run.  A manual button that is held keeps its relay on.
+
+    :parameters:
+        i (int): Index of the relay.
+        on (bool): True to turn the relay on.
+
+    :returns: None
+    """
+    global remote_relays
+    bit = 1 << i
+    if on:
+        remote_relays |= bit
+    else:
+        remote_relays &= ~bit
+        if relay_state.running & bit:
+            relay_outputs.off(i)
+            if enable_logging and relay_state.logged & bit:
+                log_event(EVENT_SCHEDULE_OFF, i)
+                relay_state.logged &= ~bit
+            relay_state.stop(bit)
+            schedule_changed.set()
+    buttons_changed.set()  # check_manual_button() turns the relay on or off, buttons_task() writes it
+
+
+def schedule_uploaded(filename):
+    """
+    Installs the schedule of a PUT /schedule upload before it replaces the schedule file, and wakes schedule_task()
+    to plan with it.
+
+    Answers 500 if the new schedule could not be installed.  The upload is then deleted, so the schedule file and the
+    schedule the controller runs stay the old ones.
+
+    :parameters:
+        filename (str): The complete upload, renamed over the schedule file by FileUpload after a 204.
+    """
+    try:
+        install_schedule(force=True, filename=filename)
+    except Exception as e:
+        print(f"Error loading schedule data: {e}")
+        log_data(f"Schedule uploaded over HTTP but not loaded: {e}")
+        return error_response(500, str(e))
+    log_data("Schedule file updated over HTTP")
+    schedule_changed.set()
+    # Renaming keeps the upload's size and modification time, so its ETag is the schedule file's once it is in place.
+    return Response(204, etag=schedule_etag(filename))
+
+
+def handle_api_request(request):
+    """
+    Answers an HTTP API request, see http_api_enabled for the requests it understands.
+
+    :parameters:
+        request (Request): The request, with its headers.
+
+    :returns:
+        response (Response or FileUpload): The answer, or a FileUpload that receives the new schedule for PUT.
+    """
+    if request.path == "/schedule":
+        etag = schedule_etag()
+        if request.method == "GET":
+            if etag_matches(request.headers.get("if-none-match"), etag):
+                return Response(304, etag=etag)
+            return Response(200, file_chunks(schedule_filename), etag=etag,
+                            length=file_signature(schedule_filename)[0])
+        if request.method == "PUT":
+            if_match = request.headers.get("if-match")
+            if if_match is not None and not etag_matches(if_match, etag):
+                return error_response(412, "The schedule has changed")
+            return FileUpload(schedule_filename, load_schedule, schedule_uploaded)
+        return error_response(405)
+
+    if request.path == "/relays":
+        if request.method != "GET":
+            return error_response(405)
+        etag = relay_status_etag()
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(304, etag=etag)
+        return Response(200, relay_status_chunks(), etag=etag)
+
+    # /relays/N/on and /relays/N/off
+    parts = request.path.split("/")
+    if len(parts) == 4 and parts[1] == "relays" and parts[3] in ("on", "off"):
+        if request.method != "POST":
+            return error_response(405)
+        try:
+            i = int(parts[2])
+        except ValueError:
+            return error_response(404)
+        if not 0 <= i < len(relays):
+            return error_response(404, "No such relay")
+        set_remote_relay(i, parts[3] == "on")
+        return Response(204)
+    return error_response(404)
+
+
+async def api_task():
+    """
+    Task that serves the HTTP API, polling the server every http_api_poll_interval seconds.
+
+    The server starts once the RTC is set and Wi-Fi is connected.  While a client is connected it is polled again as
+    soon as the other tasks have had their turn.
+
+    :returns: None
+    """
+    global http_server
+    await clock_ready.wait()
+    while wifi.radio.ipv4_address is None:
+        await wifi_connect(max_retries=3, retry_interval=10)
+        if wifi.radio.ipv4_address is None:
+            await asyncio.sleep(clock_check_interval)
+    network_session()
+    http_server = HttpServer(socket_pool, handle_api_request, http_api_port)
+    http_server.start(str(wifi.radio.ipv4_address))
+    if debug: print(f"HTTP API listening on port {http_api_port}")
+    try:
+        while True:
+            http_server.poll()
+            if http_server.busy():
+                await asyncio.sleep(0)
+                continue
+            # Keeps low power sleep from stopping the server.
+            wakeups.set(EVENT_API, time.monotonic() + http_api_poll_interval)
+            await asyncio.sleep(http_api_poll_interval)
+    finally:
+        http_server.stop()
+
+
+def task_error(name, error):
+    """
+    Reports an error that stopped a task, before the task is started again.
+
+    :parameters:
+        name (str): Name of the task.
+        error (Exception): The error.
+
+    :returns: None
+    """
+    print(f"Main Loop Error in {name} task: {error}")
+    flash_led(3, 0.1, 0.1)  # Flash the LED three times to indicate a main loop error
+
+
+async def run_task(name, task, *args):
+    """
+    Runs a task and starts it again a second after any error, so one failure doesn't stop the controller.
+
+    :parameters:
+        name (str): Name of the task, for error messages.
+        task (function): The task's async function.
+        args: Arguments for the task.
+
+    :returns: None
+    """
+    while True:
+        try:
+            await task(*args)
+            return
+        except Exception as error:
+            task_error(name, error)
+            await asyncio.sleep(1)  # Wait for 1 second before continuing
+
+
+async def run_tasks():
+    """
+    Runs the controller: restores the state saved before a deep sleep, then runs every task until the program stops.
+
+    :returns: None
+    """
+    rtc_restored = restore_after_deep_sleep()
+    tasks = [
+        run_task("led", led_task),
+        run_task("buttons", buttons_task),
+        run_task("log", log_task),
+        run_task("clock", clock_task, rtc_restored),
+        run_task("schedule", schedule_task),
+    ]
+    if http_api_enabled:
+        tasks.append(run_task("api", api_task))
+    await asyncio.gather(*tasks)
+
+
 def main_loop():
     """
     The main loop of the program responsible for managing relay control and scheduling.
@@ -594,94 +1808,24 @@ def main_loop():
     The loop iterates through each relay, checks for manual activation, checks the scheduling status,
     activates relays based on schedules, and handles the pausing of schedules. It also prints the Pico's uptime
     and the properties of each relay for debugging purposes.
+    The work is split into cooperative asyncio tasks run by run_tasks(): the buttons, the schedule, the log, the
+    clock and the LED.  Each waits until the next thing it has to do without blocking the others, so the relays are
+    switched on time while the network is retried or the LED flashes.
     """
     try:
-        # Attempt to connect to Wi-Fi
-        wifi_connect(max_retries=3, retry_interval=10, simulate_failure=False)
-
-        # Get current local day of the week and time from the Internet and update RTC
-        set_rtc_datetime()
-
-        while True:
-            try:
-                if debug: print("Entering main loop...")
-
-                # Get the current date and time from the Pico's Real-Time Clock (RTC).
-                current_date_time = rtc.RTC().datetime
-                current_day = current_date_time.tm_wday  # Extract the current day of the week (0-6, Monday is 0)
-                current_time = (current_date_time.tm_hour, current_date_time.tm_min)  # Current time as (hour, minute)
-
-                if debug:
-                    # Define a list of weekday names for debug use
-                    weekday_names = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-                    print("Current day:", current_day, "(", weekday_names[current_day], ")")
-                    print("Current Real Time:", f"{current_time[0]:02d}:{current_time[1]:02d}")
-                    print(f"Current Structured Time: {current_time}")
-
-                check_manual_button()  # Check for any manual buttons being pushed
-                load_schedule_data()  # Reload schedule data
-
-                if pause_schedule_button.value:
-                    if debug: print("Scheduling active")
-                    for i in range(len(relays)):
-                        # Check if the relays watering time matches current time and get the duration
-                        watering_result, watering_duration = is_watering_time(i, current_time)
-                        if is_watering_day(i, current_day) and watering_result:
-                            if not manual_activation_flags[i] and end_time[i] == -1:
-                                # Activate relay and set its start and end times
-                                relays[i].value = RELAY_ACTIVE
-                                start_time[i] = rtc.RTC().datetime
-                                end_time[i] = calculate_end_time(start_time[i], watering_duration)
-                                schedule_running[i] = True
-
-                                if enable_logging and not event_logged[i]:
-                                    # Log the scheduled relay event
-                                    log_data(f"Relay {i}: was activated via schedule.")
-                                    event_logged[i] = True
-
-                            else:
-                                if debug: print(f"Relay {i} for Garden Bed {i + 1} was manually activated")
-
-                        if schedule_running[i] and end_time[i] <= rtc.RTC().datetime:
-                            # Deactivate relay if the end time is reached
-                            relays[i].value = RELAY_INACTIVE
-                            schedule_running[i] = False
-                            end_time[i] = -1
-
-                            if enable_logging and event_logged[i]:
-                                # Log the deactivation of relay
-                                log_data(f"Relay {i}: was deactivated via schedule.")
-                                event_logged[i] = False
-
-                else:
-                    if debug: print("Scheduling paused")
-                    for i in range(len(relays)):
-                        if not manual_activation_flags[i]:
-                            # Deactivate relay if scheduling is paused
-                            relays[i].value = RELAY_INACTIVE
-                            schedule_running[i] = False
-                            end_time[i] = -1
-
-                if debug: print_relay_properties()
-
-                if enable_logging:
-                    log_cpu_temp()  # Log CPU temperature if logging is enabled
-
-                uptime()  # Print the Pico's uptime for debugging
-                time.sleep(1.5)  # Add a short delay to prevent excessive CPU processing
-
-            except Exception as main_loop_error:
-                # Handle errors that occur in the main loop
-                print(f"Main Loop Error: {main_loop_error}")
-                flash_led(3, 0.1, 0.1)  # Flash the LED three times to indicate a main loop error
-                time.sleep(1)  # Wait for 1 second before continuing
+        asyncio.run(run_tasks())
 
     except Exception as main_error:
-        # Handle errors that occur before entering the main loop
+        # Handle errors that occur outside the tasks
         print(f"Main Error: {main_error}")
-        flash_led(5, 0.1, 0.1)  # Flash the LED five times to indicate a main error
+        asyncio.run(play_led(5, 0.1, 0.1))  # Flash the LED five times to indicate a main error
         time.sleep(1)  # Wait for 1 second before exiting
 
+    finally:
+        flush_log()  # Don't lose buffered log entries when the program stops
+        if loop_profiler.enabled:
+            loop_profiler.print_report()  # Show where the loop spent its time, for example after Ctrl-C
+
 
 # Prepare to run the main loop.
 if __name__ == "__main__":
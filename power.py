@@ -0,0 +1,147 @@
+"""
+Low power sleep between watering events for the Garden Controller.
+
+Most of the day nothing is watering and nobody is pressing buttons, so there is no reason for the Pico to be awake.
+PowerManager puts the Pico into CircuitPython light sleep or deep sleep until either a time alarm fires at the next
+deadline from the main loop, or a pin alarm fires because one of the buttons was pressed.
+
+- Light sleep keeps RAM, so every variable in main.py is exactly as it was when the Pico wakes up.
+- Deep sleep saves the most power but ends with a reset, so main.py starts again from the top.  Before sleeping the
+  relay flags and the RTC date/time are packed into alarm.sleep_memory, and restore_state() unpacks them after the
+  wake so the Pico does not need to connect to the Internet to set its clock again.
+
+The alarm module comes from hal.py.  On a host computer, where CircuitPython's alarm module does not exist, that is
+alarm_host.py, so the power saving path can be run and tested off the device.
+"""
+import struct
+
+from hal import alarm, time
+
+# Power modes.
+# "none" never sleeps, the main loop polls the buttons while waiting for the next deadline.
+# "light" uses light sleep for every wait.
+# "deep" uses deep sleep when the next deadline is at least deep_sleep_min seconds away and light sleep otherwise.
+POWER_NONE = "none"
+POWER_LIGHT = "light"
+POWER_DEEP = "deep"
+
+# Layout of the state saved in alarm.sleep_memory before a deep sleep:
+# magic, date/time as seconds since the epoch (main.py saves UTC), planned sleep in milliseconds, then three 64 bit
+# relay bitmasks for the manual activation flags, schedule running flags and event logged flags (see relay_state.py).
+SLEEP_MEMORY_MAGIC = b"GCPS"
+SLEEP_MEMORY_FORMAT = "<4sIIQQQ"
+SLEEP_MEMORY_SIZE = struct.calcsize(SLEEP_MEMORY_FORMAT)
+
+
+class PowerManager:
+    """
+    Chooses and enters the low power sleep used between watering events.
+
+    :parameters:
+        mode (str): One of POWER_NONE, POWER_LIGHT or POWER_DEEP.
+        deep_sleep_min (float): Shortest sleep, in seconds, worth a deep sleep and the reset that follows it.
+        min_sleep (float): Shorter waits than this are not worth entering any sleep mode.
+    """
+
+    def __init__(self, mode=POWER_LIGHT, deep_sleep_min=300, min_sleep=1):
+        if mode not in (POWER_NONE, POWER_LIGHT, POWER_DEEP):
+            raise ValueError("Invalid power mode specified")
+        self.mode = mode
+        self.deep_sleep_min = deep_sleep_min
+        self.min_sleep = min_sleep
+        self.light_sleeps = 0  # Number of light sleeps entered since start up.
+        self.pin_wakeups = 0  # Number of light sleeps ended by a button rather than the time alarm.
+
+    def enabled(self):
+        return self.mode != POWER_NONE
+
+    def wants_deep_sleep(self, duration):
+        """
+        Returns True if a sleep of the given number of seconds should be a deep sleep.
+        """
+        return self.mode == POWER_DEEP and duration >= self.deep_sleep_min
+
+    def pin_alarms(self, watch_pins):
+        """
+        Builds a PinAlarm for every watched pin that is currently released (HIGH).
+
+        The buttons are wired to ground with pull-ups, so each alarm waits for its pin to go LOW.  A pin that is
+        already LOW (a latched button) cannot be watched for its release because the alarm would have to use a
+        pull-down, so it is left out and noticed at the next timed wake instead.
+
+        :parameters:
+            watch_pins (list): List of (pin, value) pairs giving each board pin and its current value.
+        """
+        return [alarm.pin.PinAlarm(pin, value=False, pull=True) for pin, value in watch_pins if value]
+
+    def light_sleep(self, wake_at, watch_pins):
+        """
+        Light sleeps until time.monotonic() reaches wake_at or a watched pin goes LOW.
+
+        The pins in watch_pins must not be in use (deinit() their DigitalInOut objects first).
+
+        :returns:
+            woken_by_pin (bool): True if a button ended the sleep.
+        """
+        alarms = self.pin_alarms(watch_pins)
+        alarms.append(alarm.time.TimeAlarm(monotonic_time=wake_at))
+        self.light_sleeps += 1
+        woke = alarm.light_sleep_until_alarms(*alarms)
+        woken_by_pin = isinstance(woke, alarm.pin.PinAlarm)
+        if woken_by_pin:
+            self.pin_wakeups += 1
+        return woken_by_pin
+
+    def deep_sleep(self, duration, watch_pins, epoch_time, manual_mask, running_mask, logged_mask):
+        """
+        Saves the controller state to sleep memory and deep sleeps for duration seconds or until a button is pressed.
+
+        This function does not return on the Pico, the program starts again from the top when the Pico wakes.
+
+        :parameters:
+            duration (float): Seconds to sleep.
+            watch_pins (list): List of (pin, value) pairs for the buttons that can wake the Pico.
+            epoch_time (int): The date/time as seconds since the epoch, restored by restore_state().
+            manual_mask, running_mask, logged_mask (int): Relay flag bitmasks to restore after the wake.
+        """
+        self.save_state(epoch_time, duration, manual_mask, running_mask, logged_mask)
+        alarms = self.pin_alarms(watch_pins)
+        alarms.append(alarm.time.TimeAlarm(monotonic_time=time.monotonic() + duration))
+        alarm.exit_and_deep_sleep_until_alarms(*alarms)
+
+    def save_state(self, epoch_time, duration, manual_mask, running_mask, logged_mask):
+        """
+        Packs the date/time, the planned sleep and the relay flag bitmasks into alarm.sleep_memory.
+        """
+        alarm.sleep_memory[:SLEEP_MEMORY_SIZE] = struct.pack(
+            SLEEP_MEMORY_FORMAT, SLEEP_MEMORY_MAGIC, int(epoch_time), int(duration * 1000),
+            manual_mask, running_mask, logged_mask)
+
+    def restore_state(self):
+        """
+        Returns the state saved before a deep sleep if the program is starting because a deep sleep alarm fired.
+
+        The saved state is cleared so a later normal reset does not restore it again.
+
+        :returns:
+            state (dict): None after a normal start.  Otherwise a dictionary with "epoch_time", the estimated date/time
+            now ("epoch_time" is only known when the time alarm fired, it is None after a button wake),
+            "woken_by_pin", and the "manual_mask", "running_mask" and "logged_mask" relay bitmasks.
+        """
+        if alarm.wake_alarm is None:
+            return None
+        magic, epoch_time, duration_ms, manual_mask, running_mask, logged_mask = struct.unpack(
+            SLEEP_MEMORY_FORMAT, bytes(alarm.sleep_memory[:SLEEP_MEMORY_SIZE]))
+        if magic != SLEEP_MEMORY_MAGIC:
+            return None
+        alarm.sleep_memory[:4] = b"\x00\x00\x00\x00"  # Clear the magic so the state is only restored once.
+
+        woken_by_pin = isinstance(alarm.wake_alarm, alarm.pin.PinAlarm)
+        return {
+            # After a time alarm the Pico slept exactly as planned, after a button wake the elapsed time is unknown.
+            "epoch_time": None if woken_by_pin else epoch_time + (duration_ms + 500) // 1000,
+            "woken_by_pin": woken_by_pin,
+            "manual_mask": manual_mask,
+            "running_mask": running_mask,
+            "logged_mask": logged_mask,
+        }
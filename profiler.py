@@ -0,0 +1,169 @@
+"""
+Per-phase timing of the Garden Controller main loop.
+
+Every pass of the schedule task runs the same phases in the same order: the schedule file check, the schedule
+evaluation, the uptime print and the wait until the next event.  LoopProfiler reads time.monotonic_ns() at the start of
+the pass and again at the end of each phase.  The manual buttons and the CPU temperature log run in tasks of their own
+and time themselves with record_since().  The time each phase took goes into a latency histogram with fixed buckets
+(under 100 us, under 1 ms, ... 10 s and over).  It also keeps the longest time seen for every phase, both since start up
+and since the last call to end_window(), so an occasional multi-second stall shows up against the phase that caused it.
+
+All counters live in arrays allocated when the profiler is created, so profiling a pass allocates no memory.
+
+Reading the results from the REPL: import main instead of letting it run as main.py, start the loop with
+main.main_loop(), stop it with Ctrl-C and then call main.loop_profiler.print_report().  main.py also prints the
+report when the loop stops, and can log the longest time of every phase periodically (see profile_log_interval).
+
+The clock comes from hal.py so the module runs the same on the Pico and on a host computer.
+"""
+from array import array
+
+from hal import time
+
+# Main loop phases, in the order they run.
+PHASE_BUTTONS = 0  # Reading the buttons and check_manual_button(), timed by the buttons task.
+PHASE_SCHEDULE_LOAD = 1  # load_schedule_data().
+PHASE_SCHEDULE = 2  # Starting and stopping relays on schedule, or turning them off while paused.
+PHASE_CPU_LOG = 3  # log_cpu_temp() and time based log flushes, timed by the log task.
+PHASE_UPTIME = 4  # uptime() printing.
+PHASE_SLEEP = 5  # Planning the wakeups and waiting for the next event, while the other tasks run.
+PHASE_NAMES = ("buttons", "schedule_load", "schedule", "cpu_log", "uptime", "sleep")
+
+# Upper limits of the histogram buckets in microseconds.  A last bucket holds everything at or over the last limit.
+BUCKET_LIMITS_US = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+# Largest value an "L" array element holds, longer times are clamped to it (about 71 minutes in microseconds).
+MAX_US = 0xFFFFFFFF
+
+
+def format_us(microseconds):
+    """
+    Formats a time in microseconds with a unit that keeps it short, for example "850us", "12.5ms" or "3.20s".
+    """
+    if microseconds < 1_000:
+        return f"{microseconds}us"
+    if microseconds < 1_000_000:
+        return f"{microseconds / 1_000:.1f}ms"
+    return f"{microseconds / 1_000_000:.2f}s"
+
+
+class LoopProfiler:
+    """
+    Latency histograms and maximum times for each phase of the main loop.
+
+    Call start() at the top of a pass and mark(phase) at the end of each phase.  The time since the previous start()
+    or mark() is charged to the phase.
+
+    :parameters:
+        phase_names (tuple): Name of each phase, phases are numbered by their position.
+        bucket_limits_us (tuple): Ascending upper limits of the histogram buckets in microseconds.
+        enabled (bool): If False, start() and mark() return at once and nothing is recorded.
+    """
+
+    def __init__(self, phase_names=PHASE_NAMES, bucket_limits_us=BUCKET_LIMITS_US, enabled=True):
+        self.phase_names = phase_names
+        self.bucket_limits_us = bucket_limits_us
+        self.enabled = enabled
+        self.buckets = len(bucket_limits_us) + 1
+        phases = len(phase_names)
+        # counts[phase * buckets + bucket] is the number of times the phase took a time in that bucket.
+        self.counts = array("L", [0] * (phases * self.buckets))
+        self.max_us = array("L", [0] * phases)  # Longest time of each phase since start up or reset().
+        self.window_max_us = array("L", [0] * phases)  # Longest time of each phase since end_window().
+        self.last_us = array("L", [0] * phases)  # Time each phase took in the latest pass.
+        self.passes = 0
+        self.stamp = 0  # time.monotonic_ns() at the last start() or mark().
+
+    def start(self):
+        """
+        Marks the start of a pass of the main loop.
+        """
+        if self.enabled:
+            self.passes += 1
+            self.stamp = time.monotonic_ns()
+
+    def mark(self, phase):
+        """
+        Marks the end of a phase and records the time it took.
+        """
+        if self.enabled:
+            now = time.monotonic_ns()
+            self.record(phase, (now - self.stamp) // 1000)
+            self.stamp = now
+
+    def record_since(self, phase, started_ns):
+        """
+        Records the time since started_ns, a time.monotonic_ns() value, against a phase that is timed on its own.
+        """
+        if self.enabled:
+            self.record(phase, (time.monotonic_ns() - started_ns) // 1000)
+
+    def record(self, phase, elapsed_us):
+        """
+        Adds one time, in microseconds, to a phase's histogram and maximums.
+        """
+        if elapsed_us > MAX_US:
+            elapsed_us = MAX_US
+        bucket = 0
+        for limit in self.bucket_limits_us:
+            if elapsed_us < limit:
+                break
+            bucket += 1
+        self.counts[phase * self.buckets + bucket] += 1
+        self.last_us[phase] = elapsed_us
+        if elapsed_us > self.max_us[phase]:
+            self.max_us[phase] = elapsed_us
+        if elapsed_us > self.window_max_us[phase]:
+            self.window_max_us[phase] = elapsed_us
+
+    def histogram(self, phase):
+        """
+        Returns a list with the number of times the phase took a time in each bucket.
+        """
+        first = phase * self.buckets
+        return list(self.counts[first:first + self.buckets])
+
+    def end_window(self):
+        """
+        Returns the longest time of each phase, in microseconds, since the last call and starts a new window.
+        """
+        window = list(self.window_max_us)
+        for phase in range(len(self.window_max_us)):
+            self.window_max_us[phase] = 0
+        return window
+
+    def reset(self):
+        """
+        Clears every histogram and maximum.
+        """
+        for values in (self.counts, self.max_us, self.window_max_us, self.last_us):
+            for i in range(len(values)):
+                values[i] = 0
+        self.passes = 0
+
+    def bucket_labels(self):
+        """
+        Returns a short label for each histogram bucket, for example "<1.0ms" and ">=10.00s".
+        """
+        labels = [f"<{format_us(limit)}" for limit in self.bucket_limits_us]
+        labels.append(f">={format_us(self.bucket_limits_us[-1])}")
+        return labels
+
+    def report(self):
+        """
+        Returns the histograms and maximums as a list of text lines, one line per phase.
+        """
+        labels = self.bucket_labels()
+        lines = [f"Loop passes: {self.passes}"]
+        for phase, name in enumerate(self.phase_names):
+            histogram = " ".join(f"{label}:{count}" for label, count in zip(labels, self.histogram(phase)) if count)
+            lines.append(f"{name}: max {format_us(self.max_us[phase])}, last {format_us(self.last_us[phase])}, "
+                         f"{histogram or 'no samples'}")
+        return lines
+
+    def print_report(self):
+        """
+        Prints report() to the REPL.
+        """
+        for line in self.report():
+            print(line)
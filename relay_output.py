@@ -0,0 +1,97 @@
+"""
+Shadow register for the Garden Controller's relay outputs.
+
+main.py used to set relays[i].value wherever it decided a relay should change, so one pass of the loop could write
+the same pin several times, for example turning a relay off when its scheduled run ends and on again when its manual
+button is still held.  Each write is a call into the GPIO driver, and a relay that chatters on and off within a pass
+shows up nowhere.
+
+RelayOutputs keeps the state every relay should be in as a bitmask, bit i for relay i, separate from the state last
+written to the pins.  The code that decides what a relay does only changes the mask.  apply(), called once at the
+end of each pass of a task, compares the two masks and writes only the pins whose state differs, so a relay that is
+turned off and on again within a pass is never written, and a pass that changes nothing writes nothing.  Every pin
+write is a real on/off transition and is counted per relay for monitoring.
+
+The pins are passed in, anything with a value attribute will do.
+"""
+from array import array
+
+from relay_state import iter_bits
+
+
+class RelayOutputs:
+    """
+    The wanted and applied on/off state of a set of relay outputs.
+
+    Attributes:
+        wanted (int): Relays that should be on.
+        applied (int): Relays last written on.
+        transitions (array): Number of times each relay was switched on or off.
+        applies (int): Number of apply() calls that wrote at least one pin.
+
+    :parameters:
+        pins (list): DigitalInOut outputs driving the relays, already set as outputs.
+        active_value (bool): Pin value that turns a relay on, False for active LOW relay modules.
+    """
+
+    def __init__(self, pins, active_value=False):
+        self.pins = pins
+        self.active_value = active_value
+        self.wanted = 0
+        self.applied = 0
+        self.transitions = array("L", [0] * len(pins))
+        self.applies = 0
+        # Start with every relay off, whatever the pins were left at.
+        for pin in pins:
+            pin.value = not active_value
+
+    def on(self, relay):
+        """
+        Asks for a relay to be turned on at the next apply().
+        """
+        self.wanted |= 1 << relay
+
+    def off(self, relay):
+        """
+        Asks for a relay to be turned off at the next apply().
+        """
+        self.wanted &= ~(1 << relay)
+
+    def set_mask(self, mask, on):
+        """
+        Asks for every relay in mask to be turned on or off at the next apply().
+        """
+        if on:
+            self.wanted |= mask
+        else:
+            self.wanted &= ~mask
+
+    def is_on(self, relay):
+        """
+        Returns True if the relay was last written on.
+        """
+        return bool(self.applied & (1 << relay))
+
+    def apply(self):
+        """
+        Writes the pins of the relays whose wanted state differs from the applied state.
+
+        :returns:
+            changed (int): Mask of the relays written, 0 if nothing changed.
+        """
+        changed = self.wanted ^ self.applied
+        if not changed:
+            return 0
+        active_value = self.active_value
+        for i in iter_bits(changed):
+            self.pins[i].value = active_value if self.wanted & (1 << i) else not active_value
+            self.transitions[i] += 1
+        self.applied = self.wanted
+        self.applies += 1
+        return changed
+
+    def total_transitions(self):
+        """
+        Returns the number of on/off transitions of all relays together.
+        """
+        return sum(self.transitions)
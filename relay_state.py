@@ -0,0 +1,120 @@
+"""
+Relay state table for the Garden Controller.
+
+main.py used to keep the state of each relay in five parallel lists: manual activation flags, schedule running
+flags, event logged flags, start times (struct_time objects) and end times (-1 or struct_time objects).  Every
+element was a separate Python object, and questions like "is any relay on?" meant walking whole lists.
+
+RelayState packs the three flags into one bitmask integer each, bit i for relay i, and keeps the times in two
+array("l") arrays.  Start times are RTC seconds since the epoch, for display only.  Stop times are deadlines in whole
+seconds of the monotonic clock, so setting the RTC while a relay runs (set_rtc_datetime()) neither cuts the run
+short nor stretches it.  Questions about all relays at once are a few integer operations on the masks, for example
+idle() or due(now), and iter_bits() visits only the relays whose bit is set.
+The table's size is fixed when it is created, so 32 or 64 zones cost a few hundred bytes of heap.
+
+Masks up to 30 relays are small integers on CircuitPython.  Beyond that they are long integers, which still work but
+allocate when they change.
+"""
+from array import array
+
+# Start or stop time of a relay that is not running on schedule.
+NO_TIME = -1
+
+# Most relays a RelayState can hold, the masks are saved as 64 bit values before a deep sleep.
+MAX_RELAYS = 64
+
+
+def iter_bits(mask):
+    """
+    Yields the index of every set bit in mask, lowest first.
+    """
+    i = 0
+    while mask:
+        if mask & 1:
+            yield i
+        mask >>= 1
+        i += 1
+
+
+class RelayState:
+    """
+    The state of every relay, as bitmasks and arrays of times.
+
+    Attributes:
+        manual (int): Relays turned on by their manual button.
+        running (int): Relays running under the watering schedule.
+        logged (int): Relays whose turning on has been logged, so the turning off is logged too.
+        start_time (array): RTC seconds since the epoch each scheduled run started, NO_TIME while the relay is not
+            running on schedule.
+        stop_at (array): Whole seconds of time.monotonic() at which each scheduled run ends, NO_TIME while the relay
+            is not running on schedule.
+
+    :parameters:
+        count (int): Number of relays, at most MAX_RELAYS.
+    """
+
+    def __init__(self, count):
+        if not 0 < count <= MAX_RELAYS:
+            raise ValueError(f"A RelayState holds 1 to {MAX_RELAYS} relays")
+        self.count = count
+        self.all = (1 << count) - 1
+        self.manual = 0
+        self.running = 0
+        self.logged = 0
+        self.start_time = array("l", [NO_TIME] * count)
+        self.stop_at = array("l", [NO_TIME] * count)
+
+    def start(self, relay, start_time, stop_at):
+        """
+        Marks a relay as running on schedule from start_time (RTC seconds since the epoch) until stop_at (monotonic
+        seconds).
+        """
+        self.running |= 1 << relay
+        self.start_time[relay] = start_time
+        self.stop_at[relay] = stop_at
+
+    def stop(self, mask):
+        """
+        Marks every relay in mask as no longer running on schedule.
+        """
+        stopping = self.running & mask
+        self.running &= ~mask
+        for relay in iter_bits(stopping):
+            self.start_time[relay] = NO_TIME
+            self.stop_at[relay] = NO_TIME
+
+    def scheduled(self, relay):
+        """
+        Returns True if the relay has a scheduled stop time.
+        """
+        return self.stop_at[relay] != NO_TIME
+
+    def not_manual(self):
+        """
+        Returns the mask of relays that are not held on by their manual button.
+        """
+        return self.all & ~self.manual
+
+    def idle(self):
+        """
+        Returns True if no relay is running on schedule or held on by its manual button.
+        """
+        return not (self.running | self.manual)
+
+    def due(self, now):
+        """
+        Returns the mask of running relays whose stop time is at or before now (whole seconds of time.monotonic()).
+        """
+        due = 0
+        for relay in iter_bits(self.running):
+            if self.stop_at[relay] <= now:
+                due |= 1 << relay
+        return due
+
+    def restore(self, manual, running, logged):
+        """
+        Restores the flag masks saved before a deep sleep.  Relays that were running have no stop time to restore.
+        """
+        self.manual = manual & self.all
+        self.running = running & self.all
+        self.logged = logged & self.all
@@ -0,0 +1,153 @@
+"""
+Host-side benchmark comparing the compiled schedule index with the original per-relay schedule scan.
+
+The original main loop called is_watering_day() and is_watering_time() for every relay on every tick.  The compiled
+index in water_schedule.py replaces that with one dictionary lookup per tick.  This script times both approaches over
+every minute of a week for Water_Schedule.json and for synthetic schedules with more zones and watering times.
+
+It also times loading each schedule at start up: parsing and compiling the JSON, against reading the binary
+schedule cache (see write_cache() and read_cache()).
+
+Run it on a host computer (not the Pico):
+    python schedule_benchmark.py
+"""
+import json
+import os
+import tempfile
+import time
+
+from water_schedule import Schedule, MINUTES_PER_DAY, load_schedule, write_cache, read_cache
+
+# Number of times to replay a full week of minutes for each measurement.
+repeat = 3
+
+
+def is_watering_day(watering_days, relay_bed_index, current_day):
+    """
+    Copy of the original per-relay day check from main.py.
+    """
+    if 7 in watering_days[relay_bed_index]:
+        return True
+    return current_day in watering_days[relay_bed_index]
+
+
+def is_watering_time(watering_times, relay_bed_index, current_time):
+    """
+    Copy of the original per-relay time check from main.py.
+    """
+    for watering_time in watering_times[relay_bed_index]:
+        if current_time == tuple(watering_time[:2]):
+            return True, watering_time[2]
+    return False, 0
+
+
+def scan_tick(schedule, current_day, current_time):
+    """
+    Finds the relays to start using the original scan over every relay.
+    """
+    starts = []
+    for i in range(len(schedule.watering_days)):
+        watering_result, watering_duration = is_watering_time(schedule.watering_times, i, current_time)
+        if is_watering_day(schedule.watering_days, i, current_day) and watering_result:
+            starts.append((i, watering_duration))
+    return starts
+
+
+def index_tick(schedule, current_day, current_time):
+    """
+    Finds the relays to start using the compiled activation index.
+    """
+    return schedule.starts_at(current_day, current_time[0], current_time[1])
+
+
+def synthetic_schedule(zones, times_per_zone):
+    """
+    Builds a schedule with the given number of zones, each watering several times a day on alternating days.
+    """
+    watering_days = {}
+    watering_times = {}
+    for zone in range(zones):
+        name = f"relay{zone:02d}"
+        watering_days[name] = [7] if zone % 3 == 0 else [day for day in range(7) if (day + zone) % 2 == 0]
+        watering_times[name] = [[(zone + 3 * n) % 24, (zone * 7 + n * 11) % 60, 5] for n in range(times_per_zone)]
+    return Schedule.from_data({"watering_days": watering_days, "watering_times": watering_times})
+
+
+def time_week(tick, schedule):
+    """
+    Replays every minute of a week through the tick function and returns the average cost per tick in microseconds.
+    """
+    minutes = [(day, (minute // 60, minute % 60)) for day in range(7) for minute in range(MINUTES_PER_DAY)]
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for current_day, current_time in minutes:
+            tick(schedule, current_day, current_time)
+    elapsed = time.perf_counter() - started
+    return elapsed / (repeat * len(minutes)) * 1e6
+
+
+def check_same_results(schedule):
+    """
+    Confirms the index and the scan agree for every minute of the week.
+    """
+    for day in range(7):
+        for minute in range(MINUTES_PER_DAY):
+            current_time = (minute // 60, minute % 60)
+            if sorted(scan_tick(schedule, day, current_time)) != list(index_tick(schedule, day, current_time)):
+                raise AssertionError(f"Schedule mismatch on day {day} at {current_time}")
+
+
+def time_loads(schedule):
+    """
+    Returns the average time in microseconds to load the schedule from JSON and from the binary cache.
+    """
+    directory = tempfile.mkdtemp()
+    json_filename = os.path.join(directory, "schedule.json")
+    cache_filename = os.path.join(directory, "schedule.bin")
+    watering_days = dict(zip(schedule.relay_order, schedule.watering_days))
+    watering_times = dict(zip(schedule.relay_order, schedule.watering_times))
+    with open(json_filename, "w") as file:
+        json.dump({"watering_days": watering_days, "watering_times": watering_times}, file)
+    signature = (0, 0)
+    write_cache(cache_filename, schedule, signature)
+    loads = 20 * repeat
+    try:
+        started = time.perf_counter()
+        for _ in range(loads):
+            load_schedule(json_filename)
+        json_cost = (time.perf_counter() - started) / loads * 1e6
+        started = time.perf_counter()
+        for _ in range(loads):
+            cached = read_cache(cache_filename, signature)
+        cache_cost = (time.perf_counter() - started) / loads * 1e6
+        if {key: cached.index[key] for key in cached.index} != schedule.index or \
+                cached.watering_times != schedule.watering_times:
+            raise AssertionError("Cached schedule differs")
+    finally:
+        os.remove(json_filename)
+        os.remove(cache_filename)
+        os.rmdir(directory)
+    return json_cost, cache_cost
+
+
+def main():
+    with open("Water_Schedule.json", "r") as file:
+        schedules = [("Water_Schedule.json", Schedule.from_data(json.load(file)))]
+    for zones, times_per_zone in ((8, 4), (32, 4), (64, 8)):
+        schedules.append((f"{zones} zones x {times_per_zone} times", synthetic_schedule(zones, times_per_zone)))
+
+    print(f"{'Schedule':<26}{'Scan us/tick':>14}{'Index us/tick':>15}{'Speedup':>10}")
+    for name, schedule in schedules:
+        check_same_results(schedule)
+        scan_cost = time_week(scan_tick, schedule)
+        index_cost = time_week(index_tick, schedule)
+        print(f"{name:<26}{scan_cost:>14.2f}{index_cost:>15.2f}{scan_cost / index_cost:>9.1f}x")
+
+    print(f"\n{'Schedule':<26}{'JSON load us':>14}{'Cache load us':>15}{'Speedup':>10}")
+    for name, schedule in schedules:
+        json_cost, cache_cost = time_loads(schedule)
+        print(f"{name:<26}{json_cost:>14.1f}{cache_cost:>15.1f}{json_cost / cache_cost:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""
+Host-side optimizer that moves watering start times apart so fewer valves are open at once.
+
+Water_Schedule.json is written by hand, and with many zones it is easy to start several of them in the same minute.
+The controller then queues them (see sequencer.py), so they start late and the order depends on which was asked for
+first.  This script reads a schedule, moves each watering time by at most its zone's tolerance, and writes a new
+schedule in which as few valves as possible are open at the same time and the watering on each day is packed into
+as short a window as possible.  Days, durations and the number of watering times are never changed.
+
+Each watering time of a relay is one run.  Runs are placed one at a time, longest first, into a load profile that
+counts the open valves in every minute of the week.  Each run goes to the start time in its tolerance band where:
+1. the most valves open during the run, counting itself, is lowest,
+2. then the sum of the valves already open during the run is lowest,
+3. then the watering window of its days grows least,
+4. then it moves least from its original time.
+Every run is then taken out and placed again against all the others, until a pass moves nothing.  A run never
+overlaps another run of the same relay, because the controller would skip the second start, and never moves past
+midnight, because the days are shared by all of a relay's watering times.
+
+Each zone's tolerance, in minutes either way, is read from an optional "watering_tolerance" section of the schedule,
+for example {"relay4": 30, "relay1": 0}.  Zones not listed use --tolerance.  The controller ignores the section.
+
+Run it on a host computer (not the Pico), with the schedule of every controller to optimize:
+    python schedule_optimizer.py Water_Schedule.json
+    python schedule_optimizer.py --tolerance 30 --output new_schedule.json Water_Schedule.json
+    python schedule_optimizer.py --load-csv load.csv front_yard.json back_yard.json
+
+The new schedule is written next to the original as <name>_optimized.json unless --output is given, followed by a
+report of the load before and after.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+from water_schedule import EVERY_DAY, MINUTES_PER_DAY, MINUTES_PER_WEEK, parse_schedule_data
+
+# Minutes either way a watering time may move when its zone has no tolerance in the schedule.
+DEFAULT_TOLERANCE = 15
+
+# Most passes of taking every run out and placing it again.
+MAX_PASSES = 10
+
+DAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+
+class Run:
+    """
+    One watering time of one relay, on every day the relay waters.
+
+    Attributes:
+        name (str): The relay's name in the schedule, such as "relay4".
+        position (int): Position of the watering time in the relay's watering_times list.
+        days (tuple): Weekdays the relay waters on, 0 is Monday.
+        original (int): Start time in the schedule, in minutes after midnight.
+        start (int): Start time after optimizing, in minutes after midnight.
+        duration (int): Minutes the run lasts.
+        tolerance (int): Most minutes the start may move either way.
+    """
+
+    def __init__(self, name, position, days, start, duration, tolerance):
+        self.name = name
+        self.position = position
+        self.days = days
+        self.original = start
+        self.start = start
+        self.duration = duration
+        self.tolerance = tolerance
+
+    def candidates(self):
+        """
+        Returns the start times the run may move to.
+        """
+        return range(max(0, self.original - self.tolerance),
+                     min(MINUTES_PER_DAY - 1, self.original + self.tolerance) + 1)
+
+    def overlaps(self, other, start):
+        """
+        Returns True if the run, starting at start, overlaps another run in time of day.
+        """
+        return ((start - other.start) % MINUTES_PER_DAY < other.duration or
+                (other.start - start) % MINUTES_PER_DAY < self.duration)
+
+
+def schedule_runs(schedule_data, tolerance=DEFAULT_TOLERANCE):
+    """
+    Splits decoded schedule data into one Run per watering time, using the relays the controller would use.
+
+    :parameters:
+        schedule_data (dict): The decoded contents of a schedule file.
+        tolerance (int): Tolerance of the zones not listed in the "watering_tolerance" section.
+
+    :returns:
+        runs (list): A Run for every watering time of a relay with at least one watering day.
+    """
+    tolerances = schedule_data.get("watering_tolerance", {})
+    relay_order, watering_days, watering_times = parse_schedule_data(schedule_data)
+    runs = []
+    for name, days, times in zip(relay_order, watering_days, watering_times):
+        days = tuple(range(7)) if EVERY_DAY in days else tuple(sorted(set(days)))
+        if not days:
+            continue
+        for position, (hour, minute, duration) in enumerate(times):
+            runs.append(Run(name, position, days, hour * 60 + minute, duration, tolerances.get(name, tolerance)))
+    return runs
+
+
+def run_minutes(run, start):
+    """
+    Yields (first minute of week, number of minutes) for every day of a run starting at start, split where the run
+    wraps from Sunday into Monday.
+    """
+    for day in run.days:
+        first = day * MINUTES_PER_DAY + start
+        if first + run.duration <= MINUTES_PER_WEEK:
+            yield first, run.duration
+        else:
+            yield first, MINUTES_PER_WEEK - first
+            yield 0, first + run.duration - MINUTES_PER_WEEK
+
+
+def add_load(load, run, change):
+    """
+    Adds change to the open valve count of every minute the run waters in.
+    """
+    for first, count in run_minutes(run, run.start):
+        for minute in range(first, first + count):
+            load[minute] += change
+
+
+def load_profile(runs):
+    """
+    Returns the number of open valves in every minute of the week, Monday 00:00 first.
+    """
+    load = [0] * MINUTES_PER_WEEK
+    for run in runs:
+        add_load(load, run, 1)
+    return load
+
+
+def day_spans(runs, skip=None):
+    """
+    Returns the (first start, last stop) of the runs starting on each weekday, None for a day without runs.
+    """
+    spans = [None] * 7
+    for run in runs:
+        if run is skip:
+            continue
+        end = run.start + run.duration
+        for day in run.days:
+            span = spans[day]
+            spans[day] = (run.start, end) if span is None else (min(span[0], run.start), max(span[1], end))
+    return spans
+
+
+def watering_window(runs):
+    """
+    Returns the total over the week of the minutes from each day's first start to its last stop.
+    """
+    return sum(span[1] - span[0] for span in day_spans(runs) if span is not None)
+
+
+def place(run, runs, load):
+    """
+    Moves a run to its best start time against the load of all the other runs.
+
+    The run's own load must already be taken out of the profile, and is not added back.
+
+    :returns:
+        start (int): The new start time, in minutes after midnight.
+    """
+    spans = day_spans(runs, skip=run)
+    siblings = [other for other in runs if other.name == run.name and other is not run]
+    best = None
+    best_start = run.start
+    for start in run.candidates():
+        if any(run.overlaps(other, start) for other in siblings):
+            continue
+        peak = 0
+        overlap = 0
+        for first, count in run_minutes(run, start):
+            minutes = load[first:first + count]
+            peak = max(peak, max(minutes))
+            overlap += sum(minutes)
+        growth = 0
+        for day in run.days:
+            span = spans[day]
+            if span is not None:
+                growth += (max(span[1], start + run.duration) - min(span[0], start)) - (span[1] - span[0])
+        cost = (peak + 1, overlap, growth, abs(start - run.original))
+        if best is None or cost < best:
+            best = cost
+            best_start = start
+    run.start = best_start
+    return best_start
+
+
+def optimize(runs):
+    """
+    Moves the start times of runs to lower the peak number of open valves and pack each day's watering.
+
+    :returns:
+        passes (int): Number of passes over the runs after the first placement.
+    """
+    load = [0] * MINUTES_PER_WEEK
+    placed = []
+    for run in sorted(runs, key=lambda run: (-run.duration, -len(run.days), run.original, run.name)):
+        run.start = run.original
+        place(run, placed + [run], load)
+        add_load(load, run, 1)
+        placed.append(run)
+
+    passes = 0
+    while passes < MAX_PASSES:
+        passes += 1
+        moved = False
+        for run in placed:
+            before = run.start
+            add_load(load, run, -1)
+            place(run, runs, load)
+            add_load(load, run, 1)
+            moved = moved or run.start != before
+        if not moved:
+            break
+    return passes
+
+
+def optimized_data(schedule_data, runs):
+    """
+    Returns a copy of decoded schedule data with the watering times moved to the runs' new start times.
+    """
+    data = dict(schedule_data)
+    data["watering_times"] = {name: [list(time) for time in times]
+                              for name, times in schedule_data["watering_times"].items()}
+    for run in runs:
+        data["watering_times"][run.name][run.position][:2] = [run.start // 60, run.start % 60]
+    return data
+
+
+def format_schedule(data):
+    """
+    Formats schedule data like Water_Schedule.json: each relay's days on one line and each watering time on its own.
+    """
+    sections = []
+    for key, value in data.items():
+        if not isinstance(value, dict):
+            sections.append(f"    {json.dumps(key)}: {json.dumps(value)}")
+            continue
+        entries = []
+        for name, item in value.items():
+            if isinstance(item, list) and item and all(isinstance(entry, list) for entry in item):
+                lines = ",\n".join(f"            {json.dumps(entry)}" for entry in item)
+                entries.append(f"        {json.dumps(name)}: [\n{lines}\n        ]")
+            else:
+                entries.append(f"        {json.dumps(name)}: {json.dumps(item)}")
+        sections.append(f"    {json.dumps(key)}: {{\n" + ",\n".join(entries) + "\n    }")
+    return "{\n" + ",\n".join(sections) + "\n}\n"
+
+
+def format_minute(minute):
+    """
+    Formats a minute of the day as HH:MM.
+    """
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def load_changes(before, after, day):
+    """
+    Returns (minute of the day, valves open before, valves open after) for every minute of a weekday where either
+    count changes.
+    """
+    changes = []
+    base = day * MINUTES_PER_DAY
+    previous = (before[base - 1], after[base - 1])  # Sunday 23:59 for Monday
+    for minute in range(MINUTES_PER_DAY):
+        counts = (before[base + minute], after[base + minute])
+        if counts != previous:
+            changes.append((minute,) + counts)
+            previous = counts
+    return changes
+
+
+def print_report(runs, original_window, before, after, passes):
+    """
+    Prints the peak load, overlap and watering window before and after, the moved runs and the load over time.
+    """
+    rows = (
+        ("Most valves open at once", max(before), max(after)),
+        ("Minutes with 2+ valves open", sum(1 for count in before if count > 1),
+         sum(1 for count in after if count > 1)),
+        ("Valve minutes overlapping", sum(count - 1 for count in before if count > 1),
+         sum(count - 1 for count in after if count > 1)),
+        ("Watering window, minutes a week", original_window, watering_window(runs)),
+    )
+    print(f"  {'':<34}{'Before':>8}{'After':>8}")
+    for label, old, new in rows:
+        print(f"  {label:<34}{old:>8}{new:>8}")
+
+    moved = [run for run in runs if run.start != run.original]
+    print(f"  Moved {len(moved)} of {len(runs)} watering times ({passes} passes):")
+    for run in moved:
+        print(f"    {run.name} {format_minute(run.original)} -> {format_minute(run.start)} "
+              f"({run.start - run.original:+d} min of {run.tolerance}, {run.duration} min run)")
+
+    print("  Open valves over time, before -> after:")
+    for day, day_name in enumerate(DAY_NAMES):
+        changes = load_changes(before, after, day)
+        if changes:
+            text = ", ".join(f"{format_minute(minute)} {old}->{new}" if old != new else
+                             f"{format_minute(minute)} {new}" for minute, old, new in changes)
+            print(f"    {day_name}: {text}")
+
+
+def write_load_csv(filename, loads):
+    """
+    Writes the open valve count of every minute of the week before and after for each schedule.
+    """
+    with open(filename, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["schedule", "weekday", "time", "before", "after"])
+        for name, before, after in loads:
+            for minute in range(MINUTES_PER_WEEK):
+                writer.writerow([name, DAY_NAMES[minute // MINUTES_PER_DAY], format_minute(minute % MINUTES_PER_DAY),
+                                 before[minute], after[minute]])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move watering start times apart so fewer valves are open at once.")
+    parser.add_argument("filenames", nargs="*", default=["Water_Schedule.json"],
+                        help="schedule files to optimize, one per controller")
+    parser.add_argument("--tolerance", type=int, default=DEFAULT_TOLERANCE,
+                        help="minutes either way a watering time may move when its zone has no tolerance in "
+                             "the schedule's watering_tolerance section")
+    parser.add_argument("--output", help="file to write the new schedule to, only with a single schedule")
+    parser.add_argument("--load-csv", help="also write the open valves in every minute of the week to a CSV file")
+    args = parser.parse_args(argv)
+    if args.output and len(args.filenames) > 1:
+        parser.error("--output needs a single schedule file")
+    if args.tolerance < 0:
+        parser.error("--tolerance can't be negative")
+
+    loads = []
+    for filename in args.filenames:
+        with open(filename, "r") as file:
+            schedule_data = json.load(file)
+        runs = schedule_runs(schedule_data, args.tolerance)
+        original_window = watering_window(runs)
+        before = load_profile(runs)
+        passes = optimize(runs)
+        after = load_profile(runs)
+
+        root, extension = os.path.splitext(filename)
+        output = args.output or f"{root}_optimized{extension or '.json'}"
+        with open(output, "w") as file:
+            file.write(format_schedule(optimized_data(schedule_data, runs)))
+        print(f"{filename} -> {output}")
+        print_report(runs, original_window, before, after, passes)
+        loads.append((filename, before, after))
+
+    if args.load_csv:
+        write_load_csv(args.load_csv, loads)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
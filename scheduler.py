@@ -0,0 +1,184 @@
+"""
+Deadline queue for the Garden Controller main loop.
+
+Instead of waking every 1.5 seconds to check whether anything needs doing, the main loop keeps a priority queue of
+the next moments something can happen: the next scheduled relay start, the stop time of every running relay, the
+next CPU temperature log entry, the next flush of the buffered log and the next schedule file check.  The loop then
+sleeps until the earliest of those deadlines (or until a button changes) and does no work in between.
+
+Deadlines are plain numbers in the same units as time.monotonic().  Each event is identified by its kind and relay
+index, and setting an event that is already queued replaces its deadline, so callers never have to remove an old
+entry before rescheduling it.
+
+CircuitPython does not include heapq, so the queue is a small binary heap written out here.
+"""
+
+# Kinds of events the main loop schedules.
+EVENT_START = "start"  # Next scheduled relay start from the watering schedule.
+EVENT_STOP = "stop"  # Scheduled end time of a running relay.
+EVENT_LOG = "log"  # Next CPU temperature log entry.
+EVENT_RELOAD = "reload"  # Next check of the schedule file for changes.
+EVENT_FLUSH = "flush"  # Next time based flush of the buffered event log.
+EVENT_DEBOUNCE = "debounce"  # Moment a changed manual button has been stable long enough to act on.
+EVENT_ZONE = "zone"  # Next daylight saving time change, when the RTC moves to the new UTC offset.
+EVENT_SYNC = "sync"  # Next time sync with the SNTP servers.
+EVENT_STEP = "step"  # Moment clock drift has put the RTC half a second off UTC, when it is stepped back on time.
+EVENT_API = "api"  # Next poll of the HTTP API server for clients.
+
+# Relay index used for events that do not belong to a relay.
+NO_RELAY = -1
+
+
+def _earlier(entry, other):
+    """
+    Returns True if a heap entry sorts before another, by deadline and then by sequence number.
+    """
+    return entry[0] < other[0] or (entry[0] == other[0] and entry[1] < other[1])
+
+
+class DeadlineQueue:
+    """
+    A priority queue of upcoming deadlines, earliest first.
+
+    Entries are kept in a binary heap of [deadline, sequence, kind, relay] lists.  A dictionary maps each
+    (kind, relay) pair to its live heap entry.  Replacing or cancelling an event marks the old heap entry as dead
+    instead of searching the heap for it, and dead entries are discarded when they reach the top.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}  # (kind, relay) -> live heap entry
+        self.sequence = 0  # Tie breaker so events with equal deadlines come out in the order they were set.
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set(self, kind, deadline, relay=NO_RELAY):
+        """
+        Schedules an event, replacing any queued event with the same kind and relay.
+
+        :parameters:
+            kind (str): Event kind, one of the EVENT_* constants.
+            deadline (float): When the event is due, in time.monotonic() seconds.
+            relay (int): Relay index the event belongs to, or NO_RELAY.
+
+        :returns: None
+        """
+        self.cancel(kind, relay)
+        if len(self.heap) > 2 * len(self.entries) + 8:
+            self._compact()  # Before the new entry is live, so it is only pushed once.
+        entry = [deadline, self.sequence, kind, relay]
+        self.sequence += 1
+        self.entries[(kind, relay)] = entry
+        self._push(entry)
+
+    def cancel(self, kind, relay=NO_RELAY):
+        """
+        Removes a queued event if there is one.
+
+        :returns:
+            cancelled (bool): True if an event was removed.
+        """
+        entry = self.entries.pop((kind, relay), None)
+        if entry is None:
+            return False
+        entry[2] = None  # Mark the heap entry as dead, it is discarded when it reaches the top.
+        return True
+
+    def deadline(self, kind, relay=NO_RELAY):
+        """
+        Returns the deadline of a queued event, or None if it is not queued.
+        """
+        entry = self.entries.get((kind, relay))
+        return None if entry is None else entry[0]
+
+    def next_event(self):
+        """
+        Returns the earliest queued event without removing it.
+
+        :returns:
+            event (tuple): (deadline, kind, relay) of the earliest event, or None if the queue is empty.
+        """
+        self._discard_dead()
+        if not self.heap:
+            return None
+        deadline, _, kind, relay = self.heap[0]
+        return deadline, kind, relay
+
+    def next_deadline(self):
+        """
+        Returns the earliest deadline in the queue, or None if the queue is empty.
+        """
+        self._discard_dead()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """
+        Removes and returns every event whose deadline is at or before now, earliest first.
+
+        :parameters:
+            now (float): The current time.monotonic() value.
+
+        :returns:
+            due (list): List of (deadline, kind, relay) tuples.
+        """
+        due = []
+        while True:
+            self._discard_dead()
+            if not self.heap or self.heap[0][0] > now:
+                return due
+            deadline, _, kind, relay = self._pop()
+            del self.entries[(kind, relay)]
+            due.append((deadline, kind, relay))
+
+    def clear(self):
+        """
+        Removes every queued event.
+        """
+        self.heap = []
+        self.entries = {}
+
+    def _compact(self):
+        # Rebuild the heap from the live entries when dead entries start to pile up behind later deadlines.
+        self.heap = []
+        for entry in self.entries.values():
+            self._push(entry)
+
+    def _discard_dead(self):
+        while self.heap and self.heap[0][2] is None:
+            self._pop()
+
+    def _push(self, entry):
+        heap = self.heap
+        heap.append(entry)
+        # Sift the new entry up until its parent is earlier.
+        position = len(heap) - 1
+        while position:
+            parent = (position - 1) >> 1
+            if not _earlier(entry, heap[parent]):
+                break
+            heap[position] = heap[parent]
+            position = parent
+        heap[position] = entry
+
+    def _pop(self):
+        heap = self.heap
+        last = heap.pop()
+        if not heap:
+            return last
+        top = heap[0]
+        # Move the last entry to the top and sift it down below any earlier child.
+        size = len(heap)
+        position = 0
+        while True:
+            child = 2 * position + 1
+            if child >= size:
+                break
+            if child + 1 < size and _earlier(heap[child + 1], heap[child]):
+                child += 1
+            if not _earlier(heap[child], last):
+                break
+            heap[position] = heap[child]
+            position = child
+        heap[position] = last
+        return top
@@ -0,0 +1,141 @@
+"""
+Zone sequencing for the Garden Controller.
+
+The watering schedule can start several zones in the same minute.  Water_Schedule.json starts relay0, relay4 and
+relay6 at 18:45, and main.py used to open every one of those solenoids at once.  Each 12 V solenoid draws its inrush
+and holding current from the solar battery, so opening them together makes a current spike and sags the battery
+voltage.
+
+ZoneSequencer sits between the schedule and the relays.  A scheduled start is queued instead of opening the valve, and
+queued zones are opened in the order they were asked for, as long as fewer than max_open valves are open and the
+current of the open zones plus the next one stays within current_budget.  Zones that have to wait run back to back
+as earlier ones stop, and each still runs for its full duration from the moment its valve opens.  If nothing is
+open the next zone always opens, even if its current alone is over the budget, so a zone can't wait forever.
+
+Valves held open by their manual button count towards both limits, but they are never held back themselves.
+
+The sequencer keeps the time every zone waited in the queue: the latest and longest delay of each zone and the number
+of its starts that were delayed, plus the highest total current of the open valves.
+"""
+from array import array
+
+from relay_state import iter_bits
+
+
+class ZoneSequencer:
+    """
+    A first in, first out queue of scheduled zone starts, limited by the number of open valves and their current.
+
+    Attributes:
+        queued (int): Mask of the zones waiting in the queue, bit i for relay i.
+        last_delay (array): Seconds each zone waited in the queue before its latest start.
+        max_delay (array): Longest time, in seconds, each zone has waited.
+        delayed (array): Number of starts of each zone that had to wait.
+        peak_current (float): Highest total current, in amps, of the valves open at once.
+
+    :parameters:
+        count (int): Number of zones.
+        max_open (int): Most valves open at once, 0 for no limit.
+        current_budget (float): Most total current, in amps, of the valves open at once, None for no limit.
+        zone_current (list): Current, in amps, each zone's valve draws.  Defaults to 0 for every zone.
+    """
+
+    def __init__(self, count, max_open=0, current_budget=None, zone_current=None):
+        if zone_current is not None and len(zone_current) < count:
+            raise ValueError("zone_current needs a current for every zone")
+        self.count = count
+        self.max_open = max_open
+        self.current_budget = current_budget
+        self.zone_current = zone_current or [0] * count
+        self.queue = []  # Queued zones, oldest first.
+        self.queued = 0
+        self.requested_at = array("l", [0] * count)  # Whole seconds of time.monotonic() each zone was queued at.
+        self.duration = array("H", [0] * count)  # Minutes each queued zone is to run for.
+        self.last_delay = array("l", [0] * count)
+        self.max_delay = array("l", [0] * count)
+        self.delayed = array("H", [0] * count)
+        self.peak_current = 0
+
+    def pending(self):
+        """
+        Returns True if any zone is waiting to open.
+        """
+        return bool(self.queued)
+
+    def request(self, relay, duration, now):
+        """
+        Queues a scheduled start.  A zone that is already queued keeps its place.
+
+        :parameters:
+            relay (int): Index of the zone.
+            duration (int): Minutes the zone is to run for once it opens.
+            now (int): The current whole seconds of time.monotonic().
+        """
+        if self.queued & (1 << relay):
+            return
+        self.queue.append(relay)
+        self.queued |= 1 << relay
+        self.requested_at[relay] = now
+        self.duration[relay] = duration
+
+    def cancel(self, mask):
+        """
+        Drops every queued zone in mask.
+        """
+        if self.queued & mask:
+            self.queue = [relay for relay in self.queue if not mask & (1 << relay)]
+            self.queued &= ~mask
+
+    def clear(self):
+        """
+        Drops every queued zone.
+        """
+        self.cancel(self.queued)
+
+    def current(self, open_mask):
+        """
+        Returns the total current, in amps, of the zones in open_mask.
+        """
+        total = 0
+        for relay in iter_bits(open_mask):
+            total += self.zone_current[relay]
+        return total
+
+    def admit(self, open_mask, now):
+        """
+        Takes the zones that may open now off the front of the queue.
+
+        :parameters:
+            open_mask (int): Mask of the valves that are open, scheduled or held by their manual button.
+            now (int): The current whole seconds of time.monotonic().
+
+        :returns:
+            starts (list): (relay, duration, delay) for each zone to open now, in queue order, where duration is in
+                minutes and delay is the seconds the zone waited.
+        """
+        starts = []
+        open_count = 0
+        for _ in iter_bits(open_mask):
+            open_count += 1
+        current = self.current(open_mask)
+        while self.queue:
+            relay = self.queue[0]
+            if open_count:
+                if self.max_open and open_count >= self.max_open:
+                    break
+                if self.current_budget is not None and current + self.zone_current[relay] > self.current_budget:
+                    break
+            self.queue.pop(0)
+            self.queued &= ~(1 << relay)
+            delay = now - self.requested_at[relay]
+            self.last_delay[relay] = delay
+            if delay > 0:
+                self.delayed[relay] += 1
+                if delay > self.max_delay[relay]:
+                    self.max_delay[relay] = delay
+            open_count += 1
+            current += self.zone_current[relay]
+            starts.append((relay, self.duration[relay], delay))
+        if current > self.peak_current:
+            self.peak_current = current
+        return starts
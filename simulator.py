@@ -0,0 +1,268 @@
+"""
+Accelerated time simulation of the Garden Controller on a host computer.
+
+Runs main.py's own asyncio tasks on the virtual clock from hal_host.py, in a VirtualEventLoop.  Instead of sleeping,
+every wait jumps the clock straight to the next thing a task has to do (a scheduled start, a relay stop, a log entry,
+a button press), so weeks of watering schedule replay in well under a second.  The simulation records:
+- every relay on/off transition with its RTC date/time,
+- every log entry the controller writes (they are kept in memory, no log file is touched),
+- the host CPU time spent in each pass of the schedule task, a stand-in for the per-tick cost on the Pico.
+
+Button presses and pause periods can be scripted so manual runs and rain delays can be replayed too.
+
+Examples:
+    python simulator.py
+    python simulator.py --days 7 --start 2024-06-03 my_schedule.json
+    python simulator.py --press 3,2024-06-05T07:00,10 --pause 2024-06-10T00:00,48 --summary
+"""
+import argparse
+import asyncio
+import calendar
+import contextlib
+import os
+import sys
+import time as host_time
+
+os.environ["GARDEN_HAL"] = "host"
+
+import hal_host
+from event_log import format_record, format_timestamp
+from power import PowerManager, POWER_NONE, POWER_LIGHT
+
+clock = hal_host.time
+
+
+def parse_datetime(text):
+    """
+    Parses "YYYY-MM-DD" or "YYYY-MM-DDTHH:MM" into seconds since the epoch.
+    """
+    for pattern in ("%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(host_time.strptime(text, pattern))
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid date/time {text!r}, expected YYYY-MM-DD or YYYY-MM-DDTHH:MM")
+
+
+class MemoryLog:
+    """
+    Log sink that keeps the records main.py writes in a list instead of a file.
+    """
+    filename = ""  # No file, so main.log_cpu_temp() starts as if the log had never been written.
+
+    def __init__(self):
+        self.records = []
+
+    def write_records(self, records):
+        self.records.extend(records)
+
+
+class Simulation:
+    """
+    Runs main.py on the virtual clock.
+
+    main.py sets up the simulated hardware when it is imported, so there can only be one Simulation per process.
+
+    :parameters:
+        schedule_filename (str): Watering schedule to replay.
+        start_epoch (int): Simulated local date/time the controller powers up at, in seconds since the epoch.
+        power_mode (str): POWER_NONE or POWER_LIGHT.  Deep sleep ends the program, so it can't be simulated.
+        idle_wakeup (float): Replaces main.py's max_sleep, schedule_check_interval and the wakeup periods of the log and
+            clock tasks.  On the Pico the schedule task wakes every minute to check the schedule file, which can't
+            change during a simulation, so by default the simulation only wakes hourly when nothing is due.  Starts,
+            stops and log entries are deadlines of their own, so the trace is the same either way.  Use 60 to count loop
+            passes as the Pico would.
+        drift_ppm (float): How fast the Pico's crystal runs against true time, in parts per million, to replay the
+            clock drift the periodic time syncs correct.
+    """
+
+    def __init__(self, schedule_filename, start_epoch, power_mode=POWER_LIGHT, idle_wakeup=3600, drift_ppm=0):
+        if power_mode not in (POWER_NONE, POWER_LIGHT):
+            raise ValueError("Only the none and light power modes can be simulated")
+        clock.restart(virtual=True, world_epoch=start_epoch)
+        clock.crystal_ppm = drift_ppm
+
+        import main
+        from water_schedule import ScheduleFile
+        self.main = main
+
+        main.schedule_file = ScheduleFile(schedule_filename, main.schedule_change_check)
+        main.load_schedule_data()
+        if main.schedule_file.signature is None:
+            raise OSError(f"Could not load schedule {schedule_filename}")
+
+        self.log = MemoryLog()
+        main.log_file = main.log_buffer.sink = self.log
+        main.last_log_time = None
+        main.power = PowerManager(power_mode, main.deep_sleep_min)
+        main.max_sleep = main.schedule_check_interval = idle_wakeup
+        main.log_check_interval = main.clock_check_interval = idle_wakeup
+        # Polling the buttons every 0.1 seconds finds nothing on a virtual clock, at() wakes the buttons task at the
+        # moment a scripted button changes.
+        main.input_check_interval = main.max_sleep
+        # A task that fails would be restarted and the failure lost in the trace, stop the simulation instead.
+        main.task_error = self.task_error
+        self.loop = hal_host.new_event_loop()
+        self.controller = None  # The task running main.run_tasks(), created by the first run().
+
+        self.transitions = []  # (epoch_time, relay, on) for every relay change.
+        for i, pin in enumerate(main.relay_pins):
+            pin.listeners.append(self.relay_listener(i))
+
+        self.passes = 0
+        self.pass_ns_total = 0
+        self.pass_ns_max = 0
+
+    @staticmethod
+    def task_error(name, error):
+        raise error
+
+    def relay_listener(self, relay):
+        def listener(pin, value):
+            self.transitions.append((clock.time(), relay, value == self.main.RELAY_ACTIVE))
+        return listener
+
+    def at(self, epoch_time, function):
+        """
+        Calls function() when the simulated local date/time reaches epoch_time, then wakes the buttons task.
+        """
+        def event():
+            function()
+            self.main.buttons_changed.set()
+        clock.call_at(clock.world_to_monotonic(epoch_time), event)
+
+    def hold_button(self, pin, epoch_time, seconds):
+        """
+        Holds a button pin down from epoch_time for the given number of seconds.
+        """
+        self.at(epoch_time, lambda: hal_host.press(pin))
+        self.at(epoch_time + seconds, lambda: hal_host.release(pin))
+
+    def press_manual(self, relay, epoch_time, minutes):
+        """
+        Holds manual button relay down for the given number of minutes, running its relay.
+        """
+        self.hold_button(self.main.button_pins[relay], epoch_time, minutes * 60)
+
+    def pause(self, epoch_time, hours):
+        """
+        Latches the pause schedule button on for the given number of hours.
+        """
+        self.hold_button(self.main.pause_button_pin, epoch_time, hours * 3600)
+
+    def timed_loop_pass(self, loop_pass):
+        """
+        Wraps main.loop_pass() so the host CPU time of every pass is recorded.
+        """
+        def timed():
+            started_ns = host_time.perf_counter_ns()
+            deadline = loop_pass()
+            elapsed_ns = host_time.perf_counter_ns() - started_ns
+            self.passes += 1
+            self.pass_ns_total += elapsed_ns
+            if elapsed_ns > self.pass_ns_max:
+                self.pass_ns_max = elapsed_ns
+            return deadline
+        return timed
+
+    async def until(self, end_epoch):
+        """
+        Lets the controller's tasks run until the simulated local date/time reaches end_epoch.
+        """
+        if self.controller is None:
+            self.main.loop_pass = self.timed_loop_pass(self.main.loop_pass)
+            self.controller = asyncio.ensure_future(self.main.run_tasks())
+        while clock.world_time() < end_epoch and not self.controller.done():
+            await asyncio.sleep(min(end_epoch - clock.world_time(), 3600))
+        if self.controller.done():
+            self.controller.result()  # Raises the error that stopped the controller
+
+    def run(self, end_epoch):
+        """
+        Runs the controller until the simulated local date/time reaches end_epoch, then writes out the log buffer.
+        """
+        with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+            self.loop.run_until_complete(self.until(end_epoch))
+            self.main.flush_log()
+
+    def relay_minutes(self):
+        """
+        Returns a list with the total minutes each relay was on, counting a relay still on as on until now.
+        """
+        minutes = [0.0] * len(self.main.relays)
+        on_since = {}
+        for epoch_time, relay, on in self.transitions:
+            if on:
+                on_since.setdefault(relay, epoch_time)
+            elif relay in on_since:
+                minutes[relay] += (epoch_time - on_since.pop(relay)) / 60
+        for relay, since in on_since.items():
+            minutes[relay] += (clock.time() - since) / 60
+        return minutes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a watering schedule on a virtual clock.")
+    parser.add_argument("schedule", nargs="?", default="Water_Schedule.json", help="schedule file to replay")
+    parser.add_argument("--start", default="2024-06-03", help="local date/time to start at, YYYY-MM-DD[THH:MM]")
+    parser.add_argument("--days", type=float, default=30, help="number of days to simulate")
+    parser.add_argument("--power", choices=(POWER_NONE, POWER_LIGHT), default=POWER_LIGHT, help="power mode")
+    parser.add_argument("--idle-wakeup", type=float, default=3600,
+                        help="longest sleep, in seconds, when nothing is due (the Pico uses 60)")
+    parser.add_argument("--press", action="append", default=[], metavar="RELAY,START,MINUTES",
+                        help="hold a manual button down, for example 3,2024-06-05T07:00,10")
+    parser.add_argument("--pause", action="append", default=[], metavar="START,HOURS",
+                        help="latch the pause schedule button on, for example 2024-06-10T00:00,48")
+    parser.add_argument("--drift", type=float, default=0, metavar="PPM",
+                        help="crystal drift in parts per million, positive if the Pico's clock runs fast")
+    parser.add_argument("--summary", action="store_true", help="only print the summary, not the trace")
+    args = parser.parse_args(argv)
+
+    start_epoch = parse_datetime(args.start)
+    simulation = Simulation(args.schedule, start_epoch, args.power, args.idle_wakeup, args.drift)
+    for press in args.press:
+        relay, start, minutes = press.split(",")
+        simulation.press_manual(int(relay), parse_datetime(start), float(minutes))
+    for pause in args.pause:
+        start, hours = pause.split(",")
+        simulation.pause(parse_datetime(start), float(hours))
+
+    started = host_time.perf_counter()
+    simulation.run(start_epoch + args.days * 86400)
+    wall_time = host_time.perf_counter() - started
+
+    if not args.summary:
+        print("Relay transitions:")
+        for epoch_time, relay, on in simulation.transitions:
+            print(f"{format_timestamp(epoch_time)}: relay {relay} {'on' if on else 'off'}")
+        print("\nLog entries:")
+        for record in simulation.log.records:
+            print(format_record(record))
+        print()
+
+    power = simulation.main.power
+    passes = max(simulation.passes, 1)
+    print(f"Simulated {args.days:g} days from {format_timestamp(start_epoch)} in {wall_time:.3f} seconds")
+    print(f"Loop passes: {simulation.passes}, mean {simulation.pass_ns_total / passes / 1000:.1f} us, "
+          f"max {simulation.pass_ns_max / 1000:.1f} us per pass")
+    print(f"Light sleeps: {power.light_sleeps} ({power.pin_wakeups} ended by a button)")
+    print(f"Relay transitions: {len(simulation.transitions)}, log entries: {len(simulation.log.records)}")
+    outputs = simulation.main.relay_outputs
+    pin_writes = sum(relay._pin.writes for relay in simulation.main.relays)
+    print(f"Relay pin writes: {pin_writes} in {outputs.applies} batches, "
+          f"{outputs.total_transitions()} transitions counted")
+    stats = simulation.main.clock_discipline.stats()
+    drift = "unknown" if stats["drift_ppb"] is None else f"{stats['drift_ppb'] / 1000:.3f} ppm"
+    print(f"Time syncs: {stats['syncs']} ({stats['failures']} failed), interval now {stats['interval']} s, "
+          f"drift {drift}, largest offset {stats['max_offset_ms']} ms, RTC steps {stats['rtc_steps']}")
+    sequencer = simulation.main.zone_sequencer
+    print(f"Zone sequencing: at most {sequencer.max_open} valves and {sequencer.current_budget} A, "
+          f"peak {sequencer.peak_current:g} A")
+    for relay, minutes in enumerate(simulation.relay_minutes()):
+        starts = sum(1 for _, r, on in simulation.transitions if r == relay and on)
+        print(f"  relay {relay}: {starts} runs, {minutes:.0f} minutes on, {sequencer.delayed[relay]} delayed "
+              f"(longest {sequencer.max_delay[relay]} s)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,375 @@
+"""
+SNTP time sync for the Garden Controller.
+
+get_local_time() used to build a new socket pool and HTTPS session on every call and fetch worldtimeapi.org over TLS
+just to read a timestamp out of the JSON.  A TLS handshake on the RP2040 keeps the radio on for seconds and needs a
+lot of heap.
+
+SntpClient asks an SNTP server (RFC 4330) for the time instead: one 48 byte UDP request and one 48 byte answer.  The
+servers are tried in order until one gives a valid answer.  The client measures the round trip time of the exchange
+with time.monotonic_ns() and takes the server's time as of halfway through the server's reply leg.  It also compares
+that with the controller's own clock to report the offset.  The result of a sync is a TimeSample.  It ties the
+server's UTC time to a time.monotonic_ns() reading, so the current UTC time can be worked out from it later
+without asking again.
+
+ClockDiscipline keeps the clock close to UTC between syncs.  It measures how fast or slow the crystal runs from one
+sync to the next, sets the RTC again whenever the drift has put it half a second off, and spaces the syncs further
+apart while the clock keeps good time.
+
+All times are kept as integer nanoseconds.  CircuitPython floats only hold about 22 bits, which is not enough for
+seconds since 1970.
+
+The socket pool is passed in, so the client works with socketpool.SocketPool on the Pico and with the stand-in in
+hal_host.py on a host computer, which answers from a local UDP server driven by the simulated world clock.
+"""
+import struct
+
+from hal import time
+
+# UDP port SNTP servers listen on.
+NTP_PORT = 123
+
+# Seconds from 1900-01-01, where NTP time starts, to 1970-01-01, where time.time() starts.
+NTP_UNIX_DELTA = 2_208_988_800
+
+# Size of an SNTP request or answer without authentication fields.
+NTP_PACKET_SIZE = 48
+
+# First byte of a request: leap indicator 0, version 4, mode 3 (client).
+NTP_CLIENT_HEADER = 0x23
+NTP_MODE_SERVER = 4
+NTP_LEAP_UNSYNCHRONIZED = 3
+
+# Offsets of the 64 bit timestamps in a packet.
+NTP_ORIGINATE = 24
+NTP_RECEIVE = 32
+NTP_TRANSMIT = 40
+
+NS_PER_SECOND = 1_000_000_000
+
+
+def ntp_to_unix_ns(seconds, fraction):
+    """
+    Converts an NTP timestamp, whole seconds and 32 bit fraction, into nanoseconds since 1970-01-01.
+
+    NTP seconds wrap around in February 2036.  As RFC 4330 suggests, seconds with the top bit clear are taken to be
+    after the wrap.
+    """
+    if not seconds & 0x80000000:
+        seconds += 1 << 32
+    return (seconds - NTP_UNIX_DELTA) * NS_PER_SECOND + ((fraction * NS_PER_SECOND) >> 32)
+
+
+def unix_ns_to_ntp(unix_ns):
+    """
+    Converts nanoseconds since 1970-01-01 into an NTP timestamp, (seconds, fraction).
+    """
+    seconds, ns = divmod(unix_ns, NS_PER_SECOND)
+    return (seconds + NTP_UNIX_DELTA) & 0xFFFFFFFF, (ns << 32) // NS_PER_SECOND
+
+
+class TimeSample:
+    """
+    The time from one SNTP answer.
+
+    Attributes:
+        server (int): Index of the server that answered, in the client's server list.
+        utc_ns (int): UTC time, in nanoseconds since 1970-01-01, when the answer arrived.
+        monotonic_ns (int): time.monotonic_ns() when the answer arrived.
+        round_trip_ns (int): Time the request and answer spent on the network, not counting the server's own time.
+        offset_ns (int): How far the controller's clock was behind the server's, negative if it was ahead.
+        stratum (int): The server's distance from a reference clock, 1 is a server with its own reference clock.
+    """
+
+    def __init__(self, server, utc_ns, monotonic_ns, round_trip_ns, offset_ns, stratum):
+        self.server = server
+        self.utc_ns = utc_ns
+        self.monotonic_ns = monotonic_ns
+        self.round_trip_ns = round_trip_ns
+        self.offset_ns = offset_ns
+        self.stratum = stratum
+
+    def utc_now_ns(self, monotonic_ns=None):
+        """
+        Returns the UTC time in nanoseconds since 1970-01-01 at a time.monotonic_ns() reading, by default now.
+        """
+        if monotonic_ns is None:
+            monotonic_ns = time.monotonic_ns()
+        return self.utc_ns + monotonic_ns - self.monotonic_ns
+
+
+class SntpClient:
+    """
+    Gets the UTC time from SNTP servers over UDP.
+
+    :parameters:
+        socket_pool (socketpool.SocketPool): Pool the UDP socket is made from.  Keep one pool for the life of the
+            program, making a new one for each sync wastes heap.
+        servers (list): Host names or IP addresses of the servers, tried in order.
+        local_clock_ns (function): Returns the controller's own idea of the current UTC time in nanoseconds since
+            1970-01-01, the offset in each TimeSample is measured against it.  Defaults to time.time(), the RTC.
+        timeout (float): Seconds to wait for each server's answer.
+        port (int): UDP port of the servers.
+
+    Attributes:
+        last (TimeSample): The latest successful sync, None before the first.
+        syncs, failures (int): Number of successful and failed calls to sync().
+        last_error (str): Why the latest failed server attempt failed, None if none has failed.
+    """
+
+    def __init__(self, socket_pool, servers, local_clock_ns=None, timeout=2, port=NTP_PORT):
+        self.socket_pool = socket_pool
+        self.servers = servers
+        self.local_clock_ns = local_clock_ns or (lambda: time.time() * NS_PER_SECOND)
+        self.timeout = timeout
+        self.port = port
+        self.packet = bytearray(NTP_PACKET_SIZE)  # Reused for every request and answer.
+        self.last = None
+        self.syncs = 0
+        self.failures = 0
+        self.last_error = None
+
+    def sync(self):
+        """
+        Asks each server in turn for the time until one answers.
+
+        :returns:
+            sample (TimeSample): The first valid answer, or None if no server gave one.
+        """
+        for index, server in enumerate(self.servers):
+            try:
+                sample = self.query(index, server)
+            except (OSError, ValueError) as e:
+                self.last_error = f"{server}: {e}"
+                continue
+            self.last = sample
+            self.syncs += 1
+            return sample
+        self.failures += 1
+        return None
+
+    def query(self, index, server):
+        """
+        Sends one request to a server and returns its answer as a TimeSample.
+
+        Raises OSError if the server can't be reached or doesn't answer within timeout, and ValueError if the answer
+        is not a usable time (wrong mode or version, a "kiss-o'-death" or an unsynchronized server, or an answer to
+        some other request).
+        """
+        address = self.socket_pool.getaddrinfo(server, self.port)[0][4]
+        packet = self.packet
+        for i in range(NTP_PACKET_SIZE):
+            packet[i] = 0
+        packet[0] = NTP_CLIENT_HEADER
+
+        sock = self.socket_pool.socket(self.socket_pool.AF_INET, self.socket_pool.SOCK_DGRAM)
+        try:
+            sock.settimeout(self.timeout)
+            sent_ns = time.monotonic_ns()
+            # The server copies the transmit timestamp into the answer's originate timestamp.  The send time is
+            # used as a cookie to match the answer to this request, the controller's clock may not be set yet.
+            struct.pack_into(">II", packet, NTP_TRANSMIT, *unix_ns_to_ntp(sent_ns))
+            cookie = bytes(packet[NTP_TRANSMIT:NTP_TRANSMIT + 8])
+            sock.sendto(packet, address)
+            size = sock.recvfrom_into(packet)[0]
+            received_ns = time.monotonic_ns()
+        finally:
+            sock.close()
+
+        if size < NTP_PACKET_SIZE:
+            raise ValueError(f"Short answer of {size} bytes")
+        leap, version, mode = packet[0] >> 6, (packet[0] >> 3) & 7, packet[0] & 7
+        stratum = packet[1]
+        if mode != NTP_MODE_SERVER or not 1 <= version <= 4:
+            raise ValueError(f"Not a server answer (version {version}, mode {mode})")
+        if bytes(packet[NTP_ORIGINATE:NTP_ORIGINATE + 8]) != cookie:
+            raise ValueError("Answer to a different request")
+        if stratum == 0:
+            raise ValueError(f"Kiss-o'-death {bytes(packet[12:16])}")
+        if leap == NTP_LEAP_UNSYNCHRONIZED or stratum > 15:
+            raise ValueError("Server clock is not synchronized")
+
+        server_received_ns = ntp_to_unix_ns(*struct.unpack_from(">II", packet, NTP_RECEIVE))
+        server_sent_ns = ntp_to_unix_ns(*struct.unpack_from(">II", packet, NTP_TRANSMIT))
+        round_trip_ns = (received_ns - sent_ns) - (server_sent_ns - server_received_ns)
+        if round_trip_ns < 0:
+            round_trip_ns = 0
+        utc_ns = server_sent_ns + round_trip_ns // 2
+        offset_ns = utc_ns - int(self.local_clock_ns())
+        return TimeSample(index, utc_ns, received_ns, round_trip_ns, offset_ns, stratum)
+
+
+class ClockDiscipline:
+    """
+    Keeps the controller's clock close to UTC between SNTP syncs and decides when to sync again.
+
+    On the RP2040 the RTC and time.monotonic_ns() are both clocked from the same crystal, so they drift together.
+    Each sync ties a UTC time to a monotonic reading, and the next sync shows how far the monotonic clock ran fast
+    or slow in between.  That gives the drift rate, kept in parts per billion.  With the rate known, utc_ns()
+    estimates UTC at any monotonic reading, correcting for the drift.  The RTC only counts whole seconds, so it is
+    corrected in steps instead: next_step_ns() says when the RTC will be half a second off the estimate, and the
+    controller then sets it again at the start of an estimated second.  That steps the RTC back on time in small
+    corrections and keeps it within half a second between syncs.
+
+    The time between syncs adapts to how good the estimate is.  If a sync finds the estimate was off by less than a
+    quarter of accuracy_ns, the interval doubles, up to max_interval.  If it was off by more than accuracy_ns, the
+    interval halves, down to min_interval.  A stable crystal is therefore synced only every few days, which keeps
+    the radio off.  A failed sync is retried after min_interval without changing the interval.
+
+    :parameters:
+        min_interval, max_interval (int): Shortest and longest time between syncs, in seconds.
+        accuracy_ns (int): How far, in nanoseconds, the estimate may be off at a sync before syncs come sooner.
+
+    Attributes:
+        interval (int): Current time between syncs in seconds.
+        rate_ppb (int): Drift rate of the monotonic clock and RTC, parts per billion fast (negative if slow).
+        rate_known (bool): True once two syncs have measured the rate.
+        next_sync_ns (int): time.monotonic_ns() when the next sync is due, None before the first.
+        syncs, failures (int): Number of successful and failed syncs.
+        steps (int): Number of times the RTC was stepped between syncs.
+        last_offset_ns, max_offset_ns (int): Estimate error found by the latest sync and the largest found, the
+            offsets of the first sync (against the unset RTC) are not counted.
+        last_round_trip_ns (int): Round trip time of the latest sync.
+    """
+
+    # The RTC is stepped when it is this far off the estimate.
+    STEP_THRESHOLD_NS = NS_PER_SECOND // 2
+
+    def __init__(self, min_interval=3600, max_interval=4 * 86400, accuracy_ns=250_000_000):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.accuracy_ns = accuracy_ns
+        self.interval = min_interval
+        self.rate_ppb = 0
+        self.rate_known = False
+        self.base_utc_ns = None  # UTC time and time.monotonic_ns() of the latest sync.
+        self.base_monotonic_ns = None
+        self.rtc_utc = None  # UTC seconds the RTC was last set to and time.monotonic_ns() when it was.
+        self.rtc_monotonic_ns = None
+        self.next_sync_ns = None
+        self.syncs = 0
+        self.failures = 0
+        self.steps = 0
+        self.last_offset_ns = 0
+        self.max_offset_ns = 0
+        self.last_round_trip_ns = 0
+
+    def synced(self):
+        """
+        Returns True once a sync has given the estimate a starting point.
+        """
+        return self.base_utc_ns is not None
+
+    def utc_ns(self, monotonic_ns):
+        """
+        Returns the estimated UTC time, in nanoseconds since 1970-01-01, at a time.monotonic_ns() reading, or None
+        before the first sync.
+        """
+        if self.base_utc_ns is None:
+            return None
+        elapsed = monotonic_ns - self.base_monotonic_ns
+        return self.base_utc_ns + elapsed - elapsed * self.rate_ppb // NS_PER_SECOND
+
+    def update(self, sample, monotonic_ns):
+        """
+        Takes in the result of a sync, a TimeSample or None if it failed, and plans the next sync.
+
+        The sample's offset must have been measured against utc_ns() (see SntpClient's local_clock_ns), so it is
+        the error of the estimate.
+        """
+        if sample is None:
+            self.failures += 1
+            self.next_sync_ns = monotonic_ns + self.min_interval * NS_PER_SECOND
+            return
+        if self.base_utc_ns is not None:
+            elapsed = sample.monotonic_ns - self.base_monotonic_ns
+            offset = sample.offset_ns
+            # The estimate ran offset behind over elapsed, so the clock ran that much faster than thought.
+            measured_ppb = self.rate_ppb - offset * NS_PER_SECOND // elapsed if elapsed > 0 else self.rate_ppb
+            # Average with the previous rate so one noisy round trip doesn't throw the estimate off.
+            self.rate_ppb = (self.rate_ppb + measured_ppb) // 2 if self.rate_known else measured_ppb
+            self.rate_known = True
+            self.last_offset_ns = offset
+            if abs(offset) > abs(self.max_offset_ns):
+                self.max_offset_ns = offset
+            if abs(offset) * 4 < self.accuracy_ns:
+                self.interval = min(self.interval * 2, self.max_interval)
+            elif abs(offset) > self.accuracy_ns:
+                self.interval = max(self.interval // 2, self.min_interval)
+        self.base_utc_ns = sample.utc_ns
+        self.base_monotonic_ns = sample.monotonic_ns
+        self.last_round_trip_ns = sample.round_trip_ns
+        self.syncs += 1
+        self.next_sync_ns = monotonic_ns + self.interval * NS_PER_SECOND
+
+    def schedule_sync(self, monotonic_ns):
+        """
+        Plans the next sync min_interval after a time.monotonic_ns() reading, for a clock that was set without one,
+        for example from the time saved before a deep sleep.
+        """
+        self.next_sync_ns = monotonic_ns + self.min_interval * NS_PER_SECOND
+
+    def rtc_set(self, utc, monotonic_ns, step=False):
+        """
+        Records that the RTC was set to a UTC time, in whole seconds, at a time.monotonic_ns() reading.
+
+        :parameters:
+            step (bool): True if this was a correction step asked for by next_step_ns().
+        """
+        self.rtc_utc = utc
+        self.rtc_monotonic_ns = monotonic_ns
+        if step:
+            self.steps += 1
+
+    def rtc_error_ns(self, monotonic_ns):
+        """
+        Returns how far the RTC is ahead of the estimated UTC time at a time.monotonic_ns() reading, or None if
+        either is unknown.
+        """
+        utc_ns = self.utc_ns(monotonic_ns)
+        if utc_ns is None or self.rtc_utc is None:
+            return None
+        return self.rtc_utc * NS_PER_SECOND + monotonic_ns - self.rtc_monotonic_ns - utc_ns
+
+    def rtc_fraction_ns(self, monotonic_ns):
+        """
+        Returns how long ago, in nanoseconds, the RTC last counted a second, 0 if unknown.
+
+        The RTC counts from the moment it was set, so its seconds start at known monotonic readings.
+        """
+        if self.rtc_monotonic_ns is None:
+            return 0
+        return (monotonic_ns - self.rtc_monotonic_ns) % NS_PER_SECOND
+
+    def next_step_ns(self):
+        """
+        Returns the time.monotonic_ns() reading at which the RTC should be set again, None if it never drifts off.
+
+        That is the start of the first estimated UTC second after the RTC is STEP_THRESHOLD_NS off the estimate.
+        """
+        if not self.rate_known or self.rate_ppb == 0 or self.rtc_utc is None:
+            return None
+        # The RTC gains rate_ppb nanoseconds on the estimate every second, so it gets ahead if the rate is positive
+        # and behind if it is negative.
+        error = self.rtc_error_ns(self.rtc_monotonic_ns)
+        if self.rate_ppb > 0:
+            remaining = self.STEP_THRESHOLD_NS - error
+        else:
+            remaining = self.STEP_THRESHOLD_NS + error
+        step_ns = self.rtc_monotonic_ns + max(remaining, 0) * NS_PER_SECOND // abs(self.rate_ppb)
+        return step_ns + NS_PER_SECOND - self.utc_ns(step_ns) % NS_PER_SECOND
+
+    def stats(self):
+        """
+        Returns the sync statistics as a dictionary, for monitoring.
+        """
+        return {
+            "syncs": self.syncs,
+            "failures": self.failures,
+            "interval": self.interval,
+            "drift_ppb": self.rate_ppb if self.rate_known else None,
+            "last_offset_ms": self.last_offset_ns // 1_000_000,
+            "max_offset_ms": self.max_offset_ns // 1_000_000,
+            "last_round_trip_ms": self.last_round_trip_ns // 1_000_000,
+            "rtc_steps": self.steps,
+        }
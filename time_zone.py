@@ -0,0 +1,293 @@
+"""
+Time zone and daylight saving time (DST) rules for the Garden Controller.
+
+get_local_time() used to take the UTC offset and the DST offset from worldtimeapi.org, so every boot needed an HTTPS
+round trip just to learn the offset, and the RTC stayed on the old offset when DST started or ended until the next
+boot.
+
+A TimeZone holds the rules of one zone in the compact form POSIX uses for the TZ variable, for example
+"PST8PDT,M3.2.0,M11.1.0": standard time is 8 hours behind UTC, DST starts on the second Sunday of March and ends on
+the first Sunday of November, both at 02:00 local time.  From that it works out the UTC offset at any moment, the
+local time for a UTC time and back, and the exact UTC instant of the next DST change, all with integer arithmetic
+and no network access.  The network is only needed for the UTC time itself (see time_sync.py).
+
+ZONES maps the names of some common zones to their rules.  Any other zone can be given as a POSIX rule directly,
+the rule for a zone can be found in the last line of its file in /usr/share/zoneinfo on most Linux systems.  Only the
+"Mm.w.d" form of DST rules is understood, which is what every current zone uses.  A rule describes the zone as it is
+now, times before its rules last changed (2007 in the United States) may come out an hour off.
+
+Times are seconds since the epoch, 1970-01-01.
+"""
+
+# POSIX rules of the zones known by name.
+ZONES = {
+    "UTC": "UTC0",
+    "America/Los_Angeles": "PST8PDT,M3.2.0,M11.1.0",
+    "America/Denver": "MST7MDT,M3.2.0,M11.1.0",
+    "America/Phoenix": "MST7",
+    "America/Chicago": "CST6CDT,M3.2.0,M11.1.0",
+    "America/New_York": "EST5EDT,M3.2.0,M11.1.0",
+    "America/Anchorage": "AKST9AKDT,M3.2.0,M11.1.0",
+    "Pacific/Honolulu": "HST10",
+    "Europe/London": "GMT0BST,M3.5.0/1,M10.5.0",
+    "Europe/Berlin": "CET-1CEST,M3.5.0,M10.5.0/3",
+    "Australia/Sydney": "AEST-10AEDT,M10.1.0,M4.1.0/3",
+}
+
+SECONDS_PER_DAY = 86400
+
+# Local time DST changes happen at when a rule doesn't say, 02:00.
+DEFAULT_CHANGE_TIME = 2 * 3600
+
+
+def days_from_civil(year, month, day):
+    """
+    Returns the number of days from 1970-01-01 to a date in the proleptic Gregorian calendar.
+    """
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def civil_from_days(days):
+    """
+    Returns the (year, month, day) that is a number of days after 1970-01-01.
+    """
+    days += 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = month_index + (3 if month_index < 10 else -9)
+    return year_of_era + era * 400 + (1 if month <= 2 else 0), month, day
+
+
+def days_in_month(year, month):
+    """
+    Returns the number of days in a month.
+    """
+    if month == 2:
+        return 29 if year % 4 == 0 and (year % 100 != 0 or year % 400 == 0) else 28
+    return 30 if month in (4, 6, 9, 11) else 31
+
+
+def rule_day(year, month, week, weekday):
+    """
+    Returns the day, as days since 1970-01-01, of a "Mm.w.d" rule: weekday d (0 is Sunday) of week w of month m.
+
+    Week 1 is the first week in which the weekday occurs and week 5 means the last one in the month.
+    """
+    first = days_from_civil(year, month, 1)
+    # 1970-01-01 was a Thursday, weekday 4.
+    day = first + (weekday - (first + 4)) % 7 + (week - 1) * 7
+    last = first + days_in_month(year, month) - 1
+    while day > last:
+        day -= 7
+    return day
+
+
+class _Parser:
+    """
+    Reads the parts of a POSIX TZ rule in order.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def more(self):
+        return self.pos < len(self.text)
+
+    def peek(self):
+        return self.text[self.pos] if self.more() else ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at position {self.pos} of time zone rule {self.text!r}")
+        self.pos += 1
+
+    def name(self):
+        if self.peek() == "<":
+            end = self.text.find(">", self.pos)
+            if end < 0:
+                raise ValueError(f"Unterminated <name> in time zone rule {self.text!r}")
+            name = self.text[self.pos + 1:end]
+            self.pos = end + 1
+            return name
+        start = self.pos
+        while self.more() and self.peek().isalpha():
+            self.pos += 1
+        if self.pos - start < 3:
+            raise ValueError(f"Expected a zone abbreviation at position {start} of time zone rule {self.text!r}")
+        return self.text[start:self.pos]
+
+    def number(self):
+        start = self.pos
+        while self.more() and self.peek().isdigit():
+            self.pos += 1
+        if start == self.pos:
+            raise ValueError(f"Expected a number at position {start} of time zone rule {self.text!r}")
+        return int(self.text[start:self.pos])
+
+    def duration(self):
+        """
+        Reads [+|-]hh[:mm[:ss]] and returns it in seconds.
+        """
+        sign = 1
+        if self.peek() in "+-":
+            sign = -1 if self.peek() == "-" else 1
+            self.pos += 1
+        seconds = self.number() * 3600
+        for scale in (60, 1):
+            if self.peek() != ":":
+                break
+            self.pos += 1
+            seconds += self.number() * scale
+        return sign * seconds
+
+    def change(self):
+        """
+        Reads ",Mm.w.d[/time]" and returns (month, week, weekday, seconds after local midnight).
+        """
+        self.expect(",")
+        self.expect("M")
+        month = self.number()
+        self.expect(".")
+        week = self.number()
+        self.expect(".")
+        weekday = self.number()
+        if not (1 <= month <= 12 and 1 <= week <= 5 and 0 <= weekday <= 6):
+            raise ValueError(f"Invalid DST change M{month}.{week}.{weekday} in time zone rule {self.text!r}")
+        seconds = DEFAULT_CHANGE_TIME
+        if self.peek() == "/":
+            self.pos += 1
+            seconds = self.duration()
+        return month, week, weekday, seconds
+
+
+class TimeZone:
+    """
+    The UTC offset and DST rules of a time zone.
+
+    Offsets are in seconds east of UTC, so -28800 for Pacific Standard Time.  Note that POSIX rules write them the
+    other way round, "PST8" is 8 hours west.
+
+    Attributes:
+        rule (str): The POSIX rule the zone was made from.
+        std_name, dst_name (str): Abbreviations of standard time and DST, dst_name is None without DST.
+        std_offset, dst_offset (int): UTC offsets of standard time and DST.
+        dst_start, dst_end (tuple): (month, week, weekday, seconds) of each change, None without DST.
+
+    :parameters:
+        rule (str): A POSIX TZ rule such as "PST8PDT,M3.2.0,M11.1.0".
+    """
+
+    def __init__(self, rule):
+        parser = _Parser(rule)
+        self.rule = rule
+        self.std_name = parser.name()
+        self.std_offset = -parser.duration()
+        self.dst_name = None
+        self.dst_offset = self.std_offset
+        self.dst_start = self.dst_end = None
+        if parser.more():
+            self.dst_name = parser.name()
+            self.dst_offset = self.std_offset + 3600
+            if parser.peek() not in ",":
+                self.dst_offset = -parser.duration()
+            self.dst_start = parser.change()
+            self.dst_end = parser.change()
+        if parser.more():
+            raise ValueError(f"Unexpected {parser.text[parser.pos:]!r} at the end of time zone rule {rule!r}")
+        self.cached_year = None
+        self.cached_changes = None
+
+    def changes(self, year):
+        """
+        Returns the UTC instants DST starts and ends in a year, (start, end), or None if the zone has no DST.
+        """
+        if self.dst_start is None:
+            return None
+        if year != self.cached_year:
+            month, week, weekday, seconds = self.dst_start
+            # Each change happens at a local time on the clock that is in use before it.
+            start = rule_day(year, month, week, weekday) * SECONDS_PER_DAY + seconds - self.std_offset
+            month, week, weekday, seconds = self.dst_end
+            end = rule_day(year, month, week, weekday) * SECONDS_PER_DAY + seconds - self.dst_offset
+            self.cached_year = year
+            self.cached_changes = (start, end)
+        return self.cached_changes
+
+    def is_dst(self, utc):
+        """
+        Returns True if DST is in effect at a UTC time.
+        """
+        changes = self.changes(civil_from_days((utc + self.std_offset) // SECONDS_PER_DAY)[0])
+        if changes is None:
+            return False
+        start, end = changes
+        if start < end:
+            return start <= utc < end
+        return not end <= utc < start  # Southern hemisphere, DST spans the new year.
+
+    def utc_offset(self, utc):
+        """
+        Returns the UTC offset, in seconds, in effect at a UTC time.
+        """
+        return self.dst_offset if self.is_dst(utc) else self.std_offset
+
+    def name(self, utc):
+        """
+        Returns the abbreviation in use at a UTC time, for example "PST" or "PDT".
+        """
+        return self.dst_name if self.is_dst(utc) else self.std_name
+
+    def local_time(self, utc):
+        """
+        Converts a UTC time into local time, both in seconds since the epoch.
+        """
+        return utc + self.utc_offset(utc)
+
+    def to_utc(self, local):
+        """
+        Converts a local time into UTC, both in seconds since the epoch.
+
+        A local time that happens twice when DST ends is taken as the first, DST, one.  One that is skipped when DST
+        starts is taken as standard time.
+        """
+        for offset in (self.dst_offset, self.std_offset):
+            if self.utc_offset(local - offset) == offset:
+                return local - offset
+        return local - self.std_offset
+
+    def next_change(self, utc):
+        """
+        Returns the UTC instant of the first DST change after a UTC time, or None if the zone has no DST.
+        """
+        year = civil_from_days((utc + self.std_offset) // SECONDS_PER_DAY)[0]
+        upcoming = None
+        for candidate_year in (year, year + 1):
+            changes = self.changes(candidate_year)
+            if changes is None:
+                return None
+            for instant in changes:
+                if instant > utc and (upcoming is None or instant < upcoming):
+                    upcoming = instant
+            if upcoming is not None:
+                return upcoming
+        return upcoming
+
+
+def get_zone(name):
+    """
+    Returns the TimeZone for a zone name from ZONES, or for a POSIX TZ rule.
+
+    Raises ValueError if the name is not in ZONES and is not a valid rule.
+    """
+    return TimeZone(ZONES.get(name, name))
@@ -0,0 +1,561 @@
+"""
+Watering schedule compiler for the Garden Controller.
+
+Water_Schedule.json stores the schedule the way a person thinks about it: per relay, a list of days and a list of
+[hour, minute, duration] entries.  That is easy to edit but slow to evaluate, because every tick of the main loop has
+to scan every relay's lists to find out whether anything should start.
+
+This module compiles the JSON data once into an activation index keyed by minute of the week
+(weekday * 1440 + hour * 60 + minute).  Each key maps to a tuple of (relay_index, duration) pairs, so a tick is a
+single dictionary lookup no matter how many relays or watering times the schedule contains.
+
+ScheduleFile wraps the schedule file and only re-reads and re-compiles it when the file has actually changed, so the
+main loop can ask for the latest schedule on every tick without touching flash or the heap.
+
+Parsing the JSON is still the slowest and most allocation heavy part of start up on the RP2040, so ScheduleFile can
+keep the compiled schedule in a binary cache file next to the JSON (see write_cache() and read_cache()).  The cache
+records the signature of the JSON file it was compiled from and is only used while the JSON file still has that
+signature, otherwise the JSON is parsed and the cache written again.  The JSON file stays the one that is edited.
+"""
+import binascii
+import json
+import os
+import struct
+from array import array
+
+# Number of minutes in a day and in a week, used to build the minute-of-week index keys.
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+# Special day value in Water_Schedule.json meaning "water every day".
+EVERY_DAY = 7
+
+# Longest watering time in minutes, the largest duration the binary cache and the zone sequencer can store.
+MAX_DURATION = 0xFFFF
+
+# Empty result returned by Schedule.starts_at() when nothing is scheduled.  Shared so a lookup miss never allocates.
+NO_STARTS = ()
+
+
+def minute_of_week(weekday, hour, minute):
+    """
+    Converts a weekday and time of day into a minute-of-week index key.
+
+    :parameters:
+        weekday (int): Day of the week (0 to 6, where 0 is Monday).
+        hour (int): Hour of the day on a 24hr clock.
+        minute (int): Minute of the hour.
+
+    :returns:
+        key (int): Minutes since Monday 00:00.
+    """
+    return weekday * MINUTES_PER_DAY + hour * 60 + minute
+
+
+def first_after(keys, value):
+    """
+    Returns the position of the first key greater than value in a sorted sequence of keys, len(keys) if there is none.
+
+    A binary search, CircuitPython has no bisect module.
+    """
+    low, high = 0, len(keys)
+    while low < high:
+        middle = (low + high) >> 1
+        if keys[middle] <= value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def whole_number(value, low, high):
+    """
+    Returns True if value is an int (not a bool or a float) from low to high.
+    """
+    return type(value) is int and low <= value <= high
+
+
+def parse_schedule_data(schedule_data):
+    """
+    Converts decoded Water_Schedule.json data into the relay ordered watering_days and watering_times lists.
+
+    Relay keys are sorted alphabetically so "relay0" maps to relay index 0, "relay1" to index 1 and so on.
+
+    Every day must be a whole number from 0 to EVERY_DAY, and every watering time a list of a whole hour from 0 to 23,
+    minute from 0 to 59 and duration from 1 to MAX_DURATION minutes.  A schedule with anything else, such as a
+    duration of 1.5, raises ValueError, so a schedule file, an upload and the binary cache accept the same schedules.
+
+    :parameters:
+        schedule_data (dict): The decoded contents of Water_Schedule.json.
+
+    :returns:
+        relay_order (list): Sorted relay names.
+        watering_days (list): List of watering days for each relay.
+        watering_times (list): List of [hour, minute, duration] lists for each relay.
+    """
+    relay_order = sorted([key for key in schedule_data["watering_days"] if key.startswith("relay")])
+    watering_days = []
+    watering_times = []
+    for relay_name in relay_order:
+        days = schedule_data["watering_days"][relay_name]
+        times = schedule_data["watering_times"].get(relay_name, [])
+        for day in days:
+            if not whole_number(day, 0, EVERY_DAY):
+                raise ValueError(f"{relay_name}: day {day!r} is not a whole number from 0 to {EVERY_DAY}")
+        for time in times:
+            if not (isinstance(time, list) and len(time) == 3 and whole_number(time[0], 0, 23)
+                    and whole_number(time[1], 0, 59) and whole_number(time[2], 1, MAX_DURATION)):
+                raise ValueError(f"{relay_name}: watering time {time!r} is not [hour, minute, duration] in whole "
+                                 f"numbers, with a duration of 1 to {MAX_DURATION} minutes")
+        watering_days.append(days)
+        watering_times.append(times)
+    return relay_order, watering_days, watering_times
+
+
+def build_activation_index(watering_days, watering_times):
+    """
+    Builds the minute-of-week activation index from the watering_days and watering_times lists.
+
+    Every day listed for a relay is combined with every watering time for that relay.  A 7 in the days list expands
+    to all seven days, and duplicate days are only indexed once.  If the same relay is listed twice for the same
+    minute the first duration wins, which matches the first-match behaviour of the old per-relay scan.
+
+    :parameters:
+        watering_days (list): List of watering days for each relay.
+        watering_times (list): List of [hour, minute, duration] lists for each relay.
+
+    :returns:
+        index (dict): Maps minute-of-week keys to a tuple of (relay_index, duration) pairs in relay order.
+    """
+    index = {}
+    for relay_index, days in enumerate(watering_days):
+        if EVERY_DAY in days:
+            days = range(7)
+        for day in set(days):
+            for hour, minute, duration in watering_times[relay_index]:
+                key = minute_of_week(day, hour, minute)
+                starts = index.setdefault(key, [])
+                if relay_index not in [start[0] for start in starts]:
+                    starts.append((relay_index, duration))
+
+    # Freeze the entries into sorted tuples so the index can be shared safely and iterated in relay order.
+    for key in index:
+        index[key] = tuple(sorted(index[key]))
+    return index
+
+
+class Schedule:
+    """
+    A compiled, read-only view of the watering schedule.
+
+    Holds the relay ordered lists that the rest of the program already uses together with the activation index.
+    A Schedule is never modified after it is built, so replacing the schedule is a single assignment.  The index is a
+    dictionary when the schedule is compiled from JSON, or a StartIndex when it is read from the binary cache.
+    """
+
+    def __init__(self, relay_order, watering_days, watering_times, index=None, start_keys=None):
+        self.relay_order = relay_order
+        self.watering_days = watering_days
+        self.watering_times = watering_times
+        # A schedule read from the binary cache comes with its index already built.
+        self.index = build_activation_index(watering_days, watering_times) if index is None else index
+        # Minute-of-week keys in order, for finding the next start.
+        self.start_keys = sorted(self.index) if start_keys is None else start_keys
+
+    @classmethod
+    def from_data(cls, schedule_data):
+        """
+        Builds a Schedule from decoded Water_Schedule.json data.
+        """
+        return cls(*parse_schedule_data(schedule_data))
+
+    @classmethod
+    def empty(cls):
+        """
+        Builds a Schedule with no relays, used as a fallback when the schedule file cannot be read.
+        """
+        return cls([], [], [])
+
+    def starts_at(self, weekday, hour, minute):
+        """
+        Returns the relays that are scheduled to start at the given weekday and time.
+
+        :parameters:
+            weekday (int): Day of the week (0 to 6, where 0 is Monday).
+            hour (int): Hour of the day on a 24hr clock.
+            minute (int): Minute of the hour.
+
+        :returns:
+            starts (tuple): Tuple of (relay_index, duration) pairs, empty if nothing starts this minute.
+        """
+        return self.index.get(weekday * MINUTES_PER_DAY + hour * 60 + minute, NO_STARTS)
+
+    def minutes_until_next_start(self, weekday, hour, minute):
+        """
+        Returns how many minutes from the given minute until the next minute with a scheduled start.
+
+        Only starts strictly after the given minute are considered, wrapping around into next week.  A schedule with
+        a single start time therefore returns 7 days when asked at that exact minute.
+
+        :parameters:
+            weekday (int): Day of the week (0 to 6, where 0 is Monday).
+            hour (int): Hour of the day on a 24hr clock.
+            minute (int): Minute of the hour.
+
+        :returns:
+            minutes (int): Minutes until the next start, or None if the schedule has no starts at all.
+        """
+        keys = self.start_keys
+        if not keys:
+            return None
+        current = weekday * MINUTES_PER_DAY + hour * 60 + minute
+        low = first_after(keys, current)
+        if low == len(keys):
+            return keys[0] + MINUTES_PER_WEEK - current
+        return keys[low] - current
+
+
+def load_schedule(filename):
+    """
+    Reads a watering schedule JSON file and compiles it into a Schedule.
+
+    :parameters:
+        filename (str): Path of the schedule JSON file.
+
+    :returns:
+        schedule (Schedule): The compiled schedule.
+    """
+    with open(filename, 'r') as file:
+        return Schedule.from_data(json.load(file))
+
+
+class StartIndex:
+    """
+    An activation index kept in the flat arrays it was read into from the binary schedule cache.
+
+    It answers get(key) and index[key] like the dictionary from build_activation_index(), so a Schedule can use
+    either.  The key is found with a binary search and its tuple of (relay_index, duration) pairs is only built when
+    it is asked for, so loading the index allocates nothing per start.  Starts are looked up once per pass of the
+    schedule task, which only runs when something is due, so the search costs far less than building a dictionary.
+
+    :parameters:
+        keys (array): Sorted minute-of-week keys, array("H").
+        first (array): Position of each key's first start in relays and durations, with one more entry at the end
+            for the total, array("H").
+        relays (bytearray): Relay index of every start.
+        durations (array): Duration in minutes of every start, array("H").
+    """
+
+    def __init__(self, keys, first, relays, durations):
+        self.keys = keys
+        self.first = first
+        self.relays = relays
+        self.durations = durations
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def get(self, key, default=None):
+        position = first_after(self.keys, key) - 1
+        if position < 0 or self.keys[position] != key:
+            return default
+        return tuple((self.relays[i], self.durations[i])
+                     for i in range(self.first[position], self.first[position + 1]))
+
+    def __getitem__(self, key):
+        starts = self.get(key)
+        if starts is None:
+            raise KeyError(key)
+        return starts
+
+
+# Binary schedule cache format (see write_cache()).  A header of magic, format version, number of signature values,
+# number of relays, number of start keys and number of starts, then these arrays in order, little endian like the
+# RP2040, so each is read from the file straight into an array:
+#   signature: uint32 per value of the JSON file's signature the cache was compiled from.
+#   start index: keys (uint16), first start of each key plus the total (uint16), relay of each start (uint8) and
+#       duration of each start (uint16).
+#   relays: name lengths (uint8), names, day counts (uint8), days (uint8), time counts (uint8), then the hour (uint8),
+#       minute (uint8) and duration (uint16) of every watering time.
+CACHE_MAGIC = b"WSCH"
+CACHE_VERSION = 1
+CACHE_HEADER = "<4sBBHHH"
+
+
+def read_array(file, typecode, count):
+    """
+    Reads count values of an array typecode from a binary file straight into a new array.
+
+    Raises ValueError if the file ends first.
+    """
+    values = bytearray(count) if typecode == "B" else array(typecode, [0] * count)
+    if count and file.readinto(values) != len(values) * (1 if typecode == "B" else values.itemsize):
+        raise ValueError("Schedule cache cut short")
+    return values
+
+
+def write_cache(filename, schedule, signature):
+    """
+    Writes a compiled Schedule to a binary cache file.
+
+    The cache is written to filename + ".new" and renamed over filename once it is complete, so a write that fails
+    part way never leaves a damaged cache behind.  Raises OSError if the file can't be written, and ValueError,
+    TypeError or OverflowError if the schedule holds values the cache can't store, such as a relay index over 255
+    or more than 255 watering times for a relay.  The partial file is deleted in both cases.
+
+    :parameters:
+        filename (str): Path of the cache file.
+        schedule (Schedule): The compiled schedule.
+        signature (tuple): Signature of the JSON file the schedule was compiled from.
+
+    :returns: None
+    """
+    keys = array("H", schedule.start_keys)
+    first = array("H", [0])
+    relays = bytearray()
+    durations = array("H")
+    for key in keys:
+        for relay_index, duration in schedule.index[key]:
+            relays.append(relay_index)
+            durations.append(duration)
+        first.append(len(relays))
+    names = [name.encode() for name in schedule.relay_order]
+    times = [time for relay_times in schedule.watering_times for time in relay_times]
+
+    temporary = filename + ".new"
+    try:
+        with open(temporary, "wb") as file:
+            file.write(struct.pack(CACHE_HEADER, CACHE_MAGIC, CACHE_VERSION, len(signature), len(names), len(keys),
+                                   len(relays)))
+            file.write(array("I", signature))
+            for values in (keys, first, relays, durations):
+                file.write(values)
+            file.write(bytes(len(name) for name in names))
+            file.write(b"".join(names))
+            file.write(bytes(len(days) for days in schedule.watering_days))
+            file.write(bytes(day for days in schedule.watering_days for day in days))
+            file.write(bytes(len(relay_times) for relay_times in schedule.watering_times))
+            file.write(bytes(time[0] for time in times))
+            file.write(bytes(time[1] for time in times))
+            file.write(array("H", [time[2] for time in times]))
+        try:
+            os.rename(temporary, filename)
+        except OSError:
+            # FAT can't rename over an existing file.
+            remove_file(filename)
+            os.rename(temporary, filename)
+    except Exception:
+        remove_file(temporary)
+        raise
+
+
+def remove_file(filename):
+    """
+    Deletes a file, if it exists.
+    """
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def read_cache(filename, signature):
+    """
+    Reads a Schedule from a binary cache file, if it was compiled from a JSON file with the given signature.
+
+    No JSON is parsed, nothing is sorted and the activation index is used as it was built, as a StartIndex over the
+    arrays it is read into.
+
+    :parameters:
+        filename (str): Path of the cache file.
+        signature (tuple): Signature of the JSON file as it is now.
+
+    :returns:
+        schedule (Schedule): The cached schedule, or None if there is no cache or it is out of date or damaged.
+    """
+    try:
+        with open(filename, "rb") as file:
+            magic, version, signature_count, relay_count, key_count, start_count = struct.unpack(
+                CACHE_HEADER, file.read(struct.calcsize(CACHE_HEADER)))
+            if magic != CACHE_MAGIC or version != CACHE_VERSION or signature_count != len(signature):
+                return None
+            if tuple(read_array(file, "I", signature_count)) != tuple(signature):
+                return None
+            keys = read_array(file, "H", key_count)
+            index = StartIndex(keys, read_array(file, "H", key_count + 1), read_array(file, "B", start_count),
+                               read_array(file, "H", start_count))
+            name_lengths = read_array(file, "B", relay_count)
+            names = read_array(file, "B", sum(name_lengths))
+            day_counts = read_array(file, "B", relay_count)
+            days = read_array(file, "B", sum(day_counts))
+            time_counts = read_array(file, "B", relay_count)
+            hours = read_array(file, "B", sum(time_counts))
+            minutes = read_array(file, "B", len(hours))
+            durations = read_array(file, "H", len(hours))
+    except Exception:
+        return None  # No cache file, or one cut short or damaged: compile from the JSON instead
+
+    relay_order, watering_days, watering_times = [], [], []
+    name_at = day_at = time_at = 0
+    for relay_index in range(relay_count):
+        relay_order.append(names[name_at:name_at + name_lengths[relay_index]].decode())
+        name_at += name_lengths[relay_index]
+        watering_days.append(list(days[day_at:day_at + day_counts[relay_index]]))
+        day_at += day_counts[relay_index]
+        watering_times.append([[hours[i], minutes[i], durations[i]]
+                               for i in range(time_at, time_at + time_counts[relay_index])])
+        time_at += time_counts[relay_index]
+    return Schedule(relay_order, watering_days, watering_times, index, keys)
+
+
+# Ways ScheduleFile can detect a changed schedule file.
+# "stat" compares the file size and modification time from os.stat() and never reads the file.
+# "crc" also reads the file and compares a CRC32 of its contents, catching same-size edits made within the 2 second
+# modification time resolution of the FAT filesystem.  It still skips the JSON parse and index rebuild.
+CHANGE_CHECK_STAT = "stat"
+CHANGE_CHECK_CRC = "crc"
+
+
+def file_signature(filename):
+    """
+    Returns a cheap signature of a file made from its size and modification time.
+
+    os.stat() returns a tuple on CircuitPython, so the fields are read by index (6 is st_size, 8 is st_mtime).
+
+    :parameters:
+        filename (str): Path of the file.
+
+    :returns:
+        signature (tuple): (size, mtime) of the file.
+    """
+    stat_result = os.stat(filename)
+    return stat_result[6], stat_result[8]
+
+
+def file_crc(filename, chunk_size=256):
+    """
+    Returns the CRC32 of a file's contents, read in small chunks to keep heap use low.
+
+    :parameters:
+        filename (str): Path of the file.
+        chunk_size (int): Number of bytes read at a time.
+
+    :returns:
+        crc (int): CRC32 of the file contents.
+    """
+    crc = 0
+    buffer = bytearray(chunk_size)
+    with open(filename, 'rb') as file:
+        while True:
+            count = file.readinto(buffer)
+            if not count:
+                return crc
+            crc = binascii.crc32(memoryview(buffer)[:count], crc)
+
+
+class ScheduleFile:
+    """
+    Keeps a compiled Schedule in sync with its JSON file, re-parsing only when the file changes.
+
+    Call reload() as often as you like.  It checks the file signature (and optionally a CRC of the contents) and only
+    when that differs from the last successful load does it parse the JSON and build a new Schedule.  The new
+    Schedule is completely built before it replaces the current one, so readers of .schedule always see either the
+    old schedule or the new one, never a half built mix.  If the new file cannot be parsed the previous schedule is
+    kept, and that broken version of the file is not parsed again until it changes.
+
+    With a cache_filename, a schedule that is parsed is also written to that binary cache, and reload() reads the
+    cache instead of parsing the JSON while the JSON file's signature is the one the cache was compiled from.  If the
+    cache can't be written, for example while the filesystem is read-only or when the schedule holds values the cache
+    can't store, the schedule is still used and the JSON is simply parsed every time.
+
+    :parameters:
+        filename (str): Path of the schedule JSON file.
+        change_check (str): CHANGE_CHECK_STAT or CHANGE_CHECK_CRC.
+        cache_filename (str): Path of the binary cache file, None to parse the JSON every time.
+    """
+
+    def __init__(self, filename, change_check=CHANGE_CHECK_STAT, cache_filename=None):
+        if change_check not in (CHANGE_CHECK_STAT, CHANGE_CHECK_CRC):
+            raise ValueError("Invalid change check specified")
+        self.filename = filename
+        self.change_check = change_check
+        self.cache_filename = cache_filename
+        self.schedule = Schedule.empty()
+        self.signature = None  # Signature of the file that produced self.schedule, None until the first load.
+        self.failed_signature = None  # Signature of the last file version that failed to load.
+        self.load_count = 0  # Number of times the file has actually been parsed.
+        self.cache_loads = 0  # Number of times the schedule was read from the cache instead.
+
+    def current_signature(self, filename=None):
+        """
+        Returns the signature of the file, or of another file such as an upload, as it is on disk right now.
+        """
+        filename = filename or self.filename
+        signature = file_signature(filename)
+        if self.change_check == CHANGE_CHECK_CRC:
+            signature = signature + (file_crc(filename),)
+        return signature
+
+    def changed(self):
+        """
+        Returns True if the file differs from the one the current schedule was loaded from.
+        """
+        return self.current_signature() != self.signature
+
+    def reload(self, force=False, filename=None):
+        """
+        Reloads the schedule if the file has changed.
+
+        :parameters:
+            force (bool): If True, reload from the JSON even if the file signature has not changed, ignoring the
+                cache.  Use it after replacing the file within the 2 second modification time resolution of FAT.
+            filename (str): Load from this file instead, an upload that is renamed over the schedule file once its
+                schedule is installed.  Renaming keeps a file's size and modification time, so the signature
+                recorded for it is still the schedule file's afterwards.  If the rename fails the schedule file no
+                longer matches, and the next reload() goes back to it.
+
+        :returns:
+            reloaded (bool): True if a new schedule was loaded, False if the current one was kept.
+
+        Raises OSError if the file cannot be read and ValueError or KeyError if it cannot be parsed.  In both cases
+        the current schedule is left in place.
+        """
+        signature = self.current_signature(filename)
+        if not force and signature in (self.signature, self.failed_signature):
+            return False
+        schedule = None
+        if self.cache_filename is not None and not force:
+            schedule = read_cache(self.cache_filename, signature)
+        if schedule is not None:
+            self.cache_loads += 1
+        else:
+            try:
+                schedule = load_schedule(filename or self.filename)
+            except Exception:
+                self.failed_signature = signature
+                raise
+            self.load_count += 1
+            self.save_cache(schedule, signature)
+        # Swap in the fully built schedule and record which file version it came from.
+        self.schedule, self.signature = schedule, signature
+        return True
+
+    def save_cache(self, schedule, signature):
+        """
+        Writes the schedule to the cache file, if there is one.  Returns True if it was written.
+        """
+        if self.cache_filename is None:
+            return False
+        try:
+            write_cache(self.cache_filename, schedule, signature)
+        except Exception as e:
+            # Read-only filesystem, full flash or a value the cache can't store.  The JSON is parsed again next time,
+            # and an older cache is deleted so it can't be taken for this schedule.
+            if not isinstance(e, OSError):
+                print(f"Schedule cache not written: {e}")
+            remove_file(self.cache_filename)
+            return False
+        return True